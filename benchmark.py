@@ -0,0 +1,706 @@
+import os
+import sys
+import struct
+import tempfile
+from time import time
+from collections import OrderedDict
+
+import tcpip
+from tcpip import make_packet, make_datagram, write_pcap, parse_ip_string
+from tcpip import readstring, ip_header, tcp_header, parse_control, EOD
+from string import letters, digits, punctuation, whitespace
+from sql_parser import keywords
+
+# Usage: python benchmark.py [name [n]]
+#        python benchmark.py generate capture.pcap [megabytes [connections [seed]]]
+#        python benchmark.py suite [results.json [megabytes [connections [seed [repeat]]]]]
+#        python benchmark.py compare old.json new.json
+
+def timed_run(label, fn, count):
+    before = time()
+    fn()
+    elapsed = time() - before
+    print '%-30s %8.3fs %12.0f/s' % (label, elapsed, count / elapsed if elapsed else 0)
+    return elapsed
+
+def synthetic_packets(n, clients = 50, noise = 0):
+    # noise: how many port-80 packets to write for every MySQL one
+    server = (parse_ip_string('10.7.5.15'), 3306)
+    web = (parse_ip_string('10.7.5.80'), 80)
+    frames = []
+    for c in range(clients):
+        client = (parse_ip_string('10.5.6.%d' % (c % 250 + 1)), 30000 + c)
+        frames.append(make_packet(client, server, '\x1d\x00\x00\x00\x03SELECT * FROM customers WHERE 1'))
+        frames.append(make_packet(server, client, 'r' * (40 + 37 * c % 1400)))
+        for i in range(noise):
+            frames.append(make_packet(web, client, 'h' * (100 + 51 * i % 1400)))
+    for i in xrange(n):
+        yield 1000000000 + i / 1000.0, frames[i % len(frames)]
+
+def synthetic_capture(n):
+    fd = tempfile.NamedTemporaryFile(suffix = '.pcap')
+    write_pcap(fd, synthetic_packets(n))
+    fd.flush()
+    return fd
+
+def consume(packets):
+    for p in packets:
+        p.timestamp
+
+def bench_read_packets(n = 1000000):
+    capture = synthetic_capture(n)
+    print 'capture: %d packets, %d bytes' % (n, os.path.getsize(capture.name))
+    timed_run('stream_packets (fd.read)', lambda: consume(tcpip.stream_packets(file(capture.name, 'rb'))), n)
+    timed_run('read_packets (mmap)', lambda: consume(tcpip.read_packets(capture.name)), n)
+
+def legacy_parse(raw_data):
+    # The dict-per-header parse Packet.parse used before headers were precompiled
+    ip_data = raw_data[14:]
+    ip = readstring(ip_data[:20], ip_header)
+    tcp_data = ip_data[(ip['info'] & 0xF) * 4:]
+    header = readstring(tcp_data[0:20], tcp_header, endian='!')
+    control = parse_control(ord(tcp_data[13]))
+    return (ip['source'], header['source_port']), (ip['destination'], header['destination_port']), control, tcp_data[(ord(tcp_data[12])>>4) * 4:]
+
+def bench_parse(n = 200000):
+    frames = [raw for (ts, raw) in synthetic_packets(100)]
+    def legacy():
+        for i in xrange(n):
+            legacy_parse(frames[i % 100])
+    def compiled():
+        for i in xrange(n):
+            tcpip.Packet(frames[i % 100]).parse()
+    old = timed_run('dict headers', legacy, n)
+    new = timed_run('precompiled Layout records', compiled, n)
+    print 'per packet: %.2fus -> %.2fus' % (old / n * 1e6, new / n * 1e6)
+
+def bench_lazy_parse(n = 200000):
+    frames = [raw for (ts, raw) in synthetic_packets(200, noise = 18)]
+    def eager():
+        for i in xrange(n):
+            p = tcpip.Packet(frames[i % 200])
+            p.parse()
+            p.header, p.data
+    def lazy():
+        for i in xrange(n):
+            p = tcpip.Packet(frames[i % 200])
+            p.parse()
+            if p.destination[1] == 3306 or p.source[1] == 3306:
+                p.header, p.data
+    print '90% non-3306 traffic'
+    timed_run('dict headers', lambda: [legacy_parse(frames[i % 200]) for i in xrange(n)], n)
+    timed_run('decode everything', eager, n)
+    timed_run('lazy, decode 3306 only', lazy, n)
+
+def bench_filter(n = 500000):
+    fd = tempfile.NamedTemporaryFile(suffix = '.pcap')
+    write_pcap(fd, synthetic_packets(n, noise = 18))
+    fd.flush()
+    def run(filter):
+        def parse_all():
+            for p in tcpip.read_packets(fd.name, filter=filter):
+                p.parse()
+        return parse_all
+    print 'capture: %d packets, 90%% non-3306' % n
+    timed_run('no filter', run(None), n)
+    timed_run("filter 'tcp port 3306'", run('tcp port 3306'), n)
+    timed_run("filter '... and host'", run('tcp port 3306 and host 10.7.5.15'), n)
+
+def legacy_mysql_packetizer():
+    # The byte-at-a-time coroutine MysqlPacketizer replaced
+    h1 = yield
+    while True:
+        h2 = yield
+        h3 = yield
+        pn = yield
+        packet_len = (h3<<16) + (h2<<8) + h1
+        data = ""
+        for n in xrange(packet_len):
+            data += chr((yield))
+
+        h1 = yield (pn, data)
+
+def legacy_send(iter, data):
+    for c in data:
+        result = iter.send(ord(c))
+        if result:
+            yield result
+
+def result_set_stream(rows, row_size):
+    frame = lambda pn, payload: struct.pack('<I', len(payload) | ((pn % 256) << 24)) + payload
+    stream = [frame(1, '\x02')]
+    stream.extend([frame(2 + n, 'f' * 40) for n in range(2)])
+    stream.append(frame(4, '\xfe\x00\x00\x02\x00'))
+    stream.extend([frame(5 + n, 'r' * row_size) for n in xrange(rows)])
+    stream.append(frame(5 + rows, '\xfe\x00\x00\x02\x00'))
+    stream = ''.join(stream)
+    # Cut into MSS-sized segments like the wire would
+    return [buffer(stream, n, 1448) for n in xrange(0, len(stream), 1448)]
+
+def bench_packetizer(rows = 2000):
+    from queries import MysqlPacketizer
+    for row_size in (100, 10000, 200000):
+        segments = result_set_stream(rows, row_size) if row_size < 100000 else result_set_stream(rows // 100, row_size)
+        size = sum([len(s) for s in segments])
+        def legacy():
+            packetizer = legacy_mysql_packetizer()
+            packetizer.next()
+            for segment in segments:
+                list(legacy_send(packetizer, segment))
+        def framer():
+            packetizer = MysqlPacketizer()
+            for segment in segments:
+                packetizer.feed(segment)
+        print '%d byte rows, %d bytes' % (row_size, size)
+        timed_run('  per-byte coroutine (bytes/s)', legacy, size)
+        timed_run('  MysqlPacketizer (bytes/s)', framer, size)
+
+def bench_parallel(sessions = 400):
+    from multiprocessing import cpu_count
+    from queries import mysql_session, mysql_capture, analyze, analyze_parallel
+    server = (parse_ip_string('10.7.5.15'), 3306)
+    capture = mysql_capture([
+        mysql_session((parse_ip_string('10.5.%d.%d' % (n // 250, n % 250 + 1)), 20000 + n), server,
+                      [('SELECT * FROM customers WHERE customers_id = %d' % q, q % 20) for q in range(50)],
+                      ts = n * 0.01)
+        for n in range(sessions)])
+    queries = sessions * 50
+    timed_run('serial (queries/s)', lambda: analyze(capture.name), queries)
+    processes = 2
+    while processes <= cpu_count():
+        timed_run('%d processes (queries/s)' % processes, lambda: analyze_parallel(capture.name, processes), queries)
+        processes *= 2
+
+def bench_dump(keys = 2000, samples = 500):
+    import cPickle
+    import random
+    from queries import Bucket, SketchBucket
+    rng = random.Random(1)
+    for BucketFactory in (Bucket, SketchBucket):
+        bucket = BucketFactory()
+        for k in xrange(keys):
+            key = 'SELECT * FROM table_%d WHERE id = ?' % k
+            for n in xrange(samples):
+                bucket.increment(key, rng.lognormvariate(-5, 2))
+        pickled = cPickle.dumps(bucket.data)
+        binary = bucket.dump()
+        print '%s: %d keys x %d samples' % (BucketFactory.__name__, keys, samples)
+        print '  cPickle %10d bytes, binary %10d bytes' % (len(pickled), len(binary))
+        timed_run('  load cPickle (keys/s)', lambda: BucketFactory().load(pickled), keys)
+        timed_run('  load binary (keys/s)', lambda: BucketFactory().load(binary), keys)
+
+def query_corpus(distinct = 2000, n = 200000):
+    # Repeat-heavy: a few texts make up most of the traffic
+    import random
+    rng = random.Random(7)
+    texts = ["/* page_%d.php */ SELECT c.customers_id, c.name, o.total FROM customers c "
+             "INNER JOIN orders o ON o.customers_id = c.customers_id WHERE c.customers_id = %d "
+             "AND o.status IN ('open', 'paid', %d) ORDER BY o.created DESC LIMIT 20" % (k % 50, k * 7919, k)
+             for k in range(distinct)]
+    return [texts[min(int(rng.paretovariate(1.2)) - 1, distinct - 1)] for i in xrange(n)]
+
+def bench_sql_cache(n = 100000):
+    from sql_parser import Sql, SqlCache
+    queries = query_corpus(n = n)
+    print '%d queries, %d distinct texts' % (n, len(set(queries)))
+    timed_run('Sql() per query', lambda: [Sql(q).fuzzy() for q in queries], n)
+    for size in (100, 10000):
+        cache = SqlCache(size)
+        timed_run('SqlCache(%d)' % size, lambda: [cache(q).fuzzy() for q in queries], n)
+        print '  ', cache
+
+class LegacyStream(object):
+    def __init__(self, source):
+        self.source = source
+        self.pos = 0
+        
+    def peek(self, n=0):
+        if self.pos >= len(self.source):
+            return '\x00'
+        return self.source[self.pos + n]
+        
+    def pull(self):
+        if self.pos >= len(self.source):
+            raise EOD()
+        self.pos += 1
+        return self.source[self.pos - 1]
+
+def legacy_lexer(sql):
+    # The character-at-a-time lexer sql_parser.lexer replaced
+    stream = LegacyStream(sql)
+    while True:
+        try:
+            char = stream.pull()
+        except EOD:
+            return
+            
+        if char in whitespace:
+            continue
+            
+        elif char in letters:
+            # Tokens
+            result = char
+            while stream.peek() in letters+digits+'_.':
+                result += stream.pull()
+            if result.lower() in keywords:
+                result_type = 'keyword'
+                result = result.upper()
+            else:
+                result_type = 'token'
+            yield (result_type, result)
+            
+        elif char in digits:
+            # Numbers
+            result = char
+            while stream.peek() in digits+'.':
+                result += stream.pull()
+            yield ('number', result)
+            
+        elif char in punctuation:
+            # Symbols
+            if char == '/' and stream.peek() == '*':
+                # Comments
+                comment = char + stream.pull()
+                while True:
+                    char = stream.pull()
+                    comment += char
+                    if char == '*' and stream.peek() == '/':
+                        comment += stream.pull()
+                        yield ('comment', comment)
+                        break
+            elif char == "'" or char == '"' or char == '`':
+                # Quoted string
+                quote = char
+                result = char
+                while stream.peek() != quote or result[-1] == "\\":
+                    result += stream.pull()
+                    
+                result += stream.pull()
+                if quote == '`':
+                    yield ('token', result)
+                else:
+                    yield ('string', result)
+                
+            else:
+                # Operators, parens, etc
+                if char == '!' and stream.peek() == '=':
+                    yield ('symbol', char + stream.pull())
+                else:
+                    yield ('symbol', char)
+
+def bench_lexer(n = 2000):
+    from sql_parser import lexer
+    queries = [q + ' /* ' + 'x' * 200 + ' */ ' + q for q in set(query_corpus(distinct = 500, n = 20000))]
+    queries = (queries * (n // len(queries) + 1))[:n]
+    size = sum([len(q) for q in queries])
+    print '%d queries, %d bytes' % (n, size)
+    timed_run('Stream lexer (bytes/s)', lambda: [list(legacy_lexer(q)) for q in queries], size)
+    timed_run('regex lexer (bytes/s)', lambda: [list(lexer(q)) for q in queries], size)
+
+def bench_normalize(n = 2000):
+    from sql_parser import Sql, fingerprint
+    queries = list(set(query_corpus(distinct = 500, n = 20000)))
+    queries = (queries * (n // len(queries) + 1))[:n]
+    timed_run('Sql(q).fuzzy()', lambda: [Sql(q).fuzzy() for q in queries], n)
+    timed_run('fingerprint(q)', lambda: [fingerprint(q) for q in queries], n)
+
+def bench_tables(megabytes = 200):
+    # First-pass triage, busiest conversations: Packet by Packet, then in bulk
+    fd = tempfile.NamedTemporaryFile(suffix = '.pcap')
+    counts = generate(fd, megabytes * 1024 * 1024)
+    def packets():
+        totals = {}
+        for p in tcpip.read_packets(fd.name, filter = 'tcp'):
+            p.parse()
+            packets, size = totals.get(p.socket, (0, 0))
+            totals[p.socket] = (packets + 1, size + p.pcap.orig_len)
+        return totals
+    def tables():
+        return tcpip.conversations(tcpip.read_tables(fd.name))
+    print 'capture: %(bytes)d bytes, %(frames)d frames' % counts
+    timed_run('read_packets + socket (frames/s)', packets, counts['frames'])
+    if tcpip.numpy is None:
+        print 'read_tables needs NumPy'
+        return
+    timed_run('read_tables (frames/s)', lambda: list(tcpip.read_tables(fd.name)), counts['frames'])
+    timed_run('read_tables + conversations', tables, counts['frames'])
+
+# Synthetic MySQL traffic: python benchmark.py generate capture.pcap [megabytes [connections]]
+
+MSS = 1448
+
+query_shapes = [
+    # (weight, query text, result), result: rows as (lowest, highest, pareto alpha), or 'ok' / 'error'
+    (30, "SELECT * FROM customers WHERE customers_id = %(id)d", (1, 1, None)),
+    (20, "SELECT id, status, total FROM orders WHERE customers_id = %(id)d ORDER BY created DESC LIMIT %(limit)d",
+     (0, 50, None)),
+    (10, "SELECT COUNT(*) FROM sessions WHERE last_seen > %(time)d", (1, 1, None)),
+    (10, "/* report.php */ SELECT p.sku, p.name, p.description, s.quantity FROM products p "
+         "INNER JOIN stock s ON s.sku = p.sku WHERE p.category IN (%(ids)s)", (10, 20000, 1.1)),
+    (15, "UPDATE sessions SET last_seen = %(time)d WHERE session_id = '%(hex)s'", 'ok'),
+    (10, "INSERT INTO audit_log (customers_id, action, at) VALUES (%(id)d, 'login', %(time)d)", 'ok'),
+    (1, "SELECT * FROM customers_archive_%(limit)d WHERE customers_id = %(id)d", 'error'),
+]
+
+def mysql_frame(pn, payload):
+    return struct.pack('<I', len(payload) | ((pn % 256) << 24)) + payload
+
+def length_coded(n):
+    if n < 251:
+        return chr(n)
+    if n < 0x10000:
+        return '\xfc' + struct.pack('<H', n)
+    return '\xfd' + struct.pack('<I', n)[:3]
+
+class SyntheticConnection(object):
+    """
+    Frames of one MySQL connection at a time from client, in time order: the
+    handshake (SYN, SYN-ACK, greeting, login, OK), queries drawn from
+    query_shapes with the client's think time and the server's latency
+    between them, and a FIN when the session's done. Then it reconnects
+    from the next port. Data is cut into MSS segments, which the receiver
+    ACKs every other one; retransmits of them come at that rate.
+    """
+    def __init__(self, client_ip, server, rng, now, retransmits = 0.001, counts = None):
+        self.client_ip = client_ip
+        self.server = server
+        self.rng = rng
+        self.now = now
+        self.retransmits = retransmits
+        self.counts = counts if counts is not None else {}
+        self.port = 32768 + rng.randrange(20000)
+        self.weights = [weight for weight, text, result in query_shapes]
+
+    def count(self, name, n = 1):
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def send(self, source, destination, data = '', control = ('ACK', 'PSH')):
+        """Frames for one write (or a bare control segment), every MSS bytes; the receiver ACKs every other one."""
+        seq = self.seq
+        for n, start in enumerate(range(0, len(data), MSS) or [0]):
+            piece = data[start:start + MSS]
+            frame = make_packet(source, destination, piece, control, seq[source], seq[destination])
+            self.now += 0.000012 * (1 + len(piece) // 150)
+            yield self.now, frame
+            if piece and self.rng.random() < self.retransmits:
+                self.now += 0.0002
+                self.count('retransmits')
+                yield self.now, frame
+            seq[source] = (seq[source] + len(piece) + ('SYN' in control or 'FIN' in control)) & 0xFFFFFFFF
+            if piece and n % 2:
+                yield self.now, make_packet(destination, source, '', ('ACK',), seq[destination], seq[source])
+
+    def result(self, shape):
+        """(the server's response, rows in it)."""
+        rng = self.rng
+        if shape == 'ok':
+            return mysql_frame(1, '\x00' + length_coded(1) + length_coded(rng.randrange(100000)) + '\x02\x00\x00\x00'), 0
+        if shape == 'error':
+            return mysql_frame(1, '\xff' + struct.pack('<H', 1146) + "#42S02Table doesn't exist"), 0
+        lowest, highest, alpha = shape
+        if alpha is None:
+            rows = rng.randint(lowest, highest)
+        else:
+            rows = min(int(lowest * rng.paretovariate(alpha)), highest)
+        widths = [rng.choice((4, 10, 32, 200)) for n in range(rng.randint(1, 6))]
+        eof = '\xfe\x00\x00\x02\x00'
+        frames = [mysql_frame(1, length_coded(len(widths)))]
+        frames.extend([mysql_frame(2 + n, '\x03def\x04shop\x05table\x05table\x04col%d\x04col%d' % (n, n) + '\x00' * 13)
+                       for n in range(len(widths))])
+        pn = 2 + len(widths)
+        frames.append(mysql_frame(pn, eof))
+        row = ''.join([length_coded(width) + 'v' * width for width in widths])
+        for n in xrange(rows):
+            frames.append(mysql_frame(pn + 1 + n, row))
+        frames.append(mysql_frame(pn + 1 + rows, eof))
+        return ''.join(frames), rows
+
+    def session(self, queries):
+        rng = self.rng
+        self.port = 32768 + (self.port - 32768 + 1) % 28000
+        client, server = (self.client_ip, self.port), self.server
+        self.seq = {client: rng.randrange(1 << 32), server: rng.randrange(1 << 32)}
+        for frame in self.send(client, server, control = ('SYN',)):
+            yield frame
+        self.count('connections')
+        for frame in self.send(server, client, control = ('SYN', 'ACK')):
+            yield frame
+        greeting = mysql_frame(0, '\x0a5.1.73-log\x00' + '\x00' * 4 + 's' * 8 + '\x00' * 19 + 's' * 12 + '\x00')
+        login = mysql_frame(1, '\x85\xa6\x03\x00\x00\x00\x00\x01\x08' + '\x00' * 23 + 'app\x00\x14' + 'p' * 20)
+        ok = mysql_frame(2, '\x00\x00\x00\x02\x00\x00\x00')
+        for source, destination, data in ((server, client, greeting), (client, server, login), (server, client, ok)):
+            for frame in self.send(source, destination, data):
+                yield frame
+        for n in xrange(queries):
+            self.now += rng.expovariate(500)
+            weight, text, shape = query_shapes[self.pick()]
+            sql = text % {'id': rng.randrange(1000000), 'limit': rng.choice((10, 20, 50)), 'time': 1300000000 + n,
+                          'hex': '%032x' % rng.getrandbits(128),
+                          'ids': ', '.join([str(rng.randrange(500)) for i in range(rng.randint(1, 8))])}
+            for frame in self.send(client, server, mysql_frame(0, '\x03' + sql)):
+                yield frame
+            self.now += rng.lognormvariate(-7.5, 1)
+            response, rows = self.result(shape)
+            for frame in self.send(server, client, response):
+                yield frame
+            # Counted once the response is out, so a capture cut short only counts what it has
+            self.count('queries')
+            self.count('rows', rows)
+            if shape == 'error':
+                self.count('errors')
+        for frame in self.send(client, server, mysql_frame(0, '\x01')):
+            yield frame
+        for frame in self.send(client, server, control = ('FIN', 'ACK')):
+            yield frame
+        for frame in self.send(server, client, control = ('FIN', 'ACK')):
+            yield frame
+
+    def pick(self):
+        target = self.rng.random() * sum(self.weights)
+        for n, weight in enumerate(self.weights):
+            target -= weight
+            if target < 0:
+                return n
+        return len(self.weights) - 1
+
+    def __iter__(self):
+        while True:
+            for frame in self.session(self.rng.randint(20, 400)):
+                yield frame
+            self.now += self.rng.expovariate(10)
+
+def noise_frame(rng):
+    """Something that isn't MySQL: mostly web traffic, some of it IPv6, DNS over UDP and ARP."""
+    kind = rng.random()
+    if kind < 0.1:
+        return '\xff' * 6 + '\x00\x19\xb9\xf3\xb4\xb5' + '\x08\x06' + '\x00\x01\x08\x00\x06\x04\x00\x01' + '\x00' * 28
+    if kind < 0.2:
+        # Some with no payload at all: an 8 byte datagram is shorter than a TCP header
+        dns = (parse_ip_string('10.7.5.53'), 53)
+        client = (parse_ip_string('10.5.%d.%d' % (rng.randrange(8), rng.randrange(1, 250))), rng.randrange(32768, 61000))
+        query = '' if rng.random() < 0.3 else rng.choice(('\x00\x01\x01\x00', '\x81\x80\x00\x01')) + 'd' * rng.randrange(20, 120)
+        return make_datagram(client, dns, query) if rng.random() < 0.5 else make_datagram(dns, client, query)
+    client_port, size = rng.randrange(32768, 61000), rng.choice((0, 0, 120, 600, MSS))
+    if kind < 0.25:
+        web = (parse_ip_string('2001:db8::80'), 443)
+        client = (parse_ip_string('2001:db8::%x' % rng.randrange(1, 0xffff)), client_port)
+    else:
+        web = (parse_ip_string('10.7.5.80'), 80)
+        client = (parse_ip_string('10.5.%d.%d' % (rng.randrange(8), rng.randrange(1, 250))), client_port)
+    source, destination = (web, client) if rng.random() < 0.7 else (client, web)
+    return make_packet(source, destination, 'h' * size, ('ACK', 'PSH') if size else ('ACK',), rng.getrandbits(32))
+
+def synthetic_traffic(connections = 50, seed = 1, retransmits = 0.001, noise = 0.25, start = 1300000000.0, counts = None):
+    """
+    (timestamp, frame) for ever: connections concurrent MySQL connections
+    (see SyntheticConnection), interleaved by time, with on average noise
+    non-MySQL frames for every MySQL one. The same seed gives the same
+    traffic.
+    """
+    import heapq
+    import random
+    rng = random.Random(seed)
+    counts = counts if counts is not None else {}
+    server = (parse_ip_string('10.7.5.15'), 3306)
+    streams = [iter(SyntheticConnection(parse_ip_string('10.5.%d.%d' % (10 + c // 250, c % 250 + 1)), server,
+                                        random.Random(rng.getrandbits(64)), start + rng.random() * 0.01,
+                                        retransmits, counts))
+               for c in range(connections)]
+    p = noise / (1.0 + noise)
+    for timestamp, frame in heapq.merge(*streams):
+        yield timestamp, frame
+        while rng.random() < p:
+            yield timestamp, noise_frame(rng)
+            counts['noise'] = counts.get('noise', 0) + 1
+
+def generate(fd, size, **options):
+    """Writes a pcap of synthetic_traffic(**options) to fd, stopping after size bytes of frames; returns the counts."""
+    counts = {'frames': 0, 'bytes': 0}
+    def frames():
+        for timestamp, frame in synthetic_traffic(counts = counts, **options):
+            if counts['bytes'] >= size:
+                return
+            counts['frames'] += 1
+            counts['bytes'] += len(frame)
+            yield timestamp, frame
+    write_pcap(fd, frames())
+    fd.flush()
+    return counts
+
+# The regression suite: python benchmark.py suite [results.json [megabytes]]
+# times each stage on its own and end to end over a generated capture, best
+# of a few runs, and saves the results (and where they came from) as JSON;
+# python benchmark.py compare old.json new.json shows what changed.
+
+class Recorder(object):
+    def __init__(self):
+        self.packets = []
+    def saw_packet(self, packet):
+        self.packets.append(packet)
+
+def best_of(repeat, fn):
+    """(fastest time of repeat runs of fn, what the last run returned)."""
+    best = None
+    for n in range(repeat):
+        before = time()
+        result = fn()
+        elapsed = time() - before
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def run_suite(capture, repeat = 3, limit = 200000):
+    """
+    {stage: {'seconds', 'items', 'unit', 'rate'}} for capture. The stages
+    after read_packets work on its first limit MySQL packets, held in memory,
+    so each only times itself.
+    """
+    from itertools import islice
+    from sql_parser import lexer, fingerprint
+    from queries import MysqlConnection, Bucket, SketchBucket, analyze
+    results = OrderedDict()
+    def record(stage, seconds, items, unit):
+        results[stage] = OrderedDict([('seconds', seconds), ('items', items), ('unit', unit),
+                                      ('rate', items / seconds if seconds else 0)])
+        print '%-22s %8.3fs %14.0f %s/s' % (stage, seconds, results[stage]['rate'], unit)
+
+    size = os.path.getsize(capture)
+    seconds, frames = best_of(repeat, lambda: sum(1 for p in tcpip.read_packets(capture)))
+    record('read_packets', seconds, size, 'bytes')
+    packets = list(islice(tcpip.read_packets(capture, filter = 'tcp port 3306'), limit))
+
+    def demux():
+        conns = []
+        def ConnFactory():
+            conns.append(Recorder())
+            return conns[-1]
+        tcpip.collapse_tcp_streams(iter(packets), ConnFactory)
+        return conns
+    seconds, conns = best_of(repeat, demux)
+    record('collapse_tcp_streams', seconds, len(packets), 'packets')
+
+    def mysql():
+        queries = []
+        for conn in conns:
+            connection = MysqlConnection(queries.append)
+            for packet in conn.packets:
+                connection.saw_packet(packet)
+        return queries
+    seconds, queries = best_of(repeat, mysql)
+    record('MysqlConnection', seconds, sum([len(conn.packets) for conn in conns]), 'packets')
+
+    texts = [query.sql for query in queries]
+    seconds, tokens = best_of(repeat, lambda: [list(lexer(sql)) for sql in texts])
+    record('lexer', seconds, sum(map(len, texts)), 'bytes')
+
+    samples = [(fingerprint(query.sql)[0], query.first_result - query.timestamp) for query in queries]
+    for BucketFactory in (Bucket, SketchBucket):
+        def aggregate():
+            bucket = BucketFactory()
+            for key, value in samples:
+                bucket.increment(key, value)
+            return bucket
+        seconds, bucket = best_of(repeat, aggregate)
+        record(BucketFactory.__name__, seconds, len(samples), 'queries')
+
+    seconds, stats = best_of(repeat, lambda: analyze(capture))
+    record('end_to_end', seconds, stats.queries, 'queries')
+    results['end_to_end']['packets_per_second'] = frames / seconds
+    return results
+
+def environment():
+    """What the results depend on besides the code: the interpreter, the machine, and which code."""
+    import platform
+    import subprocess
+    try:
+        revision = subprocess.Popen(['git', 'rev-parse', 'HEAD'], stdout = subprocess.PIPE, stderr = subprocess.PIPE,
+                                    cwd = os.path.dirname(os.path.abspath(__file__))).communicate()[0].strip() or None
+    except OSError:
+        revision = None
+    return OrderedDict([('revision', revision), ('python', sys.version.split()[0]), ('platform', platform.platform()),
+                        ('machine', platform.machine()), ('when', time())])
+
+def suite(out = None, megabytes = 20, connections = 50, seed = 1, repeat = 3):
+    import json
+    capture = tempfile.NamedTemporaryFile(suffix = '.pcap')
+    counts = generate(capture, megabytes * 1024 * 1024, connections = connections, seed = seed)
+    print 'capture: %(bytes)d bytes, %(frames)d frames, %(queries)d queries, %(connections)d connections' % counts
+    document = OrderedDict([('environment', environment()),
+                            ('capture', OrderedDict([('megabytes', megabytes), ('connections', connections),
+                                                     ('seed', seed), ('counts', counts)])),
+                            ('repeat', repeat),
+                            ('results', run_suite(capture.name, repeat))])
+    if out is not None:
+        fd = file(out, 'w')
+        json.dump(document, fd, indent = 1)
+        fd.close()
+    return document
+
+def compare(old, new):
+    """Prints how each stage's rate changed between two suite result files."""
+    import json
+    before, after = [json.load(file(name), object_pairs_hook = OrderedDict) for name in (old, new)]
+    for stage, result in after['results'].items():
+        if stage not in before['results']:
+            continue
+        was = before['results'][stage]['rate']
+        print '%-22s %14.0f -> %14.0f %s/s  %+6.1f%%' % (stage, was, result['rate'], result['unit'],
+                                                     (result['rate'] / was - 1) * 100 if was else 0)
+
+import unittest
+
+class TestSyntheticTraffic(unittest.TestCase):
+
+    def capture(self, **options):
+        fd = tempfile.NamedTemporaryFile(suffix = '.pcap')
+        return fd, generate(fd, 300000, **options)
+
+    def test_analyzed(self):
+        from queries import analyze
+        fd, counts = self.capture(connections = 8, retransmits = 0.01)
+        stats = analyze(fd.name)
+        self.assertTrue(counts['queries'] > 50)
+        self.assertEqual(counts['queries'], stats.queries)
+        self.assertEqual(counts['errors'], stats.counters.get('mysql_error_1146', 0))
+        self.assertEqual(counts['retransmits'], stats.counters['tcp_retransmits'])
+        self.assertEqual(0, stats.counters.get('tcp_gaps', 0))
+        self.assertEqual(8, stats.counters['peak_connections'])
+        self.assertEqual(counts['frames'], len(list(tcpip.read_packets(fd.name))))
+        self.assertEqual(counts['frames'] - counts['noise'], len(list(tcpip.read_packets(fd.name, filter = 'tcp port 3306'))))
+        # Unfiltered, the UDP and ARP noise reaches the demuxer too
+        packets = list(tcpip.read_packets(fd.name))
+        self.assertTrue([p for p in packets if str(p.raw_data[12:14]) == '\x08\x00' and len(p.raw_data) == 42])
+        self.assertEqual(counts['connections'], tcpip.collapse_tcp_streams(packets, Recorder).opened)
+
+    def test_reproducible(self):
+        first, second, other = self.capture(seed = 5)[0], self.capture(seed = 5)[0], self.capture(seed = 6)[0]
+        self.assertEqual(file(first.name, 'rb').read(), file(second.name, 'rb').read())
+        self.assertNotEqual(file(first.name, 'rb').read(), file(other.name, 'rb').read())
+
+benchmarks = {
+    'read_packets': bench_read_packets,
+    'parse': bench_parse,
+    'lazy_parse': bench_lazy_parse,
+    'filter': bench_filter,
+    'packetizer': bench_packetizer,
+    'parallel': bench_parallel,
+    'dump': bench_dump,
+    'sql_cache': bench_sql_cache,
+    'lexer': bench_lexer,
+    'normalize': bench_normalize,
+    'tables': bench_tables,
+}
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ['generate']:
+        options = dict(zip(('connections', 'seed'), [int(a) for a in sys.argv[4:6]]))
+        print generate(file(sys.argv[2], 'wb'), float(sys.argv[3] if len(sys.argv) > 3 else 100) * 1024 * 1024, **options)
+    elif sys.argv[1:2] == ['suite']:
+        suite(sys.argv[2] if len(sys.argv) > 2 else None, *[int(a) for a in sys.argv[3:]])
+    elif sys.argv[1:2] == ['compare']:
+        compare(sys.argv[2], sys.argv[3])
+    else:
+        names = sys.argv[1:2] or sorted(benchmarks)
+        args = [int(a) for a in sys.argv[2:]]
+        for name in names:
+            print '==', name
+            benchmarks[name](*args)
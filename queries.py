@@ -1,27 +1,54 @@
-from tcpip import read_packets, collapse_tcp_streams, uint16, uint64,read1string
+import sys
+import mmap
+import heapq
+import struct
+from collections import deque, OrderedDict
+from math import log, ceil
+from array import array
+from cStringIO import StringIO
+from tcpip import read_packets, read_tables, capture_index, collapse_tcp_streams, ConnectionTable, TcpReassembler, uint16, uint32, uint64,read1string, read, EOD
 from itertools import islice, chain
-from sql_parser import Sql
+from sql_parser import Sql, SqlCache, fingerprint, fingerprint_id
 from cPickle import loads, dumps
 
-def mysql_packetizer():
-    h1 = yield
-    while True:
-        h2 = yield
-        h3 = yield
-        pn = yield
-        packet_len = (h3<<24) + (h2<<8) + h1        
-        data = ""
-        for n in xrange(packet_len):
-            data += chr((yield))
-
-        h1 = yield (pn, data)
-        
-def send(iter, data):
-    for c in data:
-        result = iter.send(ord(c))
-        if result:
-            yield result
-            
+mysql_header_struct = struct.Struct('<' + uint32)
+
+class MysqlPacketizer(object):
+    """
+    Splits one direction of a TCP stream into MySQL packets. feed() takes
+    whatever a segment carried and returns the complete (packet number,
+    payload) pairs in it; a partial packet waits in the buffer for the next
+    segment.
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, data):
+        buffer = self.buffer
+        if buffer:
+            buffer.extend(data)
+            data = buffer
+
+        unpack_from = mysql_header_struct.unpack_from
+        end = len(data)
+        offset = 0
+        packets = []
+        while offset + 4 <= end:
+            header, = unpack_from(data, offset)
+            start = offset + 4
+            stop = start + (header & 0xFFFFFF)
+            if stop > end:
+                break
+            packets.append((header >> 24, str(data[start:stop])))
+            offset = stop
+
+        if data is buffer:
+            del buffer[:offset]
+        elif offset < end:
+            # Nothing was buffered, so only the leftover gets copied
+            self.buffer = bytearray(data[offset:])
+        return packets
+
 commands = {
     0: 'COM_SLEEP',
     1: 'COM_QUIT',
@@ -54,80 +81,183 @@ commands = {
     28: 'COM_STMT_FETCH'
 }
 
-def lcb(string):
-    first = ord(string[0])
+def read_lcb(data, offset = 0):
+    """The length coded binary at offset: (value, or None for NULL; offset just past it)."""
+    if offset >= len(data):
+        raise BadDataException('malformed')
+    first = ord(data[offset])
     if first <= 250:
-        return first
+        return first, offset + 1
     elif first == 251:
-        return None # null
-    elif first == 252:        
-        return read1string(uint16, string[1:3])
-    elif first == 253:
-        raise "Didn't implement uint24 because bleh"
-    elif first == 254:
-        return read1string(uint64, string[1:9])
+        return None, offset + 1 # null
+    size = {252: 2, 253: 3, 254: 8}.get(first)
+    if size is None or offset + 1 + size > len(data):
+        raise BadDataException('malformed')
+    value = data[offset + 1:offset + 1 + size]
+    if size == 3:
+        value += '\x00'
+    return read1string(value, '<' + {2: uint16, 3: uint32, 8: uint64}[size]), offset + 1 + size
+
+def lcb(string):
+    return read_lcb(string)[0]
+
+# EOF and OK packets carry server status flags
+SERVER_MORE_RESULTS_EXISTS = 0x0008
+status_struct = struct.Struct('<' + uint16)
+prepare_ok_struct = struct.Struct('<' + uint32 + uint16 + uint16)
+statement_id_struct = struct.Struct('<' + uint32)
+error_code_struct = struct.Struct('<' + uint16)
 
 class MysqlQuery(object):
-    def __init__(self, sql, ts):
+    """
+    One command and the server's response to it. command is COM_QUERY,
+    COM_STMT_PREPARE or COM_STMT_EXECUTE (sql is then the prepared text);
+    error_code is set when the server answered with an error.
+
+    The timestamps split the response into phases: up to field_response the
+    server is thinking, up to first_result it sends column definitions, and
+    up to last_result rows (which come to result_size rows, result_bytes
+    bytes of MySQL packets).
+    """
+    def __init__(self, sql, ts, midstream = False, command = 'COM_QUERY', connection = 0):
         self.sql = sql
         self.timestamp = ts
+        self.midstream = midstream
+        self.command = command
+        self.connection = connection
         self.field_response = 0
         self.first_result = 0
         self.last_result = 0
+        self.result_size = 0
+        self.result_bytes = 0
+        self.resultsets = 0
+        self.error_code = None
 
 class BadDataException(Exception):
-    pass
+    """The state machine lost track of the conversation; cause says how (see failure_causes)."""
+    def __init__(self, cause, packet = None):
+        Exception.__init__(self, cause, packet)
+        self.cause = cause
+        self.packet = packet
+
+failure_causes = ('sequence_mismatch', 'unexpected_direction', 'unknown_command', 'eof_missing', 'malformed', 'stream_gap')
+
+def starts_query(packet):
+    """
+    Does this segment look like the start of a COM_QUERY: packet number 0,
+    command 3, and a length that at least covers the rest of the segment?
+    That's our cue to join a connection whose handshake we never saw.
+    """
+    if packet.destination[1] != 3306:
+        return False
+    data = packet.data
+    if len(data) < 6:
+        return False
+    header, = mysql_header_struct.unpack_from(data)
+    length = header & 0xFFFFFF
+    return (header >> 24 == 0 and data[4] == '\x03' and length >= len(data) - 4
+            and length < 0xFFFFFF and (' ' <= data[5] <= '~' or data[5] in '\t\r\n'))
 
 conns = 0
 class MysqlConnection(object):
     
-    def __init__(self, onQuery = lambda *args, **kw: None):
+    def __init__(self, onQuery = lambda *args, **kw: None, midstream = False, counters = None):
+        """
+        midstream: joining after the handshake, at a command; see starts_query.
+        counters: dict for the TCP and protocol failure counts, usually shared by all connections.
+        """
         global conns
         conns +=1
         self.conn = conns
-        self.to_server = mysql_packetizer()
-        self.from_server = mysql_packetizer()
-        self.to_server.next()
-        self.from_server.next() 
+        self.midstream = midstream
+        self.counters = {} if counters is None else counters
+        self.failures = {}
+        self.to_server = MysqlPacketizer()
+        self.from_server = MysqlPacketizer()
+        self.streams = {'to_server': TcpReassembler(self.counters), 'from_server': TcpReassembler(self.counters)}
+
+        self.statements = {}
+        self.received = 0
 
+        self.resyncing = False
         self.protocol = self.saw_mysql_packet()
         self.protocol.next()
         
         self.onQuery = onQuery
         
     def saw_packet(self, packet):
-        if not self.protocol:
-            return
-            
         if packet.destination[1] == 3306:
             dir = 'to_server'
         elif packet.destination[1] != 3306:
             dir = 'from_server'
             
-        for pn, data in send(getattr(self, dir), packet.data):
-            mysql_packet = {'dir': dir, 'num':pn, 'data':data, 'packet': packet, 'first': ord(data[0])}
-            try:
-                self.protocol.send(mysql_packet)
-            except (BadDataException, AssertionError):
-                self.protocol = None
-                break
-                
+        for packet, segment in self.streams[dir].feed(packet):
+            if segment is None:
+                # Lost bytes: hope the next segment starts a MySQL packet
+                self.failed('stream_gap', dir)
+                continue
+            for pn, data in getattr(self, dir).feed(segment):
+                if dir == 'from_server':
+                    self.received += len(data) + 4
+                if not data:
+                    # No command or response byte; while resyncing, that's just stray bytes read as a header
+                    if not self.resyncing:
+                        self.failed('malformed', dir)
+                        break
+                    continue
+                mysql_packet = {'dir': dir, 'num':pn, 'data':data, 'packet': packet, 'first': ord(data[0])}
+                try:
+                    self.protocol.send(mysql_packet)
+                except BadDataException, e:
+                    self.failed(e.cause, dir)
+                    break
+
+    def failed(self, cause, dir):
+        """
+        Counts the failure, throws away whatever dir's packetizer was holding
+        and restarts the state machine, to pick up again at the next
+        plausible command.
+        """
+        self.failures[cause] = self.failures.get(cause, 0) + 1
+        name = 'protocol_' + cause
+        self.counters[name] = self.counters.get(name, 0) + 1
+        setattr(self, dir, MysqlPacketizer())
+        self.resyncing = True
+        self.protocol = self.saw_mysql_packet()
+        self.protocol.next()
+
+    def resynced(self, packet):
+        """Is this where a lost conversation picks up again: a command, starting a client packet sequence?"""
+        if packet['dir'] != 'to_server' or packet['num'] != 0 or packet['first'] not in commands:
+            return False
+        data = packet['data']
+        if packet['first'] == 3 and not (len(data) > 1 and (' ' <= data[1] <= '~' or data[1] in '\t\r\n')):
+            return False
+        self.resyncing = False
+        self.counters['protocol_resyncs'] = self.counters.get('protocol_resyncs', 0) + 1
+        # Whatever the server was in the middle of, its answer to this starts afresh
+        self.from_server = MysqlPacketizer()
+        return True
         
     def saw_mysql_packet(self):
         
         internal_num = 0
         
-        # handshake init
-        packet = yield
-        assert packet['dir'] == 'from_server'
-        
-        # client auth
-        packet = yield
-        assert packet['dir'] == 'to_server'
-        
-        # server response to auth
-        packet = yield
-        assert packet['dir'] == 'from_server'
+        if not self.midstream and not self.resyncing:
+            # handshake init
+            packet = yield
+            if packet['dir'] != 'from_server':
+                raise BadDataException('unexpected_direction', packet)
+            
+            # client auth
+            packet = yield
+            if packet['dir'] != 'to_server':
+                raise BadDataException('unexpected_direction', packet)
+            
+            # server response to auth
+            packet = yield
+            if packet['dir'] != 'from_server':
+                raise BadDataException('unexpected_direction', packet)
         
         MYSQL_EOF = 0xFE
         MYSQL_OK = 0x00
@@ -135,77 +265,280 @@ class MysqlConnection(object):
         
         self.num = 0
         def check(dir):            
-            if packet['dir'] != dir or packet['num'] != self.num % 0x100:
-                raise BadDataException((
-                    self.num,
-                    self.conn,
-                    packet))
+            if packet['dir'] != dir:
+                raise BadDataException('unexpected_direction', packet)
+            if packet['num'] != self.num % 0x100:
+                raise BadDataException('sequence_mismatch', packet)
             self.num += 1
+
+        def is_eof(packet):
+            return packet['first'] == MYSQL_EOF and len(packet['data']) < 9
+
+        def more_results(packet):
+            data = packet['data']
+            if packet['first'] == MYSQL_OK:
+                offset = read_lcb(data, read_lcb(data, 1)[1])[1]
+            else:
+                offset = 3
+            if len(data) < offset + 2:
+                return False
+            return bool(status_struct.unpack_from(data, offset)[0] & SERVER_MORE_RESULTS_EXISTS)
+
+        # Commands the server doesn't answer, and ones answered by packets up to an EOF
+        no_response = ('COM_QUIT', 'COM_STMT_CLOSE', 'COM_STMT_SEND_LONG_DATA')
+        until_eof = ('COM_FIELD_LIST', 'COM_STMT_FETCH')
             
         # commands!
         while True:
             # command
             self.num = 0
             packet = yield          
+            if self.resyncing and not self.resynced(packet):
+                continue
             check('to_server')
 
+            if packet['first'] not in commands:
+                raise BadDataException('unknown_command', packet)
             command = commands[packet['first']]
-            if command == 'COM_QUERY':
-                query = MysqlQuery(packet['data'][1:], packet['packet'].timestamp)
+            data = packet['data']
+            received = self.received
+            query = None
+            if command in ('COM_QUERY', 'COM_STMT_PREPARE'):
+                query = MysqlQuery(data[1:], packet['packet'].timestamp, self.midstream, command, self.conn)
+            elif command in ('COM_STMT_EXECUTE', 'COM_STMT_CLOSE'):
+                if len(data) < 5:
+                    raise BadDataException('malformed', packet)
+                statement_id, = statement_id_struct.unpack_from(data, 1)
+                if command == 'COM_STMT_CLOSE':
+                    self.statements.pop(statement_id, None)
+                else:
+                    # Prepared before we started listening: all we know is that it ran
+                    sql = self.statements.get(statement_id, 'EXECUTE ?')
+                    query = MysqlQuery(sql, packet['packet'].timestamp, self.midstream, command, self.conn)
 
-            def is_eof(packet):
-                return packet['first'] == 0xFE and len(packet['data']) < 9
+            if command in no_response:
+                continue
             
             packet = yield
             check('from_server')
-            
-            # OK or Error, no further responses
-            if packet['first'] in (MYSQL_OK, MYSQL_ERROR):
+
+            if command in until_eof:
+                # An error ends it too, say for a table that doesn't exist
+                while not is_eof(packet) and packet['first'] != MYSQL_ERROR:
+                    packet = yield
+                    check('from_server')
                 continue
-            
+
+            # Anything else we don't time gets one packet back: OK, error, or a string
+            if query is None:
+                continue
+
             query.field_response = packet['packet'].timestamp
-            
-            # Otherwise it's a field-count packet
-            field_count = lcb(packet['data'])
-            
-            for n in range(field_count):
-                packet = yield
-                check('from_server')
-            
-            packet = yield
-            check('from_server')
-            assert is_eof(packet)
-            
-            first = True
-            results = 0
+
+            if command == 'COM_STMT_PREPARE' and packet['first'] == MYSQL_OK:
+                data = packet['data']
+                if len(data) < 9:
+                    raise BadDataException('malformed', packet)
+                statement_id, columns, params = prepare_ok_struct.unpack_from(data, 1)
+                self.statements[statement_id] = query.sql
+                # parameter definitions, then column definitions, each followed by an EOF
+                for count in (params, columns):
+                    if count:
+                        for n in range(count + 1):
+                            packet = yield
+                            check('from_server')
+                        if not is_eof(packet):
+                            raise BadDataException('eof_missing', packet)
+                query.first_result = query.last_result = packet['packet'].timestamp
+                query.resultsets = 1
+                query.result_bytes = self.received - received
+                self.onQuery(query)
+                continue
+
+            # One or more results, each an OK, an error, or a result set (text
+            # rows for COM_QUERY, binary ones for COM_STMT_EXECUTE)
             while True:
+                timestamp = packet['packet'].timestamp
+                if not query.resultsets:
+                    query.first_result = timestamp
+                query.resultsets += 1
+                more = False
+
+                if packet['first'] == MYSQL_ERROR:
+                    if len(packet['data']) >= 3:
+                        query.error_code, = error_code_struct.unpack_from(packet['data'], 1)
+                elif packet['first'] == MYSQL_OK:
+                    more = more_results(packet)
+                else:
+                    # Otherwise it's a field-count packet
+                    field_count = lcb(packet['data'])
+                    if field_count is None:
+                        raise BadDataException('malformed', packet)
+
+                    for n in range(field_count):
+                        packet = yield
+                        check('from_server')
+
+                    packet = yield
+                    check('from_server')
+                    if not is_eof(packet):
+                        raise BadDataException('eof_missing', packet)
+
+                    first = query.resultsets == 1
+                    while True:
+                        packet = yield
+                        check('from_server')
+
+                        if first:
+                            query.first_result = packet['packet'].timestamp
+                            first = False
+
+                        if is_eof(packet):
+                            more = more_results(packet)
+                            break
+                        if packet['first'] == MYSQL_ERROR:
+                            # The statement failed partway through its rows
+                            if len(packet['data']) >= 3:
+                                query.error_code, = error_code_struct.unpack_from(packet['data'], 1)
+                            break
+                        query.result_size += 1
+
+                query.last_result = packet['packet'].timestamp
+                if not more:
+                    break
                 packet = yield
                 check('from_server')
-                
-                if first:
-                    query.first_result = packet['packet'].timestamp
-                    first = False
-                
-                if is_eof(packet):
-                    break
-                results += 1
-                
-            query.last_result = packet['packet'].timestamp
-            query.result_size = results
+
+            query.result_bytes = self.received - received
             self.onQuery(query)
 
+"""
+Bucket dump format, all little-endian:
+
+    'MPKB' | uint16 version | uint8 kind | uint32 key count
+    key table: per key, uint8 type | uint32 length | bytes
+        ('s' str, 'i' int64, 'q' Sql text, 'p' pickle)
+    values, in key table order:
+        kind 0 (Bucket): uint32 n | n doubles
+        kind 1 (SketchBucket): see SketchBucket.write_value
+
+The key table comes first so a reader can merge one key's values at a time.
+"""
+
+DUMP_MAGIC = 'MPKB'
+DUMP_VERSION = 1
+dump_header_struct = struct.Struct('<4sHBI')
+dump_key_struct = struct.Struct('<cI')
+count_struct = struct.Struct('<I')
+int64_struct = struct.Struct('<q')
+
+class DumpFormatError(ValueError):
+    pass
+
+def encode_key(key):
+    if isinstance(key, Sql):
+        return 'q', key.sql
+    elif isinstance(key, str):
+        return 's', key
+    elif isinstance(key, (int, long)) and -2**63 <= key < 2**63:
+        return 'i', int64_struct.pack(key)
+    return 'p', dumps(key, 2)
+
+def decode_key(type, data):
+    if type == 'q':
+        return Sql(data)
+    elif type == 's':
+        return data
+    elif type == 'i':
+        return int64_struct.unpack(data)[0]
+    elif type == 'p':
+        return loads(data)
+    raise DumpFormatError("Unknown key type %r" % type)
+
+def pack_array(typecode, values):
+    values = array(typecode, values)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tostring()
+
+def unpack_array(typecode, fd, count):
+    values = array(typecode)
+    values.fromstring(read(fd, values.itemsize * count))
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+def write_dump(fd, kind, data, write_value):
+    keys = data.keys()
+    fd.write(dump_header_struct.pack(DUMP_MAGIC, DUMP_VERSION, kind, len(keys)))
+    for key in keys:
+        type, encoded = encode_key(key)
+        fd.write(dump_key_struct.pack(type, len(encoded)))
+        fd.write(encoded)
+    for key in keys:
+        write_value(fd, data[key])
+
+def read_dump(fd, kind, read_value):
+    """Yields (key, value) from a dump, reading one value at a time."""
+    magic, version, dump_kind, key_count = dump_header_struct.unpack(read(fd, dump_header_struct.size))
+    if magic != DUMP_MAGIC:
+        raise DumpFormatError("Not a Bucket dump")
+    if version != DUMP_VERSION:
+        raise DumpFormatError("Can't read Bucket dump version %d" % version)
+    if dump_kind != kind:
+        raise DumpFormatError("Bucket dump is kind %d, expected %d" % (dump_kind, kind))
+    keys = []
+    for n in xrange(key_count):
+        type, length = dump_key_struct.unpack(read(fd, dump_key_struct.size))
+        keys.append(decode_key(type, read(fd, length)))
+    for key in keys:
+        yield key, read_value(fd)
+
 class Bucket(object):
+    kind = 0
+
     def __init__(self):
         self.data = {}
         
     def dump(self):
-        return dumps(self.data)
+        fd = StringIO()
+        self.dump_file(fd)
+        return fd.getvalue()
+
+    def dump_file(self, fd):
+        write_dump(fd, self.kind, self.data, self.write_value)
         
     def load(self, string):
-        data_to_merge = loads(string)
-        for key, value in data_to_merge.items():
-            self.data.setdefault(key, [])
-            self.data[key].extend(value)
+        if not string.startswith(DUMP_MAGIC):
+            # cPickle dumps from before the binary format
+            for key, value in loads(string).items():
+                self.merge(key, value)
+            return
+        self.load_file(StringIO(string))
+
+    def load_file(self, fd):
+        for key, value in read_dump(fd, self.kind, self.read_value):
+            self.merge(key, value)
+
+    def merge(self, key, value):
+        self.data.setdefault(key, [])
+        self.data[key].extend(value)
+
+    def update(self, other):
+        """Merges in another bucket of the same kind, in memory rather than through a dump; other is left as it was."""
+        assert self.kind == other.kind, "Can't merge a kind %d bucket into kind %d" % (other.kind, self.kind)
+        for key, value in other.data.iteritems():
+            self.merge(key, value)
+
+    @staticmethod
+    def write_value(fd, samples):
+        fd.write(count_struct.pack(len(samples)))
+        fd.write(pack_array('d', samples))
+
+    @staticmethod
+    def read_value(fd):
+        count, = count_struct.unpack(read(fd, count_struct.size))
+        return unpack_array('d', fd, count)
         
     def increment(self, item, amount = 1):
         self.data.setdefault(item, [])
@@ -219,24 +552,242 @@ class Bucket(object):
         count = len(data)
         
         return total, total / float(count), count, median
+
+    def total(self, item):
+        return sum(self.data[item])
+
+    def count(self, item):
+        return len(self.data[item])
         
-    def counts(self):
-        items = [(k, self.aggregate(k)) for k in self.data.keys()]
+    def counts(self, n = None):
+        """(key, total, average, count, median), most total first; only the top n, if given, get aggregated."""
+        keys = self.data.keys() if n is None else heapq.nlargest(n, self.data, key = self.total)
+        items = [(k, self.aggregate(k)) for k in keys]
         items.sort(key = lambda (k,(s,a,c,m)): -s)
         return [(k, s, a, c, m) for (k,(s,a,c,m)) in items]
+
+    def quantile(self, item, q):
+        data = self.data[item]
+        data.sort()
+        return data[min(int(q * len(data)), len(data) - 1)]
+
+    def percentiles(self, item):
+        """(p50, p90, p99, max) of item's samples."""
+        return tuple([self.quantile(item, q) for q in (0.5, 0.9, 0.99, 1.0)])
+
+class LogHistogram(object):
+    """
+    A mergeable quantile sketch in the style of DDSketch: samples are counted
+    in logarithmically sized bins, so any quantile comes back within a
+    relative error of alpha, using a fixed number of bins however many
+    samples go in. Count, total, min and max are kept exactly.
+    """
+    __slots__ = ('alpha', 'gamma', 'log_gamma', 'max_bins', 'bins', 'negative', 'zero', 'count', 'total', 'min', 'max')
+
+    min_value = 1e-9
+
+    def __init__(self, alpha = 0.01, max_bins = 2048):
+        self.alpha = alpha
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self.log_gamma = log(self.gamma)
+        self.max_bins = max_bins
+        self.bins = {}
+        self.negative = {}
+        self.zero = 0
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def __getstate__(self):
+        return (self.alpha, self.max_bins, self.bins, self.negative, self.zero, self.count, self.total, self.min, self.max)
+
+    def __setstate__(self, (alpha, max_bins, bins, negative, zero, count, total, min, max)):
+        self.__init__(alpha, max_bins)
+        self.bins, self.negative, self.zero = bins, negative, zero
+        self.count, self.total, self.min, self.max = count, total, min, max
+
+    def add(self, value, count = 1):
+        if value > self.min_value:
+            bins = self.bins
+            index = int(ceil(log(value) / self.log_gamma))
+            bins[index] = bins.get(index, 0) + count
+        elif value < -self.min_value:
+            bins = self.negative
+            index = int(ceil(log(-value) / self.log_gamma))
+            bins[index] = bins.get(index, 0) + count
+        else:
+            bins = None
+            self.zero += count
+
+        self.count += count
+        self.total += value * count
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        if bins is not None and len(bins) > self.max_bins:
+            self.collapse(bins)
+
+    def collapse(self, bins):
+        # Fold the smallest bins into one, so only tiny values lose accuracy
+        keys = sorted(bins)
+        extra = len(keys) - self.max_bins
+        for key in keys[:extra]:
+            bins[keys[extra]] += bins.pop(key)
+
+    def merge(self, other):
+        assert self.gamma == other.gamma, "Can't merge sketches with different accuracy"
+        for mine, theirs in ((self.bins, other.bins), (self.negative, other.negative)):
+            for index, count in theirs.iteritems():
+                mine[index] = mine.get(index, 0) + count
+            if len(mine) > self.max_bins:
+                self.collapse(mine)
+        self.zero += other.zero
+        self.count += other.count
+        self.total += other.total
+        for value in (other.min, other.max):
+            if value is not None:
+                if self.min is None or value < self.min:
+                    self.min = value
+                if self.max is None or value > self.max:
+                    self.max = value
+
+    def value(self, index):
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def quantile(self, q):
+        """The sample at rank int(q * count), the same one Bucket.quantile picks from its sorted list."""
+        if not self.count:
+            return None
+        rank = min(int(q * self.count), self.count - 1)
+        if rank == self.count - 1:
+            return self.max
+        seen = 0
+        for index in sorted(self.negative, reverse = True):
+            seen += self.negative[index]
+            if seen > rank:
+                return max(-self.value(index), self.min)
+        seen += self.zero
+        if seen > rank:
+            return 0
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if seen > rank:
+                return min(self.value(index), self.max)
+        return self.max
+
+class SketchBucket(Bucket):
+    """
+    A Bucket that keeps a LogHistogram per key instead of every sample, so
+    memory stays bounded per key. Totals and counts are exact; medians and
+    percentiles are within alpha.
+    """
+    kind = 1
+    sketch_struct = struct.Struct('<dIQQdddIIc')
+
+    def __init__(self, alpha = 0.01):
+        Bucket.__init__(self)
+        self.alpha = alpha
+
+    def merge(self, key, sketch):
+        if key in self.data:
+            self.data[key].merge(sketch)
+        else:
+            self.data[key] = sketch
+
+    def update(self, other):
+        assert self.kind == other.kind, "Can't merge a kind %d bucket into kind %d" % (other.kind, self.kind)
+        data = self.data
+        for key, sketch in other.data.iteritems():
+            if key not in data:
+                # A copy, so later merges don't change other's sketch
+                data[key] = LogHistogram(sketch.alpha, sketch.max_bins)
+            data[key].merge(sketch)
+
+    @classmethod
+    def write_value(cls, fd, sketch):
+        # alpha, max_bins, zero, count, total, min, max, bin counts and the
+        # width of a bin count, then the positive and negative bins as int32
+        # indexes followed by their counts
+        largest = max(sketch.bins.values() + sketch.negative.values() + [0])
+        width = 'I' if largest < 2**32 else 'Q'
+        fd.write(cls.sketch_struct.pack(sketch.alpha, sketch.max_bins, sketch.zero, sketch.count, sketch.total,
+                                        sketch.min, sketch.max, len(sketch.bins), len(sketch.negative), width))
+        for bins in (sketch.bins, sketch.negative):
+            indexes = sorted(bins)
+            fd.write(pack_array('i', indexes))
+            fd.write(struct.pack('<%d%s' % (len(indexes), width), *[bins[index] for index in indexes]))
+
+    @classmethod
+    def read_value(cls, fd):
+        alpha, max_bins, zero, count, total, min, max, positive, negative, width = cls.sketch_struct.unpack(read(fd, cls.sketch_struct.size))
+        if width not in 'IQ':
+            raise DumpFormatError("Bad sketch bin width %r" % width)
+        sketch = LogHistogram(alpha, max_bins)
+        sketch.zero, sketch.count, sketch.total, sketch.min, sketch.max = zero, count, total, min, max
+        for bins, length in ((sketch.bins, positive), (sketch.negative, negative)):
+            indexes = unpack_array('i', fd, length)
+            counts = struct.unpack('<%d%s' % (length, width), read(fd, struct.calcsize('<' + width) * length))
+            bins.update(zip(indexes, counts))
+        return sketch
+
+    def increment(self, item, amount = 1):
+        sketch = self.data.get(item)
+        if sketch is None:
+            sketch = self.data[item] = LogHistogram(self.alpha)
+        sketch.add(amount)
+
+    def aggregate(self, item):
+        sketch = self.data[item]
+        return sketch.total, sketch.total / float(sketch.count), sketch.count, sketch.quantile(0.5)
+
+    def total(self, item):
+        return self.data[item].total
+
+    def count(self, item):
+        return self.data[item].count
+
+    def quantile(self, item, q):
+        return self.data[item].quantile(q)
         
-import sys
+def merge_dump_files(files, BucketFactory = Bucket):
+    """
+    Merges dumps from several files (names or open files) into one Bucket,
+    streaming each file a key at a time rather than reading them into memory.
+    """
+    bucket = BucketFactory()
+    for fd in files:
+        if isinstance(fd, basestring):
+            fd = file(fd, 'rb')
+            try:
+                bucket.load_file(fd)
+            finally:
+                fd.close()
+        else:
+            bucket.load_file(fd)
+    return bucket
+
 count_progress = 0
 def progress():
     global count_progress, total
     count_progress += 1
     if count_progress % 1000 == 0:
-        sys.stdout.write('.')
+        sys.stderr.write('.')
         if count_progress % 20000 == 0:
-            sys.stdout.write(str(total))
-            sys.stdout.write('\n')
+            sys.stderr.write(str(total))
+            sys.stderr.write('\n')
 
 def find_mac(input):
+    """The MAC address on the most of the capture's first frames: usually the capturing host's."""
+    try:
+        table = next(read_tables(input, 25000), None)
+    except ImportError:
+        # No NumPy: count the slow way, over fewer frames
+        table = None
+    if table is not None:
+        macs = table.macs()
+        return max(macs, key = macs.get)
     packets = islice(read_packets(input), 25000)
     buffer = []
     macs = Bucket()
@@ -251,46 +802,984 @@ def find_mac(input):
     
 MY_MAC = '\x00\x19\xb9\xbe\x1cM'
 
+def statement(query):
+    """The text a query is filed under. Preparing isn't running it, so prepares get their own."""
+    if query.command == 'COM_STMT_PREPARE':
+        return 'PREPARE ' + query.sql
+    return query.sql
+
+def query_fingerprint(sql):
+    """
+    fingerprint(sql), except that a query the lexer can't finish (say an
+    unterminated quote, which the server answers with a syntax error) is
+    filed under its raw text.
+    """
+    try:
+        return fingerprint(sql)
+    except (EOD, ValueError):
+        return fingerprint_id(sql), sql
+
+class QueryStats(object):
+    """
+    What analyze measures, per query fingerprint. Bucket keys are the 64-bit
+    fingerprint ids; fingerprints maps each id to (normalized text, the first
+    raw query seen with it). counters holds capture-wide counts (connections
+    and the like), which add up when QueryStats are merged.
+
+    Each of measures is a Bucket: timing is the time to the first row (or
+    the OK), think, metadata and transfer split that up the way MysqlQuery
+    does, rows and bytes are what came back.
+    """
+    measures = ('timing', 'think', 'metadata', 'transfer', 'rows', 'bytes')
+
+    def __init__(self, BucketFactory = SketchBucket, sql_cache = None):
+        for name in self.measures:
+            setattr(self, name, BucketFactory())
+        self.fingerprints = {}
+        self.sql_cache = sql_cache if sql_cache is not None else SqlCache(parse = query_fingerprint)
+        self.queries = 0
+        self.counters = {}
+
+    def count(self, counters):
+        for name, value in counters.iteritems():
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def add(self, query):
+        sql = statement(query)
+        key, text = self.sql_cache(sql)
+        if key not in self.fingerprints:
+            self.fingerprints[key] = (text, sql)
+        self.record(key, query.field_response - query.timestamp, query.first_result - query.field_response,
+                    query.last_result - query.first_result, query.result_size, query.result_bytes,
+                    query.midstream, query.error_code)
+
+    def record(self, key, think, metadata, transfer, rows, bytes, midstream = False, error_code = None):
+        """Adds one query's measures under fingerprint key (which must be in fingerprints)."""
+        self.timing.increment(key, think + metadata)
+        self.think.increment(key, think)
+        self.metadata.increment(key, metadata)
+        self.transfer.increment(key, transfer)
+        self.rows.increment(key, rows)
+        self.bytes.increment(key, bytes)
+        self.queries += 1
+        counters = self.counters
+        if midstream:
+            counters['midstream_queries'] = counters.get('midstream_queries', 0) + 1
+        if error_code is not None:
+            counters['query_errors'] = counters.get('query_errors', 0) + 1
+            name = 'mysql_error_%d' % error_code
+            counters[name] = counters.get(name, 0) + 1
+
+    def dump(self):
+        measures = dict((name, getattr(self, name).dump()) for name in self.measures)
+        return dumps((self.queries, self.counters, self.fingerprints, measures), 2)
+
+    def load(self, string):
+        queries, counters, fingerprints, measures = loads(string)
+        self.queries += queries
+        self.count(counters)
+        for key, value in fingerprints.iteritems():
+            self.fingerprints.setdefault(key, value)
+        for name, dump in measures.iteritems():
+            getattr(self, name).load(dump)
+
+    def merge(self, other):
+        """load(other.dump()), without the round trip."""
+        self.queries += other.queries
+        self.count(other.counters)
+        for key, value in other.fingerprints.iteritems():
+            self.fingerprints.setdefault(key, value)
+        for name in self.measures:
+            getattr(self, name).update(getattr(other, name))
+
+class RollingWindow(object):
+    """
+    QueryStats for the last `window` seconds of capture time, kept as one
+    slice per `interval` seconds; slices that fall out of the window are
+    dropped, so memory stays bounded however long the capture runs.
+    """
+    def __init__(self, interval = 10, window = 60, BucketFactory = SketchBucket):
+        self.interval = interval
+        self.window = window
+        self.BucketFactory = BucketFactory
+        self.sql_cache = SqlCache(parse = query_fingerprint)
+        self.slices = deque()
+
+    def slot(self, timestamp):
+        return int(timestamp // self.interval) * self.interval
+
+    def advance(self, timestamp):
+        """Starts a slice for timestamp's interval if it's past the latest one; returns its start if so."""
+        slot = self.slot(timestamp)
+        if self.slices and self.slices[-1][0] >= slot:
+            return None
+        self.slices.append((slot, QueryStats(self.BucketFactory, self.sql_cache)))
+        while self.slices[0][0] < slot - self.window:
+            self.slices.popleft()
+        return slot
+
+    def add(self, query):
+        """Adds a query; returns the start of its interval if it's the first query in it."""
+        started = self.advance(query.timestamp)
+        # Late queries (from connections whose responses straggle) count in the latest slice
+        self.slices[-1][1].add(query)
+        return started
+
+    def stats(self, end = None):
+        """The slices in the `window` seconds before end (default: the end of the latest slice), merged."""
+        merged = QueryStats(self.BucketFactory, self.sql_cache)
+        if end is None and self.slices:
+            end = self.slices[-1][0] + self.interval
+        for start, stats in self.slices:
+            if end - self.window <= start < end:
+                merged.merge(stats)
+        return merged
+
+def print_top(stats, n = 10, out = sys.stdout):
+    """The n fingerprints with the most total time, slowest first."""
+    keys = heapq.nlargest(n, stats.timing.data, key = stats.timing.total)
+    for key in keys:
+        time, avg_time, count, median_time = stats.timing.aggregate(key)
+        out.write('%10.3fs %8d %9.4fs %9.4fs  %s\n' % (time, count, median_time, stats.timing.quantile(key, 0.99), stats.fingerprints[key][0]))
+
+"""
+Query log format, for going back over a capture's queries without reading
+the capture again. All little-endian:
+
+    'MPKQ' | uint16 version | uint8 column count
+    columns: per column, uint8 name length | name | array typecode
+    blocks: uint32 rows | per column, rows values
+    text table: uint32 entries | per entry, int64 fingerprint id |
+        uint32 length | normalized text | uint32 length | example sql
+    uint64 offset of the text table | 'MPKQ'
+
+The text column indexes the text table. Queries go out a block at a time;
+the text table, which fills up as we go, comes last.
+"""
+
+LOG_MAGIC = 'MPKQ'
+LOG_VERSION = 1
+log_header_struct = struct.Struct('<4sHB')
+log_trailer_struct = struct.Struct('<Q4s')
+length_struct = struct.Struct('<B')
+
+log_columns = [
+    ('timestamp', 'd'),
+    ('connection', 'I'),
+    ('text', 'I'),
+    ('command', 'B'),
+    ('error_code', 'H'), # 0 for none
+    ('midstream', 'B'),
+    ('think', 'd'),
+    ('metadata', 'd'),
+    ('transfer', 'd'),
+    ('rows', 'I'),
+    ('bytes', 'd'),
+]
+
+command_codes = dict((name, code) for code, name in commands.items())
+
+class QueryLogWriter(object):
+    """Writes MysqlQuery objects to a query log; close() finishes the file."""
+    def __init__(self, fd, sql_cache = None, block_rows = 65536):
+        self.fd = fd
+        self.sql_cache = sql_cache if sql_cache is not None else SqlCache(parse = query_fingerprint)
+        self.block_rows = block_rows
+        self.indexes = {}
+        self.table = []
+        self.block = [array(typecode) for name, typecode in log_columns]
+        self.rows = 0
+        fd.write(log_header_struct.pack(LOG_MAGIC, LOG_VERSION, len(log_columns)))
+        for name, typecode in log_columns:
+            fd.write(length_struct.pack(len(name)) + name + typecode)
+
+    def add(self, query):
+        sql = statement(query)
+        key, text = self.sql_cache(sql)
+        index = self.indexes.get(key)
+        if index is None:
+            index = self.indexes[key] = len(self.table)
+            self.table.append((key, text, sql))
+        values = (query.timestamp, query.connection, index, command_codes[query.command], query.error_code or 0,
+                  query.midstream, query.field_response - query.timestamp, query.first_result - query.field_response,
+                  query.last_result - query.first_result, query.result_size, query.result_bytes)
+        for column, value in zip(self.block, values):
+            column.append(value)
+        self.rows += 1
+        if len(self.block[0]) >= self.block_rows:
+            self.flush()
+
+    def flush(self):
+        rows = len(self.block[0])
+        if not rows:
+            return
+        self.fd.write(count_struct.pack(rows))
+        for column in self.block:
+            if sys.byteorder == 'big':
+                column.byteswap()
+            self.fd.write(column.tostring())
+        self.block = [array(typecode) for name, typecode in log_columns]
+
+    def close(self):
+        self.flush()
+        fd = self.fd
+        offset = fd.tell()
+        fd.write(count_struct.pack(len(self.table)))
+        for key, text, sql in self.table:
+            fd.write(int64_struct.pack(key))
+            for string in (text, sql):
+                string = str(string)
+                fd.write(count_struct.pack(len(string)) + string)
+        fd.write(log_trailer_struct.pack(offset, LOG_MAGIC))
+        fd.flush()
+
+class QueryLog(object):
+    """
+    A query log, mmapped: column(name) is an array of one column for every
+    query, texts the (fingerprint id, text, example sql) table the text
+    column points into.
+    """
+    def __init__(self, filename):
+        fd = file(filename, 'rb')
+        try:
+            self.map = mmap.mmap(fd.fileno(), 0, access = mmap.ACCESS_READ)
+        finally:
+            fd.close()
+        data = self.map
+        if len(data) < log_header_struct.size + log_trailer_struct.size:
+            raise DumpFormatError("Query log is truncated")
+        magic, version, column_count = log_header_struct.unpack_from(data)
+        if magic != LOG_MAGIC:
+            raise DumpFormatError("Not a query log")
+        if version != LOG_VERSION:
+            raise DumpFormatError("Can't read query log version %d" % version)
+        table_offset, magic = log_trailer_struct.unpack_from(data, len(data) - log_trailer_struct.size)
+        if magic != LOG_MAGIC:
+            raise DumpFormatError("Query log is truncated")
+
+        offset = log_header_struct.size
+        self.columns = []
+        for n in xrange(column_count):
+            length, = length_struct.unpack_from(data, offset)
+            name, typecode = data[offset + 1:offset + 1 + length], data[offset + 1 + length]
+            self.columns.append((name, typecode))
+            offset += length + 2
+
+        # Blocks: (first value's offset, rows)
+        self.blocks = []
+        self.rows = 0
+        row_size = sum([array(typecode).itemsize for name, typecode in self.columns])
+        while offset < table_offset:
+            rows, = count_struct.unpack_from(data, offset)
+            self.blocks.append((offset + count_struct.size, rows))
+            self.rows += rows
+            offset += count_struct.size + rows * row_size
+
+        self.texts = []
+        entries, = count_struct.unpack_from(data, table_offset)
+        offset = table_offset + count_struct.size
+        for n in xrange(entries):
+            key, = int64_struct.unpack_from(data, offset)
+            offset += int64_struct.size
+            strings = []
+            for i in range(2):
+                length, = count_struct.unpack_from(data, offset)
+                strings.append(data[offset + count_struct.size:offset + count_struct.size + length])
+                offset += count_struct.size + length
+            self.texts.append((key, strings[0], strings[1]))
+
+    def __len__(self):
+        return self.rows
+
+    def close(self):
+        self.map.close()
+
+    def column(self, name):
+        values = None
+        skip = 0
+        for column, typecode in self.columns:
+            if column == name:
+                values = array(typecode)
+                break
+            skip += array(typecode).itemsize
+        if values is None:
+            raise KeyError(name)
+        for offset, rows in self.blocks:
+            start = offset + skip * rows
+            values.fromstring(self.map[start:start + values.itemsize * rows])
+        if sys.byteorder == 'big':
+            values.byteswap()
+        return values
+
+    def stats(self, where = None, BucketFactory = SketchBucket):
+        """
+        QueryStats for the logged queries, or for those where(columns, i)
+        is true of; columns maps each column's name to its array.
+        """
+        stats = QueryStats(BucketFactory)
+        columns = dict((name, self.column(name)) for name, typecode in self.columns)
+        texts, think, metadata, transfer = columns['text'], columns['think'], columns['metadata'], columns['transfer']
+        rows, bytes, midstream, error_code = columns['rows'], columns['bytes'], columns['midstream'], columns['error_code']
+        for i in xrange(self.rows):
+            if where is not None and not where(columns, i):
+                continue
+            key, text, sql = self.texts[texts[i]]
+            if key not in stats.fingerprints:
+                stats.fingerprints[key] = (text, sql)
+            stats.record(key, think[i], metadata[i], transfer[i], rows[i], bytes[i], midstream[i], error_code[i] or None)
+        return stats
+
+# What a report can be ordered by; each is cheap to get for every fingerprint
+sort_keys = {
+    'total': lambda stats, key: stats.timing.total(key),
+    'p99': lambda stats, key: stats.timing.quantile(key, 0.99),
+    'count': lambda stats, key: stats.timing.count(key),
+    'rows': lambda stats, key: stats.rows.total(key),
+    'bytes': lambda stats, key: stats.bytes.total(key),
+}
+
+report_columns = ('fingerprint', 'count', 'total', 'avg', 'p50', 'p99', 'think_p50', 'think_p99', 'metadata_p50',
+                  'metadata_p99', 'transfer_p50', 'transfer_p99', 'rows', 'avg_rows', 'bytes', 'avg_bytes', 'query')
+
+def report(stats, n = 10, sort = 'total'):
+    """
+    The top n fingerprints by one of sort_keys, as dicts of report_columns.
+    Picking them is one pass with a heap; only the n picked get aggregated.
+    """
+    by = sort_keys[sort]
+    keys = heapq.nlargest(n, stats.timing.data, key = lambda key: by(stats, key))
+    rows = []
+    for key in keys:
+        total, avg, count, p50 = stats.timing.aggregate(key)
+        row = {'fingerprint': key, 'count': count, 'total': total, 'avg': avg, 'p50': p50,
+               'p99': stats.timing.quantile(key, 0.99), 'query': stats.fingerprints[key][0]}
+        for name in ('think', 'metadata', 'transfer'):
+            bucket = getattr(stats, name)
+            row[name + '_p50'] = bucket.quantile(key, 0.5)
+            row[name + '_p99'] = bucket.quantile(key, 0.99)
+        for name in ('rows', 'bytes'):
+            row[name] = getattr(stats, name).total(key)
+            row['avg_' + name] = row[name] / float(count)
+        rows.append(row)
+    return rows
+
+def write_text(rows, out):
+    out.write('%11s %8s %10s %10s %21s %21s %21s %9s %10s  %s\n' % (
+        'total', 'count', 'p50', 'p99', 'think p50/p99', 'metadata p50/p99', 'transfer p50/p99', 'avg rows', 'avg bytes', 'query'))
+    for row in rows:
+        phases = ' '.join(['%9.4fs/%9.4fs' % (row[name + '_p50'], row[name + '_p99']) for name in ('think', 'metadata', 'transfer')])
+        out.write('%10.3fs %8d %9.4fs %9.4fs %s %9.1f %10.1f  %s\n' % (
+            row['total'], row['count'], row['p50'], row['p99'], phases, row['avg_rows'], row['avg_bytes'], row['query']))
+
+def format_fingerprint(key):
+    return '%016x' % (key & 0xFFFFFFFFFFFFFFFF)
+
+def write_csv(rows, out):
+    import csv
+    writer = csv.DictWriter(out, report_columns)
+    writer.writeheader()
+    writer.writerows([dict(row, fingerprint = format_fingerprint(row['fingerprint'])) for row in rows])
+
+def write_json(rows, out):
+    import json
+    json.dump([dict(row, fingerprint = format_fingerprint(row['fingerprint'])) for row in rows], out, indent = 1)
+    out.write('\n')
+
+report_formats = {'text': write_text, 'csv': write_csv, 'json': write_json}
+
+def print_report(stats, n = 10, sort = 'total', format = 'text', out = sys.stdout):
+    report_formats[format](report(stats, n, sort), out)
+
+def live(input = '-', interval = 10, window = 60, top = 10, out = sys.stdout,
+         idle_timeout = 600, max_connections = 65536, join_midstream = True):
+    """
+    Reads a capture as it's written (stdin, or a FIFO) and every `interval`
+    seconds of capture time prints the top slow fingerprints of the last
+    `window` seconds. Any packet moves the clock on, so intervals without
+    a finished query (say the server stalled) still get their report.
+    """
+    from time import strftime, localtime
+    rolling = RollingWindow(interval, window)
+
+    def report(end):
+        stats = rolling.stats(end)
+        out.write('== %s, last %ds: %d queries (%d mid-stream), %d connections (%d joined so far)\n' % (
+            strftime('%H:%M:%S', localtime(end)), window, stats.queries, stats.counters.get('midstream_queries', 0),
+            len(connections), connections.joined))
+        out.write('%11s %8s %10s %10s  %s\n' % ('total', 'count', 'p50', 'p99', 'query'))
+        print_top(stats, top, out)
+        out.flush()
+
+    def onQuery(query):
+        rolling.add(query)
+
+    def tick(packets):
+        for packet in packets:
+            slot = rolling.slot(packet.timestamp)
+            if rolling.slices and rolling.slices[-1][0] < slot:
+                # Every interval that ended, up to the point where the window holds only empty ones
+                ends = range(rolling.slices[-1][0] + interval, slot + interval, interval)
+                for end in ends[:window // interval + 1]:
+                    report(end)
+            rolling.advance(packet.timestamp)
+            yield packet
+
+    def ConnFactory():
+        return MysqlConnection(onQuery)
+
+    def JoinFactory(packet):
+        if starts_query(packet):
+            return MysqlConnection(onQuery, midstream = True)
+
+    connections = ConnectionTable(idle_timeout, max_connections)
+    collapse_tcp_streams(tick(read_packets(input, filter='tcp port 3306')), ConnFactory, connections = connections,
+                         JoinFactory = JoinFactory if join_midstream else None)
+    if rolling.slices:
+        report(rolling.slices[-1][0] + interval)
+
+def peak_rss():
+    """This process's peak resident set size in bytes, or None where that isn't known."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux counts kilobytes, OS X bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+class Instruments(object):
+    """
+    Where analyze's time goes, to tell which stage is the bottleneck on a
+    capture. seconds has the time spent in each of stages, not counting the
+    stages it calls into (demux calls read, which hands over to parse, and
+    mysql, whose queries go to fingerprint and on to aggregate); calls how
+    often each was entered. Every interval seconds, and once more at the
+    end, a JSON line with those, the throughput and peak RSS goes to out.
+
+    Timing costs a few microseconds a packet, so analyze only does it
+    when given Instruments (--stats).
+    """
+    stages = ('read', 'parse', 'demux', 'mysql', 'fingerprint', 'aggregate', 'query_log')
+
+    def __init__(self, out = sys.stderr, interval = 10, clock = None):
+        from time import time
+        self.out = out
+        self.interval = interval
+        self.clock = clock or time
+        self.seconds = dict.fromkeys(self.stages, 0.0)
+        self.calls = dict.fromkeys(self.stages, 0)
+        self.stack = []
+        self.mark = None
+        self.packets = self.bytes = 0
+        self.stats = self.connections = None
+        self.started = self.reported = self.clock()
+        self.last = (0, 0, 0)
+
+    def enter(self, stage):
+        now = self.clock()
+        if self.stack:
+            self.seconds[self.stack[-1]] += now - self.mark
+        self.stack.append(stage)
+        self.calls[stage] += 1
+        self.mark = now
+
+    def leave(self):
+        now = self.clock()
+        self.seconds[self.stack.pop()] += now - self.mark
+        self.mark = now
+
+    def timed(self, stage, fn):
+        """fn, counting its calls' time to stage."""
+        enter, leave = self.enter, self.leave
+        def timed(*args, **kw):
+            enter(stage)
+            try:
+                return fn(*args, **kw)
+            finally:
+                leave()
+        return timed
+
+    def read(self, packets):
+        """
+        The packets, timing reading and parsing them and counting them as
+        they go. They come out parsed, for collapse_tcp_streams(parsed = True).
+        """
+        enter, leave, clock = self.enter, self.leave, self.clock
+        packets = iter(packets)
+        while True:
+            enter('read')
+            try:
+                packet = packets.next()
+            except StopIteration:
+                return
+            finally:
+                leave()
+            enter('parse')
+            packet.parse()
+            leave()
+            self.packets += 1
+            self.bytes += len(packet.raw_data)
+            if not self.packets % 1024 and clock() - self.reported >= self.interval:
+                self.report()
+            yield packet
+
+    def snapshot(self, final = False):
+        """The numbers so far, as a dict; rates are over the time since the last report (or all of it, when final)."""
+        now = self.clock()
+        if self.stack:
+            self.seconds[self.stack[-1]] += now - self.mark
+            self.mark = now
+        queries = self.stats.queries if self.stats is not None else 0
+        counts = (self.packets, self.bytes, queries)
+        since, last = (self.started, (0, 0, 0)) if final else (self.reported, self.last)
+        elapsed = max(now - since, 1e-9)
+        rates = [(count - before) / elapsed for count, before in zip(counts, last)]
+        self.reported, self.last = now, counts
+        return OrderedDict([
+            ('elapsed', now - self.started),
+            ('final', final),
+            ('packets', self.packets),
+            ('bytes', self.bytes),
+            ('queries', queries),
+            ('packets_per_second', rates[0]),
+            ('bytes_per_second', rates[1]),
+            ('queries_per_second', rates[2]),
+            ('active_connections', len(self.connections) if self.connections is not None else 0),
+            ('peak_rss', peak_rss()),
+            ('stages', OrderedDict((stage, OrderedDict([('seconds', self.seconds[stage]), ('calls', self.calls[stage])]))
+                                   for stage in self.stages)),
+        ])
+
+    def report(self, final = False):
+        import json
+        print >>self.out, json.dumps(self.snapshot(final))
+        self.out.flush()
+
 total = 0
-def main():   
-    input = 'really-big-dump.bin'
-    
-    timing_bucket = Bucket()
-    result_bucket = Bucket()
-    
+def analyze(input, modulo = None, progress = lambda: None, BucketFactory = SketchBucket,
+            sql_cache_size = 10000, idle_timeout = 600, max_connections = 65536, join_midstream = True,
+            query_log = None, start = None, end = None, span = None, instruments = None):
+    """
+    Runs a capture through the MySQL state machine, returning its QueryStats.
+    query_log, a file name, also gets every query written to it (see QueryLog).
+    start, end and span pick out part of the capture, as for read_packets.
+    instruments (see Instruments) times each stage, reporting as it goes.
+    """
+    stats = QueryStats(BucketFactory, SqlCache(sql_cache_size, parse = query_fingerprint))
+    log = None
+    if query_log is not None:
+        log = QueryLogWriter(file(query_log, 'wb'), stats.sql_cache)
     
     def onQuery(query):
         global total
-        time = query.first_result - query.timestamp
-        sql = Sql(query.sql)
-        timing_bucket.increment(sql, time)
-        result_bucket.increment(sql, query.result_size)
+        stats.add(query)
+        if log is not None:
+            log.add(query)
         total += 1
     
+    tcp_counters = {}
+
     def ConnFactory():
-        return MysqlConnection(onQuery)
+        return MysqlConnection(onQuery, counters = tcp_counters)
+
+    def JoinFactory(packet):
+        if starts_query(packet):
+            return MysqlConnection(onQuery, midstream = True, counters = tcp_counters)
     
-    collapse_tcp_streams(read_packets(input), ConnFactory, progress)
+    connections = ConnectionTable(idle_timeout, max_connections)
+    packets = read_packets(input, filter='tcp port 3306', modulo=modulo, start=start, end=end, span=span)
+    if instruments is None:
+        collapse_tcp_streams(packets, ConnFactory, progress, connections, JoinFactory if join_midstream else None)
+    else:
+        instruments.stats, instruments.connections = stats, connections
+        onQuery = instruments.timed('fingerprint', onQuery)
+        stats.record = instruments.timed('aggregate', stats.record)
+        if log is not None:
+            log.add = instruments.timed('query_log', log.add)
+        def timed_connection(conn):
+            if conn is not None:
+                conn.saw_packet = instruments.timed('mysql', conn.saw_packet)
+            return conn
+        instruments.timed('demux', collapse_tcp_streams)(
+            instruments.read(packets), lambda: timed_connection(ConnFactory()), progress, connections,
+            (lambda packet: timed_connection(JoinFactory(packet))) if join_midstream else None, parsed = True)
+        del stats.record
+        instruments.report(final = True)
+    stats.count(connections.counters())
+    stats.count(tcp_counters)
+    if log is not None:
+        log.close()
+        log.fd.close()
+    return stats
+
+def analyze_shard((input, modulo, span, options)):
+    return analyze(input, modulo, span = span, **options).dump()
+
+def analyze_parallel(input, processes = None, split = 'connection', **options):
+    """
+    Splits the capture across a process pool, by TCP connection, or with
+    split 'range' into a stretch of the file for each process (see
+    PcapIndex.ranges). Split by connection, every worker maps the whole file
+    but only builds packets for its own connections. Split by range, each
+    only reads its part, joining connections midstream; queries in flight
+    where two parts meet are lost. The workers' QueryStats come back through
+    dump() and get merged with load().
+    """
+    from multiprocessing import Pool, cpu_count
+    processes = processes or cpu_count()
+    start, end = options.get('start'), options.get('end')
+    if split == 'range' or start is not None or end is not None:
+        # Once here, rather than in every worker
+        index = capture_index(input)
+    if split == 'range':
+        shards = [(input, None, span, options) for span in index.ranges(processes, start, end)]
+    else:
+        shards = [(input, (shard, processes), None, options) for shard in range(processes)]
+    pool = Pool(processes)
+    stats = QueryStats(options.get('BucketFactory', SketchBucket))
+    try:
+        for dump in pool.imap_unordered(analyze_shard, shards):
+            stats.load(dump)
+    finally:
+        pool.close()
+        pool.join()
+    return stats
+
+def main(input = 'really-big-dump.bin', processes = 1, top = 10, sort = 'total', format = 'text', read_log = False,
+         split = 'connection', **options):
+    if read_log:
+        start, end = options.get('start'), options.get('end')
+        where = None
+        if start is not None or end is not None:
+            where = lambda columns, i: ((start is None or columns['timestamp'][i] >= start) and
+                                        (end is None or columns['timestamp'][i] < end))
+        stats = QueryLog(input).stats(where)
+    elif processes == 1:
+        # The dots would get in the way of the instruments' lines
+        stats = analyze(input, progress=progress if options.get('instruments') is None else lambda: None, **options)
+    else:
+        stats = analyze_parallel(input, processes, split, **options)
     
-    print total
+    # Keep stdout for the report itself when it's meant for another program
+    summary = sys.stdout if format == 'text' else sys.stderr
+    if processes == 1 and not read_log:
+        print >>summary, stats.sql_cache
+    print >>summary, stats.queries
+    for name, value in sorted(stats.counters.items()):
+        print >>summary, '%s: %d' % (name, value)
     
-    for sql, time, avg_time, count, median_time in timing_bucket.counts():
-        total_rows, avg_rows, count_rows, median_rows = result_bucket.aggregate(sql)
-        """
-        print 'time:', time, 'avg:', avg_time, 'median:', median_time, 'count:', count, 
-        print 'total rows:', total_rows, 'avg rows:', avg_rows,
-        print 'sql:', sql.fuzzy()
-        print sql.sql
-        """
+    print_report(stats, top, sort, format)
         
+def parse_time(value):
+    """Seconds since the epoch, or a local 'YYYY-MM-DD HH:MM[:SS]'."""
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    from time import strptime, mktime
+    for format in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M'):
+        try:
+            return mktime(strptime(value, format))
+        except ValueError:
+            pass
+    raise ValueError("Can't read %r as a time" % value)
+
 def timed(fn):
     from time import time
     before = time()
     fn()
     after = time()
-    print 'Total time:', after - before
+    print >>sys.stderr, 'Total time:', after - before
+
+def profiled(fn, filename):
+    """Runs fn under cProfile, saving the stats to filename (python -m pstats filename to read them)."""
+    import cProfile
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(fn)
+    finally:
+        profile.dump_stats(filename)
         
 import unittest
+from tcpip import make_packet, write_pcap, parse_ip_string, Packet, pcap_packet_layout
+
+def mysql_frame(pn, payload):
+    return struct.pack('<I', len(payload) | ((pn % 0x100) << 24)) + payload
+
+def mysql_session(client, server, queries, ts = 0, step = 0.001, mss = None):
+    """
+    Synthetic capture of one MySQL connection: handshake, then each
+    (sql, rows) in queries as a COM_QUERY with a one-column result set,
+    then FIN. Writes are cut into segments of at most mss bytes.
+    Returns [(timestamp, raw frame)], ready for write_pcap.
+    """
+    packets = []
+    seq = {client: 1000, server: 5000}
+    def segment(source, destination, data = '', control = ('ACK', 'PSH')):
+        size = mss or len(data) or 1
+        for start in range(0, len(data), size) or [0]:
+            piece = data[start:start + size]
+            packets.append((ts + len(packets) * step, make_packet(source, destination, piece, control, seq[source])))
+            seq[source] += len(piece) + ('SYN' in control)
+    eof = '\xfe\x00\x00\x02\x00'
+
+    segment(client, server, control = ('SYN',))
+    segment(server, client, mysql_frame(0, '\x0a5.0.77\x00' + 'h' * 40))
+    segment(client, server, mysql_frame(1, 'a' * 40))
+    segment(server, client, mysql_frame(2, '\x00\x00\x00\x02\x00\x00\x00'))
+    for sql, rows in queries:
+        segment(client, server, mysql_frame(0, '\x03' + sql))
+        response = [mysql_frame(1, '\x01'), mysql_frame(2, '\x03def' + 'f' * 20), mysql_frame(3, eof)]
+        segment(server, client, ''.join(response))
+        rows = [mysql_frame(4 + n, '\x03row') for n in range(rows)]
+        segment(server, client, ''.join(rows + [mysql_frame(4 + len(rows), eof)]))
+    segment(client, server, control = ('FIN', 'ACK'))
+    return packets
+
+def mysql_capture(sessions):
+    """Interleaves several mysql_session()s into one temporary pcap file."""
+    import tempfile
+    packets = sorted([packet for session in sessions for packet in session])
+    fd = tempfile.NamedTemporaryFile(suffix = '.pcap')
+    write_pcap(fd, packets)
+    fd.flush()
+    return fd
+
+class TestMysqlPacketizer(unittest.TestCase):
+
+    def frame(self, pn, payload):
+        return struct.pack('<I', len(payload) | (pn << 24)) + payload
+
+    def test_whole_packets(self):
+        packetizer = MysqlPacketizer()
+        stream = self.frame(0, '\x03select 1') + self.frame(1, '')
+        self.assertEqual([(0, '\x03select 1'), (1, '')], packetizer.feed(stream))
+        self.assertEqual(0, len(packetizer.buffer))
+
+    def test_split_across_segments(self):
+        stream = self.frame(0, 'a' * 70000) + self.frame(1, 'row') + self.frame(2, '\xfe\x00\x00')
+        for size in (1, 3, 4, 5, 1000, 69999):
+            packetizer = MysqlPacketizer()
+            packets = []
+            for n in range(0, len(stream), size):
+                packets.extend(packetizer.feed(buffer(stream, n, size)))
+            self.assertEqual([(0, 'a' * 70000), (1, 'row'), (2, '\xfe\x00\x00')], packets)
+            self.assertEqual(0, len(packetizer.buffer))
+
+    def test_partial_header(self):
+        packetizer = MysqlPacketizer()
+        self.assertEqual([], packetizer.feed('\x05\x00'))
+        self.assertEqual([], packetizer.feed('\x00\x07ab'))
+        self.assertEqual([(7, 'abcde')], packetizer.feed('cde\x01'))
+        self.assertEqual('\x01', str(packetizer.buffer))
+
+class TestMysqlConnection(unittest.TestCase):
+
+    client = (parse_ip_string('10.5.6.56'), 40000)
+    server = (parse_ip_string('10.7.5.15'), 3306)
+    eof = '\xfe\x00\x00\x02\x00'
+
+    def exchange(self, sql, rows = 1):
+        return [(self.client, mysql_frame(0, '\x03' + sql)),
+                (self.server, mysql_frame(1, '\x01') + mysql_frame(2, '\x03def') + mysql_frame(3, self.eof)),
+                (self.server, ''.join([mysql_frame(4 + n, '\x03row') for n in range(rows)] + [mysql_frame(4 + rows, self.eof)]))]
+
+    def run_writes(self, writes, conn = None):
+        # writes: (source, data); data None leaves a hole in source's sequence space
+        queries = []
+        if conn is None:
+            conn = MysqlConnection(queries.append, midstream = True)
+        else:
+            conn.onQuery = queries.append
+        seq = {self.client: 1000, self.server: 5000}
+        for n, (source, data) in enumerate(writes):
+            destination = self.server if source == self.client else self.client
+            if data is None:
+                seq[source] += 10
+                continue
+            packet = Packet(make_packet(source, destination, data, ('ACK', 'PSH'), seq[source]))
+            packet.pcap = pcap_packet_layout.record(n, 0, 0, 0)
+            packet.parse()
+            conn.saw_packet(packet)
+            seq[source] += len(data)
+        self.records = queries
+        return conn, [str(query.sql) for query in queries]
+
+    def test_clean(self):
+        conn, queries = self.run_writes(self.exchange('SELECT 1') + self.exchange('SELECT 2'))
+        self.assertEqual(['SELECT 1', 'SELECT 2'], queries)
+        self.assertEqual({}, conn.failures)
+
+    def test_sequence_mismatch(self):
+        bad = self.exchange('SELECT 2')
+        bad[2] = (self.server, mysql_frame(9, '\x03row') + mysql_frame(10, self.eof))
+        conn, queries = self.run_writes(self.exchange('SELECT 1') + bad + self.exchange('SELECT 3'))
+        self.assertEqual(['SELECT 1', 'SELECT 3'], queries)
+        self.assertEqual({'sequence_mismatch': 1}, conn.failures)
+        self.assertEqual(1, conn.counters['protocol_resyncs'])
+
+    def test_unexpected_direction(self):
+        conn, queries = self.run_writes(self.exchange('SELECT 1') + [(self.server, mysql_frame(0, '\x00\x00\x00'))] +
+                                        self.exchange('SELECT 2'))
+        self.assertEqual(['SELECT 1', 'SELECT 2'], queries)
+        self.assertEqual({'unexpected_direction': 1}, conn.failures)
+
+    def test_unknown_command(self):
+        conn, queries = self.run_writes([(self.client, mysql_frame(0, '\x99junk'))] + self.exchange('SELECT 1'))
+        self.assertEqual(['SELECT 1'], queries)
+        self.assertEqual({'unknown_command': 1}, conn.failures)
+
+    def test_eof_missing(self):
+        bad = self.exchange('SELECT 1')
+        bad[1] = (self.server, mysql_frame(1, '\x01') + mysql_frame(2, '\x03def') + mysql_frame(3, '\x03row'))
+        conn, queries = self.run_writes(bad + self.exchange('SELECT 2'))
+        self.assertEqual(['SELECT 2'], queries)
+        self.assertEqual({'eof_missing': 1}, conn.failures)
+        self.assertEqual(1, conn.counters['protocol_eof_missing'])
+
+    def test_stream_gap(self):
+        conn = MysqlConnection(midstream = True)
+        conn.streams['from_server'].max_pending = 40
+        lost = self.exchange('SELECT 2', rows = 5)
+        lost[1] = (self.server, None)
+        conn, queries = self.run_writes(self.exchange('SELECT 1') + lost + self.exchange('SELECT 3', rows = 5), conn)
+        self.assertEqual(['SELECT 1', 'SELECT 3'], queries)
+        self.assertEqual({'stream_gap': 1}, conn.failures)
+        self.assertEqual(1, conn.counters['tcp_gaps'])
+
+    def test_empty_frame(self):
+        conn, queries = self.run_writes(self.exchange('SELECT 1') + [(self.client, mysql_frame(0, ''))] +
+                                        self.exchange('SELECT 2'))
+        self.assertEqual(['SELECT 1', 'SELECT 2'], queries)
+        self.assertEqual({'malformed': 1}, conn.failures)
+
+        # Row data read as headers after losing track
+        conn, queries = self.run_writes([(self.client, mysql_frame(0, '\x99junk')),
+                                         (self.server, mysql_frame(5, '') + mysql_frame(0, ''))] + self.exchange('SELECT 1'))
+        self.assertEqual(['SELECT 1'], queries)
+        self.assertEqual({'unknown_command': 1}, conn.failures)
+
+    def test_ok_and_error(self):
+        conn, queries = self.run_writes([
+            (self.client, mysql_frame(0, '\x03INSERT INTO t VALUES (1)')),
+            (self.server, mysql_frame(1, '\x00\x01\x00\x02\x00\x00\x00')),
+            (self.client, mysql_frame(0, '\x03SELEC 1')),
+            (self.server, mysql_frame(1, '\xff\x28\x04#42000You have an error')),
+        ] + self.exchange('SELECT 1'))
+        self.assertEqual(['INSERT INTO t VALUES (1)', 'SELEC 1', 'SELECT 1'], queries)
+        self.assertEqual([None, 1064, None], [query.error_code for query in self.records])
+        self.assertEqual([1, 3], [self.records[0].first_result, self.records[1].first_result])
+        self.assertEqual({}, conn.failures)
+
+    def test_unterminated_error(self):
+        conn, queries = self.run_writes([
+            (self.client, mysql_frame(0, "\x03SELECT 'abc")),
+            (self.server, mysql_frame(1, '\xff\x28\x04#42000You have an error')),
+        ] + self.exchange("SELECT 'abc'"))
+        self.assertEqual(["SELECT 'abc", "SELECT 'abc'"], queries)
+        stats = QueryStats()
+        for query in self.records:
+            stats.add(query)
+        self.assertEqual(["SELECT 'abc", 'SELECT ?'], sorted(text for text, sql in stats.fingerprints.values()))
+        self.assertEqual(1, stats.counters['mysql_error_1064'])
+
+    def test_field_list_error(self):
+        conn, queries = self.run_writes([
+            (self.client, mysql_frame(0, '\x04nosuchtable\x00')),
+            (self.server, mysql_frame(1, "\xff\x7a\x04#42S02Table 'shop.nosuchtable' doesn't exist")),
+        ] + self.exchange('SELECT 1'))
+        self.assertEqual(['SELECT 1'], queries)
+        self.assertEqual({}, conn.failures)
+
+    def test_multiple_resultsets(self):
+        more = '\xfe\x00\x00\x0a\x00'
+        conn, queries = self.run_writes([
+            (self.client, mysql_frame(0, '\x03CALL two_results()')),
+            (self.server, mysql_frame(1, '\x01') + mysql_frame(2, '\x03def') + mysql_frame(3, self.eof)),
+            (self.server, mysql_frame(4, '\x03row') + mysql_frame(5, more)),
+            (self.server, mysql_frame(6, '\x01') + mysql_frame(7, '\x03def') + mysql_frame(8, self.eof) +
+                          mysql_frame(9, '\x03row') + mysql_frame(10, '\x03row') + mysql_frame(11, more)),
+            (self.server, mysql_frame(12, '\x00\x00\x00\x02\x00\x00\x00')),
+        ] + self.exchange('SELECT 1'))
+        self.assertEqual(['CALL two_results()', 'SELECT 1'], queries)
+        call = self.records[0]
+        self.assertEqual((3, 2, 4, 3), (call.result_size, call.first_result, call.last_result, call.resultsets))
+        self.assertEqual({}, conn.failures)
+
+    def test_prepared_statements(self):
+        statement = '\x07\x00\x00\x00'
+        conn, queries = self.run_writes([
+            (self.client, mysql_frame(0, '\x16SELECT name FROM products WHERE sku = ?')),
+            (self.server, mysql_frame(1, '\x00' + statement + '\x01\x00\x01\x00\x00\x00\x00') +
+                          mysql_frame(2, '\x03def') + mysql_frame(3, self.eof) +
+                          mysql_frame(4, '\x03def') + mysql_frame(5, self.eof)),
+            (self.client, mysql_frame(0, '\x17' + statement + '\x00\x01\x00\x00\x00\x01\xfe\x00\x02x1')),
+            (self.server, mysql_frame(1, '\x01') + mysql_frame(2, '\x03def') + mysql_frame(3, self.eof)),
+            (self.server, mysql_frame(4, '\x00\x00\x03abc') + mysql_frame(5, '\x00\x00\x03def') + mysql_frame(6, self.eof)),
+            (self.client, mysql_frame(0, '\x19' + statement)),
+            (self.client, mysql_frame(0, '\x17\x08\x00\x00\x00\x00\x01\x00\x00\x00')),
+            (self.server, mysql_frame(1, '\xff\x13\x05#HY000Unknown prepared statement handler')),
+        ] + self.exchange('SELECT 1'))
+        self.assertEqual(['SELECT name FROM products WHERE sku = ?'] * 2 + ['EXECUTE ?', 'SELECT 1'], queries)
+        self.assertEqual(['COM_STMT_PREPARE', 'COM_STMT_EXECUTE', 'COM_STMT_EXECUTE', 'COM_QUERY'],
+                         [query.command for query in self.records])
+        self.assertEqual([0, 2, 0, 1], [query.result_size for query in self.records])
+        self.assertEqual(1299, self.records[2].error_code)
+        self.assertEqual({}, conn.statements)
+        self.assertEqual({}, conn.failures)
+
+        stats = QueryStats()
+        for query in self.records:
+            stats.add(query)
+        self.assertEqual(['PREPARE SELECT name FROM products WHERE sku = ?', 'SELECT name FROM products WHERE sku = ?'],
+                         sorted(text for text, sql in stats.fingerprints.values() if 'products' in text))
+        self.assertEqual((1, 1), (stats.counters['query_errors'], stats.counters['mysql_error_1299']))
+
+    def test_other_commands(self):
+        conn, queries = self.run_writes([
+            (self.client, mysql_frame(0, '\x0e')),
+            (self.server, mysql_frame(1, '\x00\x00\x00\x02\x00\x00\x00')),
+            (self.client, mysql_frame(0, '\x02shop')),
+            (self.server, mysql_frame(1, '\x00\x00\x00\x02\x00\x00\x00')),
+            (self.client, mysql_frame(0, '\x04products\x00')),
+            (self.server, mysql_frame(1, '\x03def') + mysql_frame(2, '\x03def') + mysql_frame(3, self.eof)),
+            (self.client, mysql_frame(0, '\x09')),
+            (self.server, mysql_frame(1, 'Uptime: 5  Threads: 1')),
+        ] + self.exchange('SELECT 1'))
+        self.assertEqual(['SELECT 1'], queries)
+        self.assertEqual({}, conn.failures)
+
+    def test_phases(self):
+        writes = self.exchange('SELECT 1', rows = 2)
+        rows = writes.pop()[1]
+        writes += [(self.server, rows[:8]), (self.server, rows[8:])]
+        conn, queries = self.run_writes(writes * 2)
+        query = self.records[0]
+        self.assertEqual((0, 1, 2, 3), (query.timestamp, query.field_response, query.first_result, query.last_result))
+        self.assertEqual((2, 22 + 2 * 8 + 9), (query.result_size, query.result_bytes))
+
+        stats = QueryStats()
+        for query in self.records:
+            stats.add(query)
+        key, = stats.timing.data
+        self.assertEqual([(1, 2), (1, 2), (1, 2), (2, 4), (47, 94)],
+                         [(round(getattr(stats, name).quantile(key, 0.5), 6), round(getattr(stats, name).aggregate(key)[0], 6))
+                          for name in ('think', 'metadata', 'transfer', 'rows', 'bytes')])
+        out = StringIO()
+        print_report(stats, out = out)
+        header, line = out.getvalue().splitlines()
+        self.assertTrue(header.split()[:2] == ['total', 'count'] and header.endswith('query'))
+        self.assertTrue(line.endswith('  SELECT ?'))
+
+    def test_lcb(self):
+        self.assertEqual((250, 1), read_lcb('\xfa'))
+        self.assertEqual((None, 1), read_lcb('\xfb'))
+        self.assertEqual((0x1234, 4), read_lcb('x\xfc\x34\x12', 1))
+        self.assertEqual((0x123456, 4), read_lcb('\xfd\x56\x34\x12'))
+        self.assertEqual((2 ** 40, 9), read_lcb('\xfe\x00\x00\x00\x00\x00\x01\x00\x00'))
+        self.assertEqual(0x123456, lcb('\xfd\x56\x34\x12'))
+        self.assertRaises(BadDataException, read_lcb, '\xfd\x56')
+        self.assertRaises(BadDataException, read_lcb, '\xff')
 
 class TestBucket(unittest.TestCase):
     
@@ -307,17 +1796,594 @@ class TestBucket(unittest.TestCase):
         c.load(b.dump())
         
         self.assertEqual([('foo', 15, 5, 3,5)], c.counts())
+
+    def test_update(self):
+        for Factory in (Bucket, SketchBucket):
+            a, b = Factory(), Factory()
+            a.increment('foo', 1)
+            b.increment('foo', 2)
+            b.increment('bar', 3)
+            a.update(b)
+            a.update(b)
+            a.increment('bar', 4)
+            self.assertEqual([(5, 3), (10, 3)], [(a.total(key), a.count(key)) for key in ('foo', 'bar')])
+            self.assertEqual([(2, 1), (3, 1)], [(b.total(key), b.count(key)) for key in ('foo', 'bar')])
+        self.assertRaises(AssertionError, Bucket().update, SketchBucket())
+
+    def test_percentiles(self):
+        a = Bucket()
+        for n in range(1, 101):
+            a.increment('foo', n)
+        self.assertEqual((51, 91, 100, 100), a.percentiles('foo'))
+
+    def test_dump_format(self):
+        a = Bucket()
+        a.increment('foo', 2)
+        a.increment(Sql('SELECT 1 FROM foo WHERE id = 5'), 0.25)
+        a.increment(17, -1)
+        a.increment(('tuple', 'key'), 3)
+        dump = a.dump()
+        self.assertTrue(dump.startswith(DUMP_MAGIC))
+
+        b = Bucket()
+        b.load(dump)
+        b.load(dump)
+        self.assertEqual([2, 2], b.data['foo'])
+        self.assertEqual([0.25, 0.25], b.data[Sql('SELECT 1 FROM foo WHERE id = 7')])
+        self.assertEqual([-1, -1], b.data[17])
+        self.assertEqual([3, 3], b.data[('tuple', 'key')])
+
+    def test_pickle_dumps_still_load(self):
+        a = Bucket()
+        a.load(dumps({'foo': [1, 2]}))
+        a.load(dumps({'foo': [3]}))
+        self.assertEqual([('foo', 6, 2, 3, 2)], a.counts())
+
+    def test_bad_dumps(self):
+        a = Bucket()
+        a.increment('foo')
+        self.assertRaises(DumpFormatError, SketchBucket().load, a.dump())
+        self.assertRaises(DumpFormatError, a.load, DUMP_MAGIC + '\x09\x00\x00\x00\x00\x00\x00')
+        from tcpip import EOD
+        self.assertRaises(EOD, a.load, a.dump()[:-3])
+
+    def test_merge_files(self):
+        import tempfile
+        files = []
+        for n in range(3):
+            a = Bucket()
+            a.increment('foo', n)
+            a.increment('bar%d' % n, n)
+            files.append(tempfile.TemporaryFile())
+            a.dump_file(files[-1])
+            files[-1].seek(0)
+        merged = merge_dump_files(files)
+        self.assertEqual([0, 1, 2], sorted(merged.data['foo']))
+        self.assertEqual(['bar0', 'bar1', 'bar2', 'foo'], sorted(merged.data.keys()))
+
+class TestSketchBucket(unittest.TestCase):
+
+    def test_merge(self):
+        a = SketchBucket()
+        b = SketchBucket()
+        
+        a.increment('foo', 2)
+        a.increment('foo', 5)
+        b.increment('foo', 8)
+        
+        c = SketchBucket()
+        c.load(a.dump())
+        c.load(b.dump())
+        
+        [(key, total, average, count, median)] = c.counts()
+        self.assertEqual(('foo', 15, 5, 3), (key, total, average, count))
+        self.assertAlmostEqual(5, median, delta = 5 * 0.01)
+        self.assertEqual(8, c.quantile('foo', 1.0))
+
+    def test_accuracy(self):
+        import random
+        rng = random.Random(42)
+        exact = Bucket()
+        sketch = SketchBucket(alpha = 0.01)
+        shards = [SketchBucket(alpha = 0.01) for n in range(4)]
+        for n in range(20000):
+            value = rng.lognormvariate(-5, 2) if n % 50 else 0
+            exact.increment('q', value)
+            sketch.increment('q', value)
+            shards[n % 4].increment('q', value)
+        merged = SketchBucket(alpha = 0.01)
+        for shard in shards:
+            merged.load(shard.dump())
+
+        for bucket in (sketch, merged):
+            for q in (0, 0.01, 0.1, 0.5, 0.9, 0.99, 0.999, 1.0):
+                expected = exact.quantile('q', q)
+                self.assertTrue(abs(bucket.quantile('q', q) - expected) <= expected * 0.01, (q, expected, bucket.quantile('q', q)))
+            self.assertEqual(exact.aggregate('q')[2], bucket.aggregate('q')[2])
+            self.assertAlmostEqual(exact.aggregate('q')[0], bucket.aggregate('q')[0])
+        self.assertTrue(len(sketch.data['q'].bins) < 2048)
+
+    def test_dump_large_counts(self):
+        a = SketchBucket()
+        a.data['foo'] = LogHistogram()
+        a.data['foo'].add(3, 2**33)
+        a.data['foo'].add(-1)
+        b = SketchBucket()
+        b.load(a.dump())
+        self.assertEqual({55: 2**33}, b.data['foo'].bins)
+        self.assertEqual(2**33 + 1, b.data['foo'].count)
+        self.assertAlmostEqual(3, b.quantile('foo', 0.5), delta = 0.03)
+
+    def test_bounded(self):
+        sketch = LogHistogram(alpha = 0.01, max_bins = 100)
+        for n in range(1, 100000, 7):
+            sketch.add(n)
+        self.assertEqual(100, len(sketch.bins))
+        self.assertAlmostEqual(99995, sketch.quantile(0.99), delta = 99995 * 0.02)
+        self.assertEqual(99996, sketch.quantile(1.0))
+
+    def test_negative(self):
+        sketch = LogHistogram()
+        for value in (-3, -1, 0, 2, 4):
+            sketch.add(value)
+        self.assertAlmostEqual(-3, sketch.quantile(0), delta = 0.03)
+        self.assertAlmostEqual(-1, sketch.quantile(0.2), delta = 0.01)
+        self.assertEqual(0, sketch.quantile(0.4))
+        self.assertAlmostEqual(2, sketch.quantile(0.6), delta = 0.02)
         
 
+class TestAnalyze(unittest.TestCase):
+
+    def setUp(self):
+        server = (parse_ip_string('10.7.5.15'), 3306)
+        sessions = []
+        for n in range(12):
+            client = (parse_ip_string('10.5.6.%d' % (n + 1)), 40000 + n)
+            queries = [('SELECT * FROM customers WHERE customers_id = %d' % n, n % 3),
+                       ("SELECT name FROM products WHERE sku = 'x%d'" % n, 2)]
+            sessions.append(mysql_session(client, server, queries * (n % 4 + 1), ts = n * 0.0005))
+        self.capture = mysql_capture(sessions)
+
+    def summary(self, stats):
+        return sorted([(stats.fingerprints[key][0], count, round(time, 6), stats.rows.aggregate(key)[0])
+                       for (key, time, avg_time, count, median_time) in stats.timing.counts()])
+
+    def test_serial(self):
+        self.assertEqual([
+            ("SELECT * FROM customers WHERE customers_id = ?", 30, 0.06, 30),
+            ("SELECT name FROM products WHERE sku = ?", 30, 0.06, 60),
+        ], self.summary(analyze(self.capture.name)))
+
+    def test_fingerprint_keys(self):
+        stats = analyze(self.capture.name)
+        self.assertEqual(60, stats.queries)
+        for key, (text, sql) in stats.fingerprints.items():
+            self.assertEqual(fingerprint(sql), (key, text))
+        self.assertEqual(sorted(stats.fingerprints), sorted(stats.timing.data))
+
+    def test_reordered_segments(self):
+        import random
+        server = (parse_ip_string('10.7.5.15'), 3306)
+        rng = random.Random(15)
+        sessions = []
+        for n in range(6):
+            client = (parse_ip_string('10.5.6.%d' % (n + 1)), 40000 + n)
+            session = mysql_session(client, server, [('SELECT * FROM customers WHERE customers_id = %d' % n, 20)] * 3,
+                                    ts = n * 0.0005, mss = 16)
+            times = [ts for ts, raw in session]
+            frames = [raw for ts, raw in session]
+            i = 3
+            while i < len(frames) - 2:
+                roll = rng.random()
+                if roll < 0.2 and frames[i][26:30] == frames[i + 1][26:30]:
+                    # only within one direction: the other side can't answer what it hasn't seen
+                    frames[i], frames[i + 1] = frames[i + 1], frames[i]
+                elif roll < 0.3:
+                    frames.insert(i, frames[i - 2])
+                    times.append(times[-1] + 0.001)
+                i += 1
+            sessions.append(zip(times, frames))
+        capture = mysql_capture(sessions)
+        stats = analyze(capture.name)
+        self.assertEqual(18, stats.queries)
+        self.assertEqual([(18, 360)], [(count, stats.rows.aggregate(key)[0])
+                                       for (key, time, avg_time, count, median_time) in stats.timing.counts()])
+        self.assertTrue(stats.counters['tcp_out_of_order'] > 0)
+        self.assertTrue(stats.counters['tcp_retransmits'] > 0)
+        self.assertEqual(0, stats.counters.get('tcp_gaps', 0))
+
+    def test_midstream(self):
+        server = (parse_ip_string('10.7.5.15'), 3306)
+        sessions = []
+        for n in range(4):
+            client = (parse_ip_string('10.5.6.%d' % (n + 1)), 50000 + n)
+            session = mysql_session(client, server, [('SELECT %d FROM t' % n, 1)] * 5, ts = n)
+            # Drop the SYN and handshake, and the first query's request
+            sessions.append(session[5:])
+        capture = mysql_capture(sessions)
+
+        stats = analyze(capture.name)
+        self.assertEqual(16, stats.queries)
+        self.assertEqual(16, stats.counters['midstream_queries'])
+        self.assertEqual(4, stats.counters['connections_joined'])
+        self.assertEqual(0, analyze(capture.name, join_midstream = False).queries)
+
+        stats = analyze(self.capture.name)
+        self.assertEqual(0, stats.counters.get('midstream_queries', 0))
+
+    def test_starts_query(self):
+        from tcpip import Packet
+        client, server = (1, 50000), (2, 3306)
+        def check(data, source = client, destination = server):
+            packet = Packet(make_packet(source, destination, data))
+            packet.parse()
+            return starts_query(packet)
+        self.assertTrue(check(mysql_frame(0, '\x03SELECT 1')))
+        self.assertTrue(check(mysql_frame(0, '\x03\nSELECT 1' + 'x' * 3000)[:1400]))
+        self.assertFalse(check(mysql_frame(0, '\x03SELECT 1'), server, client))
+        self.assertFalse(check(mysql_frame(1, '\x03SELECT 1')))
+        self.assertFalse(check(mysql_frame(0, '\x16SELECT 1')))
+        self.assertFalse(check(mysql_frame(0, '\x03SELECT 1') + 'trailing'))
+        self.assertFalse(check(mysql_frame(0, '\x03\x00\x01binary')))
+        self.assertFalse(check(mysql_frame(1, '\x03\nSELECT 1')))
+        self.assertFalse(check(''))
+
+    def test_connection_counters(self):
+        stats = analyze(self.capture.name)
+        self.assertEqual(12, stats.counters['connections_opened'])
+        self.assertEqual(12, stats.counters['connections_closed'])
+        self.assertEqual(0, stats.counters['active_connections'])
+        # Shards' peaks add up to at least the real peak, so leave that out
+        parallel = analyze_parallel(self.capture.name, 3).counters
+        del stats.counters['peak_connections'], parallel['peak_connections']
+        self.assertEqual(stats.counters, parallel)
+
+    def test_handshake(self):
+        client, server = (parse_ip_string('10.5.6.1'), 40000), (parse_ip_string('10.7.5.15'), 3306)
+        session = mysql_session(client, server, [('SELECT 1', 1)], step = 0.01)
+        session[1:1] = [(0.001, make_packet(server, client, '', ('SYN', 'ACK'), 4999, 1001)),
+                        (0.002, make_packet(client, server, '', ('ACK',), 1001, 5000))]
+        capture = mysql_capture([session])
+        stats = analyze(capture.name)
+        self.assertEqual((1, 1), (stats.counters['connections_opened'], stats.counters['connections_closed']))
+        self.assertEqual(1, stats.queries)
+
+    def test_parallel_matches_serial(self):
+        self.assertEqual(self.summary(analyze(self.capture.name)), self.summary(analyze_parallel(self.capture.name, 3)))
+
+    def test_parallel_exact_buckets(self):
+        serial = analyze(self.capture.name, BucketFactory = Bucket)
+        parallel = analyze_parallel(self.capture.name, 2, BucketFactory = Bucket)
+        self.assertEqual(Bucket, type(parallel.timing))
+        self.assertEqual(self.summary(serial), self.summary(parallel))
+
+    def test_time_window(self):
+        import os
+        server = (parse_ip_string('10.7.5.15'), 3306)
+        sessions = []
+        for n in range(6):
+            client = (parse_ip_string('10.5.6.%d' % (n + 1)), 40000 + n)
+            sessions.append(mysql_session(client, server, [('SELECT %d FROM t' % n, 1)] * 4, ts = 1000 + n * 10))
+        capture = mysql_capture(sessions)
+        self.addCleanup(os.remove, capture.name + '.idx')
+        capture_index(capture.name, every = 8)
+
+        stats = analyze(capture.name, start = 1020, end = 1040)
+        self.assertEqual(8, stats.queries)
+        self.assertEqual(['SELECT ? FROM t'], [text for text, sql in stats.fingerprints.values()])
+        self.assertEqual(2, stats.counters['connections_opened'])
+        self.assertEqual(self.summary(stats), self.summary(analyze_parallel(capture.name, 2, start = 1020, end = 1040)))
+        # Split by range, only queries caught where the parts meet go missing
+        for processes in (2, 3):
+            queries = analyze_parallel(capture.name, processes, 'range').queries
+            self.assertTrue(24 - (processes - 1) <= queries <= 24, queries)
+
+class TestInstruments(unittest.TestCase):
+
+    def test_exclusive_time(self):
+        ticks = iter(range(100))
+        instruments = Instruments(clock = lambda: float(ticks.next()))
+        def inner():
+            pass
+        def outer():
+            instruments.timed('fingerprint', inner)()
+            instruments.timed('fingerprint', inner)()
+        instruments.timed('mysql', outer)()
+        # mysql: 1-2, 3-4 and 5-6; fingerprint: 2-3 and 4-5
+        self.assertEqual((3, 1), (instruments.seconds['mysql'], instruments.calls['mysql']))
+        self.assertEqual((2, 2), (instruments.seconds['fingerprint'], instruments.calls['fingerprint']))
+        self.assertEqual([], instruments.stack)
+
+    def test_analyze(self):
+        import json
+        server = (parse_ip_string('10.7.5.15'), 3306)
+        sessions = []
+        for n in range(4):
+            client = (parse_ip_string('10.5.6.%d' % (n + 1)), 40000 + n)
+            sessions.append(mysql_session(client, server, [('SELECT %d FROM t' % n, n)] * 3, ts = n * 0.0005))
+        capture = mysql_capture(sessions)
+        out = StringIO()
+        stats = analyze(capture.name, instruments = Instruments(out, interval = 0))
+        self.assertEqual(analyze(capture.name).queries, stats.queries)
+        self.assertFalse('record' in vars(stats))
+
+        line = json.loads(out.getvalue())
+        self.assertTrue(line['final'])
+        self.assertEqual((sum(map(len, sessions)), 12, 0), (line['packets'], line['queries'], line['active_connections']))
+        self.assertEqual(sum([len(raw) for session in sessions for ts, raw in session]), line['bytes'])
+        self.assertTrue(line['peak_rss'] > 0)
+        stages = line['stages']
+        self.assertEqual(list(Instruments.stages), sorted(stages, key = Instruments.stages.index))
+        self.assertEqual((line['packets'], 12, 12, 0),
+                         tuple(stages[name]['calls'] for name in ('parse', 'fingerprint', 'aggregate', 'query_log')))
+        # The FINs close their connections before reaching them
+        self.assertTrue(0 < stages['mysql']['calls'] < line['packets'])
+        self.assertTrue(sum([stage['seconds'] for stage in stages.values()]) <= line['elapsed'])
+
+class TestQueryLog(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        server = (parse_ip_string('10.7.5.15'), 3306)
+        sessions = []
+        for n in range(6):
+            client = (parse_ip_string('10.5.6.%d' % (n + 1)), 40000 + n)
+            queries = [('SELECT * FROM customers WHERE customers_id = %d' % n, n), ("SELECT name FROM products WHERE sku = 'x%d'" % n, 2)]
+            sessions.append(mysql_session(client, server, queries * (n + 1), ts = n * 0.0005))
+        self.capture = mysql_capture(sessions)
+        self.log = tempfile.NamedTemporaryFile(suffix = '.log')
+
+    def summary(self, stats):
+        return sorted([(stats.fingerprints[key], stats.timing.count(key), round(stats.timing.total(key), 6),
+                        stats.rows.total(key), stats.bytes.total(key), round(stats.think.total(key), 6))
+                       for key in stats.timing.data])
+
+    def test_round_trip(self):
+        stats = analyze(self.capture.name, query_log = self.log.name)
+        log = QueryLog(self.log.name)
+        self.assertEqual(42, len(log))
+        self.assertEqual(self.summary(stats), self.summary(log.stats()))
+        self.assertEqual(2, len(log.texts))
+        connections = log.column('connection')
+        self.assertEqual(6, len(set(connections)))
+        self.assertEqual(12, list(connections).count(connections[-1]))
+        self.assertEqual(stats.queries, log.stats().queries)
+        self.assertRaises(KeyError, log.column, 'nope')
+
+    def test_blocks_and_filter(self):
+        fd = file(self.log.name, 'wb')
+        writer = QueryLogWriter(fd, block_rows = 5)
+        analyze_stats = QueryStats()
+        for n in range(12):
+            query = MysqlQuery('SELECT %d FROM t%d' % (n, n % 3), n, command = 'COM_STMT_PREPARE' if n == 11 else 'COM_QUERY')
+            query.field_response = n + 0.5
+            query.first_result = query.last_result = n + 1
+            query.result_size = n
+            query.error_code = 1064 if n == 4 else None
+            writer.add(query)
+            analyze_stats.add(query)
+        writer.close()
+        fd.close()
+        log = QueryLog(self.log.name)
+        self.assertEqual([5, 5, 2], [rows for offset, rows in log.blocks])
+        self.assertEqual(range(12), list(log.column('rows')))
+        self.assertEqual(self.summary(analyze_stats), self.summary(log.stats()))
+        self.assertEqual(1, log.stats().counters['mysql_error_1064'])
+        late = log.stats(lambda columns, i: columns['timestamp'][i] >= 6)
+        self.assertEqual(6, late.queries)
+        self.assertEqual(['PREPARE SELECT ? FROM t2', 'SELECT ? FROM t0', 'SELECT ? FROM t1', 'SELECT ? FROM t2'],
+                         sorted(text for text, sql in late.fingerprints.values()))
+
+    def test_bad_files(self):
+        file(self.log.name, 'wb').write('MPKB' + '\x00' * 40)
+        self.assertRaises(DumpFormatError, QueryLog, self.log.name)
+        stats = analyze(self.capture.name, query_log = self.log.name)
+        data = file(self.log.name, 'rb').read()
+        file(self.log.name, 'wb').write(data[:-3])
+        self.assertRaises(DumpFormatError, QueryLog, self.log.name)
+
+class TestReport(unittest.TestCase):
+
+    def setUp(self):
+        # fingerprint n: n + 1 queries taking n ms each, with 20 - 3n rows
+        self.stats = QueryStats(Bucket)
+        for n in range(1, 6):
+            for i in range(n + 1):
+                query = MysqlQuery('SELECT * FROM t%d' % n, 0)
+                query.field_response = query.first_result = query.last_result = n / 1000.0
+                query.result_size = 20 - 3 * n
+                query.result_bytes = 100
+                self.stats.add(query)
+
+    def top(self, sort, n = 2):
+        return [row['query'] for row in report(self.stats, n, sort)]
+
+    def test_sort_keys(self):
+        self.assertEqual(['SELECT * FROM t5', 'SELECT * FROM t4'], self.top('total'))
+        self.assertEqual(['SELECT * FROM t5', 'SELECT * FROM t4'], self.top('p99'))
+        self.assertEqual(['SELECT * FROM t5', 'SELECT * FROM t4'], self.top('count'))
+        self.assertEqual(['SELECT * FROM t3', 'SELECT * FROM t2'], self.top('rows'))
+        self.assertEqual(['SELECT * FROM t5', 'SELECT * FROM t4'], self.top('bytes'))
+        self.assertEqual(5, len(self.top('total', 100)))
+
+    def test_only_top_aggregated(self):
+        aggregated = []
+        aggregate = self.stats.timing.aggregate
+        self.stats.timing.aggregate = lambda key: aggregated.append(key) or aggregate(key)
+        report(self.stats, 2, 'rows')
+        self.assertEqual(2, len(aggregated))
+        self.assertEqual(2, len(self.stats.timing.counts(2)))
+
+    def test_formats(self):
+        import csv, json
+        out = StringIO()
+        print_report(self.stats, 1, format = 'csv', out = out)
+        rows = list(csv.DictReader(StringIO(out.getvalue())))
+        self.assertEqual(['SELECT * FROM t5'], [row['query'] for row in rows])
+        self.assertEqual(('6', '5.0'), (rows[0]['count'], rows[0]['avg_rows']))
+        self.assertAlmostEqual(0.03, float(rows[0]['total']))
+
+        out = StringIO()
+        print_report(self.stats, 1, format = 'json', out = out)
+        row, = json.loads(out.getvalue())
+        self.assertEqual(set(report_columns), set(row))
+        self.assertEqual((6, 600), (row['count'], row['bytes']))
+        self.assertEqual(16, len(row['fingerprint']))
+
+        out = StringIO()
+        print_report(self.stats, 3, out = out)
+        self.assertEqual(4, len(out.getvalue().splitlines()))
+
+class TestLive(unittest.TestCase):
+
+    def setUp(self):
+        server = (parse_ip_string('10.7.5.15'), 3306)
+        sessions = []
+        for n in range(30):
+            client = (parse_ip_string('10.5.6.%d' % (n + 1)), 40000 + n)
+            queries = [('SELECT * FROM customers WHERE customers_id = %d' % n, 1)] * 3
+            if n % 10 == 0:
+                queries.append(("SELECT name FROM products WHERE sku = 'x%d'" % n, 1))
+            sessions.append(mysql_session(client, server, queries, ts = 1000 + n, step = 0.01 + n * 0.001))
+        self.capture = mysql_capture(sessions)
+
+    def test_rolling_window(self):
+        def Query(timestamp):
+            query = MysqlQuery('SELECT 1', timestamp)
+            query.first_result = timestamp
+            query.result_size = 0
+            return query
+        rolling = RollingWindow(interval = 10, window = 30)
+        self.assertEqual(100, rolling.add(Query(105)))
+        self.assertEqual(None, rolling.add(Query(109)))
+        self.assertEqual(110, rolling.add(Query(110)))
+        self.assertEqual(130, rolling.add(Query(131)))
+        self.assertEqual([100, 110, 130], [start for (start, stats) in rolling.slices])
+        for n in range(2):
+            merged = rolling.stats(130)
+            self.assertEqual((3, [3]), (merged.queries, [merged.timing.count(key) for key in merged.timing.data]))
+        self.assertEqual(2, rolling.stats().queries)
+        self.assertEqual(None, rolling.add(Query(95)))
+        self.assertEqual(3, rolling.stats().queries)
+
+    def test_file(self):
+        from cStringIO import StringIO
+        out = StringIO()
+        live(self.capture.name, interval = 10, window = 20, top = 1, out = out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(['last 20s: 31 queries (0 mid-stream), 0 connections (0 joined so far)',
+                          'last 20s: 62 queries (0 mid-stream), 0 connections (0 joined so far)',
+                          'last 20s: 62 queries (0 mid-stream), 0 connections (0 joined so far)'],
+                         [line.split(', ', 1)[1] for line in lines if line.startswith('==')])
+        self.assertEqual(9, len(lines))
+        self.assertTrue(lines[-1].endswith('SELECT * FROM customers WHERE customers_id = ?'))
+
+    def test_quiet(self):
+        from cStringIO import StringIO
+        server = (parse_ip_string('10.7.5.15'), 3306)
+        sessions = [mysql_session((parse_ip_string('10.5.6.1'), 40000), server, [('SELECT 1', 1)] * 3, ts = 1000),
+                    # Joined mid-stream: no handshake, and the first query's request is lost too
+                    mysql_session((parse_ip_string('10.5.6.2'), 40001), server, [('SELECT 1', 1)] * 4, ts = 1075)[5:]]
+        capture = mysql_capture(sessions)
+        out = StringIO()
+        live(capture.name, interval = 10, window = 20, top = 1, out = out)
+        # Nothing between 1000 and 1075, but the reports go on until the window is empty
+        self.assertEqual(['last 20s: 3 queries (0 mid-stream)', 'last 20s: 3 queries (0 mid-stream)',
+                          'last 20s: 0 queries (0 mid-stream)', 'last 20s: 3 queries (3 mid-stream)'],
+                         [line.split(', ')[1] for line in out.getvalue().splitlines() if line.startswith('==')])
+        self.assertTrue(out.getvalue().splitlines()[-3].endswith('0 connections (1 joined so far)'))
+
+    def test_pipe(self):
+        import os, threading
+        from tcpip import replay_pcap
+        read_end, write_end = os.pipe()
+        def writer():
+            fd = os.fdopen(write_end, 'wb')
+            replay_pcap(self.capture.name, fd, speed = 100)
+            fd.close()
+        thread = threading.Thread(target = writer)
+        thread.start()
+        from cStringIO import StringIO
+        out = StringIO()
+        stdin = sys.stdin
+        sys.stdin = os.fdopen(read_end, 'rb')
+        try:
+            live('-', interval = 10, window = 20, top = 1, out = out)
+        finally:
+            sys.stdin.close()
+            sys.stdin = stdin
+            thread.join()
+        self.assertEqual(3, out.getvalue().count('=='))
+
 if __name__ == "__main__":
-    timed(main)
-    """
-    import cProfile
-    cProfile.run('main()', 'profile')
-    """
-    
-    
-
-
-
-
+    from optparse import OptionParser
+    parser = OptionParser(usage = "%prog [options] [capture]")
+    parser.add_option('-j', '--processes', type = 'int', default = 1,
+                      help = "analyze in this many processes, split by TCP connection (0 for one per core)")
+    parser.add_option('--sql-cache', type = 'int', default = 10000, metavar = 'N',
+                      help = "keep the parsed form of the N most recently seen query texts")
+    parser.add_option('--idle-timeout', type = 'float', default = 600, metavar = 'SECONDS',
+                      help = "stop following a connection after this long without a packet")
+    parser.add_option('--max-connections', type = 'int', default = 65536, metavar = 'N',
+                      help = "follow at most N connections, dropping the least recently active")
+    parser.add_option('--no-join', action = 'store_false', dest = 'join_midstream', default = True,
+                      help = "only follow connections whose handshake is in the capture")
+    parser.add_option('--live', action = 'store_true',
+                      help = "read the capture as it's written (default stdin, e.g. tcpdump -w - | %prog --live) and report as it goes")
+    parser.add_option('--interval', type = 'int', default = 10, metavar = 'SECONDS',
+                      help = "with --live, report this often")
+    parser.add_option('--window', type = 'int', default = 60, metavar = 'SECONDS',
+                      help = "with --live, report on this much recent traffic")
+    parser.add_option('--top', type = 'int', default = 10, metavar = 'N',
+                      help = "show the top N fingerprints")
+    parser.add_option('--sort', type = 'choice', choices = sorted(sort_keys), default = 'total',
+                      help = "rank fingerprints by %s (default total time)" % ', '.join(sorted(sort_keys)))
+    parser.add_option('--format', type = 'choice', choices = sorted(report_formats), default = 'text',
+                      help = "write the report as %s" % ', '.join(sorted(report_formats)))
+    parser.add_option('--write-log', metavar = 'FILE',
+                      help = "also write every query to FILE, to report on again with --read-log")
+    parser.add_option('--read-log', action = 'store_true',
+                      help = "report from a query log written by --write-log instead of a capture")
+    parser.add_option('--start', metavar = 'TIME',
+                      help = "only look at traffic from TIME (seconds since the epoch, or YYYY-MM-DD HH:MM:SS)")
+    parser.add_option('--end', metavar = 'TIME',
+                      help = "only look at traffic before TIME")
+    parser.add_option('--split', type = 'choice', choices = ['connection', 'range'], default = 'connection',
+                      help = "with -j, give each process its own connections (default) or its own part of the file")
+    parser.add_option('--stats', metavar = 'FILE',
+                      help = "time each stage, writing a JSON line of timings and throughput to FILE ('-' for stderr) as it goes")
+    parser.add_option('--stats-interval', type = 'float', default = 10, metavar = 'SECONDS',
+                      help = "with --stats, write a line this often")
+    parser.add_option('--profile', metavar = 'FILE',
+                      help = "run under cProfile, saving the stats to FILE")
+    options, args = parser.parse_args()
+    for name in ('write_log', 'stats', 'profile'):
+        if getattr(options, name) and options.processes != 1:
+            parser.error("--%s only works with one process" % name.replace('_', '-'))
+    for name in ('start', 'end', 'write_log', 'read_log', 'stats', 'profile', 'sort', 'format', 'processes', 'sql_cache',
+                 'split'):
+        if options.live and getattr(options, name) != parser.defaults[name]:
+            parser.error("--%s doesn't work with --live" % name.replace('_', '-'))
+    try:
+        window = dict((name, parse_time(value)) for name, value in (('start', options.start), ('end', options.end))
+                      if value is not None)
+    except ValueError, e:
+        parser.error(str(e))
+    connection_options = dict(idle_timeout = options.idle_timeout, max_connections = options.max_connections,
+                              join_midstream = options.join_midstream)
+    run = timed
+    if options.profile:
+        run = lambda fn: timed(lambda: profiled(fn, options.profile))
+    if options.live:
+        live((args or ['-'])[0], options.interval, options.window, options.top, **connection_options)
+    elif options.read_log:
+        run(lambda: main(*args[:1], top = options.top, sort = options.sort, format = options.format, read_log = True,
+                         **window))
+    else:
+        connection_options.update(window)
+        if options.stats:
+            out = sys.stderr if options.stats == '-' else file(options.stats, 'w')
+            connection_options['instruments'] = Instruments(out, options.stats_interval)
+        run(lambda: main(*args[:1], processes = options.processes, top = options.top, sort = options.sort,
+                         format = options.format, split = options.split, sql_cache_size = options.sql_cache,
+                         query_log = options.write_log, **connection_options))
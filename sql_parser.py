@@ -1,82 +1,42 @@
+import re
+import struct
+from hashlib import md5
 from tcpip import EOD
+from collections import OrderedDict
    
-class Stream(object):
-    def __init__(self, source):
-        self.source = source
-        self.pos = 0
-        
-    def peek(self, n=0):
-        if self.pos >= len(self.source):
-            return '\x00'
-        return self.source[self.pos + n]
-        
-    def pull(self):
-        if self.pos >= len(self.source):
-            raise EOD()
-        self.pos += 1
-        return self.source[self.pos - 1]
+token_pattern = re.compile(r"""
+    (?P<space>[ \t\n\r\x0b\x0c]+)
+  | (?P<word>[A-Za-z][A-Za-z0-9_.]*)
+  | (?P<number>[0-9][0-9.]*)
+  | (?P<comment>/\*.*?\*/)
+  | (?P<string>'(?:[^'\\]|\\+[^\\])*'|"(?:[^"\\]|\\+[^\\])*")
+  | (?P<quoted>`(?:[^`\\]|\\+[^\\])*`)
+  | (?P<unterminated>/\*|['"`])
+  | (?P<symbol>!=|[!-/:-@\[-`{-~])
+  | (?P<other>.)
+""", re.VERBOSE | re.DOTALL)
 
 def lexer(sql):
-    stream = Stream(sql)
-    while True:
-        try:
-            char = stream.pull()
-        except EOD:
-            return
-            
-        if char in whitespace:
+    # A quote only closes a string if it isn't right after a backslash; an
+    # unterminated string or comment raises EOD. Characters that are none of
+    # whitespace, letters, digits or punctuation are dropped.
+    for match in token_pattern.finditer(sql):
+        kind = match.lastgroup
+        if kind == 'space' or kind == 'other':
             continue
-            
-        elif char in letters:
-            # Tokens
-            result = char
-            while stream.peek() in letters+digits+'_.':
-                result += stream.pull()
-            if result.lower() in keywords:
-                result_type = 'keyword'
-                result = result.upper()
-            else:
-                result_type = 'token'
-            yield (result_type, result)
-            
-        elif char in digits:
-            # Numbers
-            result = char
-            while stream.peek() in digits+'.':
-                result += stream.pull()
-            yield ('number', result)
-            
-        elif char in punctuation:
-            # Symbols
-            if char == '/' and stream.peek() == '*':
-                # Comments
-                comment = char + stream.pull()
-                while True:
-                    char = stream.pull()
-                    comment += char
-                    if char == '*' and stream.peek() == '/':
-                        comment += stream.pull()
-                        yield ('comment', comment)
-                        break
-            elif char == "'" or char == '"' or char == '`':
-                # Quoted string
-                quote = char
-                result = char
-                while stream.peek() != quote or result[-1] == "\\":
-                    result += stream.pull()
-                    
-                result += stream.pull()
-                if quote == '`':
-                    yield ('token', result)
-                else:
-                    yield ('string', result)
-                
+        value = match.group()
+        if kind == 'word':
+            upper = value.upper()
+            if upper in keyword_set:
+                yield ('keyword', upper)
             else:
-                # Operators, parens, etc
-                if char == '!' and stream.peek() == '=':
-                    yield ('symbol', char + stream.pull())
-                else:
-                    yield ('symbol', char)
+                yield ('token', value)
+        elif kind == 'quoted':
+            yield ('token', value)
+        elif kind == 'unterminated':
+            raise EOD()
+        else:
+            yield (kind, value)
 
 
 def fuzzy(tokens):
@@ -107,6 +67,64 @@ def fuzzy_token(key, value):
     elif key == 'comment':
         return None, None
     return (key, value)
+
+# token_pattern again, but with leading whitespace folded into each match and
+# the kinds normalize treats alike merged, so there are fewer matches to loop over
+normalize_pattern = re.compile(r"""[ \t\n\r\x0b\x0c]*(?:
+    (?P<word>[A-Za-z][A-Za-z0-9_.]*)
+  | (?P<literal>[0-9][0-9.]*|'(?:[^'\\]|\\+[^\\])*'|"(?:[^"\\]|\\+[^\\])*")
+  | (?P<comment>/\*.*?\*/)
+  | (?P<quoted>`(?:[^`\\]|\\+[^\\])*`)
+  | (?P<unterminated>/\*|['"`])
+  | (?P<symbol>!=|[!-+\--/:-@\[-`{-~])
+  | ,
+  | .
+  | $)""", re.VERBOSE | re.DOTALL)
+
+def normalize(sql):
+    """
+    Sql(sql).fuzzy() in a single scan of the raw text, without building the
+    token list: literals become ?, runs of ? (so IN lists) collapse to one,
+    and comments and commas go away.
+    """
+    result = []
+    append = result.append
+    last_value = None
+    for match in normalize_pattern.finditer(sql):
+        kind = match.lastgroup
+        if kind == 'word':
+            value = match.group(kind)
+            upper = value.upper()
+            if upper in keyword_set:
+                value = upper
+        elif kind == 'literal':
+            if last_value == '?':
+                continue
+            value = '?'
+        elif kind == 'symbol':
+            value = match.group(kind)
+            if value == '?' == last_value:
+                continue
+        elif kind == 'quoted':
+            value = match.group(kind)
+        elif kind == 'unterminated':
+            raise EOD()
+        else:
+            continue
+        last_value = value
+        append(value)
+    return " ".join(result)
+
+fingerprint_struct = struct.Struct('<q')
+
+def fingerprint_id(text):
+    """Stable signed 64-bit id for a normalized query, the same in every process and on every platform."""
+    return fingerprint_struct.unpack(md5(text).digest()[:8])[0]
+
+def fingerprint(sql):
+    """(fingerprint_id, normalized text) for a raw query."""
+    text = normalize(sql)
+    return fingerprint_id(text), text
         
     
 
@@ -154,6 +172,39 @@ class Sql(object):
     key = fuzzy
     
 
+class SqlCache(object):
+    """
+    LRU cache from raw query text to its parsed Sql (or whatever parse returns,
+    e.g. fingerprint). Production traffic repeats a few thousand query texts
+    over and over, and lexing is the expensive part.
+    """
+    def __init__(self, size = 10000, parse = Sql):
+        self.size = size
+        self.parse = parse
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, sql):
+        cache = self.cache
+        try:
+            parsed = cache.pop(sql)
+        except KeyError:
+            self.misses += 1
+            parsed = self.parse(sql)
+            if len(cache) >= self.size:
+                cache.popitem(last = False)
+        else:
+            self.hits += 1
+        cache[sql] = parsed
+        return parsed
+
+    def __len__(self):
+        return len(self.cache)
+
+    def __repr__(self):
+        return "<SqlCache %d/%d entries, %d hits, %d misses>" % (len(self.cache), self.size, self.hits, self.misses)
+
 def parse_mysql(packets):
     "deprecated"
     for packet in packets:
@@ -171,8 +222,6 @@ def parse_mysql(packets):
             yield (dst, src, 'response')
             
     
-from string import letters, digits, punctuation, whitespace
-
 keywords = [
     'select', 'count', 'from', 'where', 'and', 
     'or', 'insert', 'update', 'concat', 'if',
@@ -190,6 +239,8 @@ keywords = [
     'show', 'full', 'processlist'
 ]
 
+keyword_set = frozenset([keyword.upper() for keyword in keywords])
+
 for keyword in keywords:
     globals()[keyword.upper()] = ('keyword', keyword.upper())
             
@@ -256,5 +307,58 @@ class TestSQLLexer(unittest.TestCase):
         ]
         self.assertDataEqual(expected, data)
 
+    def test_exact_streams(self):
+        self.assertEqual([
+            ('symbol', '_'), ('token', 'id.x2'), ('symbol', '!='), ('number', '1.5'), ('token', 'e3'),
+            ('token', '`weird `'), ('token', '`name`'), ('string', '"a\\\\"b"'), ('symbol', '!'), ('keyword', 'IN'),
+        ], list(lexer('_id.x2 != 1.5e3 `weird ``name` "a\\\\"b" ! \xe9 in')))
+        self.assertEqual([('comment', '/*/ * */'), ('string', "''")], list(lexer("/*/ * */ ''")))
+
+    def test_unterminated(self):
+        self.assertRaises(EOD, list, lexer("SELECT 'abc"))
+        self.assertRaises(EOD, list, lexer("SELECT /* abc"))
+
+class TestNormalize(unittest.TestCase):
+
+    def test_matches_fuzzy(self):
+        for sql in (TestSQLLexer.realSql,
+                    "SELECT a, b FROM t WHERE id IN (1, 2, 3) AND name = 'x' AND c = ? AND d IN ('a','b')",
+                    "insert into foo (a, b) values (1, 'x'), (2, 'y') /* comment */",
+                    "update `foo` set bar = -1.5 where baz != \"q\\\"\" limit 5"):
+            self.assertEqual(Sql(sql).fuzzy(), normalize(sql))
+
+    def test_in_lists(self):
+        self.assertEqual('SELECT * FROM t WHERE id IN ( ? )', normalize('select * from t where id in (1, 2, 3, 4)'))
+        self.assertEqual('SELECT * FROM t WHERE id IN ( ? )', normalize("select * from t where id in ('a', ?, 3)"))
+
+    def test_fingerprint(self):
+        id, text = fingerprint('SELECT * FROM t WHERE id = 5')
+        self.assertEqual('SELECT * FROM t WHERE id = ?', text)
+        self.assertEqual((id, text), fingerprint('select *  from t where id = 12 /* x */'))
+        self.assertNotEqual(id, fingerprint('SELECT * FROM u WHERE id = 5')[0])
+        self.assertEqual(-8011794944410558711, fingerprint_id('SELECT ?'))
+        self.assertTrue(-2**63 <= id < 2**63)
+
+class TestSqlCache(unittest.TestCase):
+
+    def test_lru(self):
+        cache = SqlCache(size = 2)
+        first = cache('SELECT 1 FROM a')
+        self.assertTrue(first is cache('SELECT 1 FROM a'))
+        cache('SELECT 2 FROM b')
+        cache('SELECT 1 FROM a')
+        cache('SELECT 3 FROM c')
+        self.assertEqual(['SELECT 1 FROM a', 'SELECT 3 FROM c'], list(cache.cache))
+        self.assertTrue(first is cache('SELECT 1 FROM a'))
+        self.assertFalse(first is Sql('SELECT 1 FROM a'))
+        self.assertEqual((3, 3), (cache.hits, cache.misses))
+        self.assertEqual(2, len(cache))
+
+    def test_fingerprint(self):
+        cache = SqlCache()
+        self.assertEqual('SELECT ? FROM a', cache('SELECT 1 FROM a').fuzzy())
+        cache = SqlCache(parse = fingerprint)
+        self.assertEqual(fingerprint('SELECT 1 FROM a'), cache('SELECT 1 FROM a'))
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
@@ -1,7 +1,18 @@
+import os
 import sys
+import mmap
+import time
+import socket
 import struct
 import itertools
+from collections import namedtuple
+from bisect import bisect_left
 from binascii import crc32
+try:
+    import numpy
+except ImportError:
+    # Only the bulk path (read_tables) needs it
+    numpy = None
 
 # http://wiki.wireshark.org/Development/LibpcapFileFormat
 
@@ -73,6 +84,44 @@ def readstruct(fd, meta):
 def readstring(data, meta, endian = ''):
     return dict([(k,v) for ((k, vfmt), v) in zip(meta, struct.unpack(endian + getfmt(meta), data))])
 
+class Layout(object):
+    """A header descriptor compiled once into a Struct and a namedtuple record."""
+    def __init__(self, name, meta, endian = ''):
+        self.meta = meta
+        self.struct = struct.Struct(endian + getfmt(meta))
+        self.size = self.struct.size
+        self.record = namedtuple(name, [k for (k,v) in meta])
+        self._make = self.record._make
+        self._unpack_from = self.struct.unpack_from
+
+    def unpack(self, data, offset = 0):
+        return self._make(self._unpack_from(data, offset))
+
+    def read(self, fd):
+        return self.unpack(read(fd, self.size))
+
+    def pack(self, *values):
+        return self.struct.pack(*values)
+
+pcap_header_layout = Layout('PcapHeader', pcap_header, endian = '<')
+pcap_packet_layout = Layout('PcapPacketHeader', pcap_packet_header, endian = '<')
+swapped_layouts = (Layout('PcapHeader', pcap_header, endian = '>'), Layout('PcapPacketHeader', pcap_packet_header, endian = '>'))
+
+# The magic number, read little-endian: (header layout, record layout, nanosecond timestamps)
+pcap_formats = {
+    0xa1b2c3d4: (pcap_header_layout, pcap_packet_layout, False),
+    0xa1b23c4d: (pcap_header_layout, pcap_packet_layout, True),
+    0xd4c3b2a1: swapped_layouts + (False,),
+    0x4d3cb2a1: swapped_layouts + (True,),
+}
+PCAPNG_MAGIC = 0x0A0D0D0A
+magic_struct = struct.Struct('<' + uint32)
+ethertype_struct = struct.Struct(uint16)
+byte_struct = struct.Struct(uint8)
+address_struct = struct.Struct(uint32 + uint32)
+ports_struct = struct.Struct('!' + uint16 + uint16)
+meta_struct = struct.Struct('!' + uint16)
+
 def read1string(data, type):
     result, = struct.unpack(type, data)
     return result
@@ -81,9 +130,18 @@ def format_endpoint((ip, port)):
     return format_ip(ip) + ":" + str(port)
     
 class Packet(object):
-    def __init__(self, raw_data):
+    # parse() only decodes what demuxing needs (endpoints and flags); everything
+    # else is decoded from raw_data the first time it's asked for.
+    # IPv4 addresses are ints (see parse_ip_string), IPv6 ones 16 byte strings.
+    __slots__ = ('raw_data', 'pcap', 'link_type', 'ip_offset', 'tcp_offset', 'meta',
+                 'source', 'destination', 'socket', 'control', '_header')
+
+    def __init__(self, raw_data, ip_offset = 14, link_type = 1):
         self.raw_data = raw_data
         self.pcap = None
+        self.link_type = link_type
+        self.ip_offset = ip_offset
+        self._header = None
     
     def __repr__(self):
         return "[Packet " + format_endpoint(self.source) + " -> " +  format_endpoint(self.destination) + " at " + str(self.timestamp) + "]"
@@ -91,51 +149,1107 @@ class Packet(object):
     @property
     def timestamp(self):
         if self.pcap:
-            return self.pcap['ts_sec'] + self.pcap['ts_usec'] / 1000000.0
+            return self.pcap.ts_sec + self.pcap.ts_usec / 1000000.0
         return 0
         
     def parse(self):
-        self.parse_mac()
-        self.parse_ip()
-        self.parse_tcp()
-
-    def parse_ip(self):
-        self.ip = readstring(self.ip_data[:20], ip_header)
-        self.ihl = (self.ip['info'] & 0xF)
-        self.tcp_data = self.ip_data[self.ihl*4:]
-
-    def parse_mac(self):
-        self.mac = self.raw_data[0:6]
-        self.mac2 = self.raw_data[6:12]
-        self.ethertype = read1string(self.raw_data[12:14], uint16)
-        self.ip_data = self.raw_data[14:]        
-            
-    def parse_tcp(self):
-        self.header = readstring(self.tcp_data[0:20], tcp_header, endian='!')
-
-        self.tcp_header_length = (ord(self.tcp_data[12])>>4) * 4
-        control_bits = ord(self.tcp_data[13])
-        
-        self.control = parse_control(control_bits)
-        self.source = (self.ip['source'], self.header['source_port'])
-        self.destination = (self.ip['destination'], self.header['destination_port'])
+        raw_data, ip_offset = self.raw_data, self.ip_offset
+        if ip_offset is None:
+            # Not IP (ARP, say): nothing to demux on
+            self.source = self.destination = self.socket = self.control = None
+            return
+        info, = byte_struct.unpack_from(raw_data, ip_offset)
+        if info >= 0x60:
+            # IPv6; we don't follow extension headers
+            protocol = raw_data[ip_offset+6:ip_offset+7]
+            tcp_offset = ip_offset + 40
+        else:
+            protocol = raw_data[ip_offset+9:ip_offset+10]
+            tcp_offset = ip_offset + (info & 0xF) * 4
+        if protocol != '\x06' or len(raw_data) < tcp_offset + 20:
+            # UDP, ICMP or a TCP header cut short: nothing to demux on either
+            self.source = self.destination = self.socket = self.control = None
+            return
+        self.tcp_offset = tcp_offset
+        if info >= 0x60:
+            source_ip, destination_ip = raw_data[ip_offset+8:ip_offset+24], raw_data[ip_offset+24:ip_offset+40]
+        else:
+            source_ip, destination_ip = address_struct.unpack_from(raw_data, ip_offset + 12)
+        source_port, destination_port = ports_struct.unpack_from(raw_data, tcp_offset)
+        self.meta = meta = meta_struct.unpack_from(raw_data, tcp_offset + 12)[0]
+
+        self.control = control_table[meta & 0xFF]
+        self.source = (source_ip, source_port)
+        self.destination = (destination_ip, destination_port)
         self.socket = frozenset((self.source, self.destination))
-        self.data = self.tcp_data[self.tcp_header_length:]
 
-def read_packets(filename, my_mac = None, modulo=None, n=None):
-    fd = file(filename, 'rb')
-    data = readstruct(fd, pcap_header)
-    assert data['magic_number'] == 0xa1b2c3d4, "If you see this, odds are you need to flip the byte order ('<' or '>' before every struct format)"
+    # Link layer (ethernet only)
+
+    @property
+    def mac(self):
+        return self.raw_data[0:6]
+
+    @property
+    def mac2(self):
+        return self.raw_data[6:12]
+
+    @property
+    def ethertype(self):
+        return ethertype_struct.unpack_from(self.raw_data, 12)[0]
+
+    # IP
+
+    @property
+    def ip_data(self):
+        return buffer(self.raw_data, self.ip_offset)
+
+    @property
+    def ip(self):
+        return ip_layout.unpack(self.raw_data, self.ip_offset)
+
+    @property
+    def ihl(self):
+        return (self.tcp_offset - self.ip_offset) // 4
+
+    # TCP
+
+    @property
+    def tcp_data(self):
+        return buffer(self.raw_data, self.tcp_offset)
+
+    @property
+    def header(self):
+        if self._header is None:
+            self._header = tcp_layout.unpack(self.raw_data, self.tcp_offset)
+        return self._header
+
+    @property
+    def tcp_header_length(self):
+        return (self.meta >> 12) * 4
+
+    @property
+    def sequence_number(self):
+        return self.header.sequence_number
 
+    @property
+    def ack_number(self):
+        return self.header.ack_number
+
+    @property
+    def window(self):
+        return self.header.window
+
+    @property
+    def data(self):
+        return buffer(self.raw_data, self.tcp_offset + (self.meta >> 12) * 4)
+
+class CaptureFormatError(ValueError): pass
+
+# Link layers. Each finds the IP header in the frame at data[offset:offset+length],
+# returning its offset in data, or None if the frame isn't IPv4 or IPv6.
+
+ip_ethertypes = ('\x08\x00', '\x86\xdd')
+vlan_ethertypes = ('\x81\x00', '\x88\xa8', '\x91\x00')
+
+def ethernet_ip(data, offset, length):
+    ethertype = data[offset+12:offset+14]
+    ip = offset + 14
+    while ethertype in vlan_ethertypes:
+        # 802.1Q tags (stacked, for Q-in-Q): the real ethertype comes after 2 bytes of tag
+        ethertype = data[ip+2:ip+4]
+        ip += 4
+    if ethertype in ip_ethertypes and ip < offset + length:
+        return ip
+    return None
+
+def sll_ip(data, offset, length):
+    # Linux cooked capture (tcpdump -i any): 16 bytes, protocol last
+    if length > 16 and data[offset+14:offset+16] in ip_ethertypes:
+        return offset + 16
+    return None
+
+def sll2_ip(data, offset, length):
+    # Linux cooked capture v2: 20 bytes, protocol first
+    if length > 20 and data[offset:offset+2] in ip_ethertypes:
+        return offset + 20
+    return None
+
+def raw_ip(data, offset, length):
+    if length and ('\x40' <= data[offset] < '\x50' or '\x60' <= data[offset] < '\x70'):
+        return offset
+    return None
+
+def null_ip(data, offset, length):
+    # BSD loopback: a 4 byte address family (in the capturing host's byte order), then IP
+    return raw_ip(data, offset + 4, length - 4)
+
+link_types = {0: null_ip, 1: ethernet_ip, 101: raw_ip, 108: null_ip, 113: sll_ip, 228: raw_ip, 229: raw_ip, 276: sll2_ip}
+
+def link_layer(link_type):
+    """(function finding the IP header, link type): picked once per file, or pcapng interface."""
+    link_type &= 0xFFFF
+    if link_type not in link_types:
+        raise CaptureFormatError("Don't know how to read link type %d" % link_type)
+    return link_types[link_type], link_type
+
+def pcap_format(magic):
+    if magic not in pcap_formats:
+        raise CaptureFormatError("Not a pcap or pcapng file (magic number %08x)" % magic)
+    return pcap_formats[magic]
+
+def microseconds(record):
+    return pcap_packet_layout.record(record.ts_sec, record.ts_usec // 1000, record.incl_len, record.orig_len)
+
+def map_packets(data, filter = None, begin = 0, stop = None, sections = None):
+    """
+    Packets for the frames in a mapped capture (see read_packets); begin and
+    stop, offsets of records from a PcapIndex, limit them to part of it.
+    """
+    if len(data) < magic_struct.size:
+        return
+    magic, = magic_struct.unpack_from(data)
+    if magic == PCAPNG_MAGIC:
+        for position, record, offset, length, (link, link_type) in PcapngReader().map_records(data, begin, stop, sections):
+            ip = link(data, offset, length)
+            if filter and (ip is None or not filter(data, ip, offset + length)):
+                continue
+            p = Packet(buffer(data, offset, length), None if ip is None else ip - offset, link_type)
+            p.pcap = record
+            yield p
+        return
+
+    header_layout, layout, nanoseconds = pcap_format(magic)
+    if len(data) < header_layout.size:
+        return
+    link, link_type = link_layer(header_layout.unpack(data).network)
+    # Plain ethernet and IPv4 is most of what we see: skip the call to link for it
+    ethernet = link is ethernet_ip
+
+    unpack = layout.unpack
+    record_size = layout.size
+    end = len(data) if stop is None else min(stop, len(data))
+    offset = max(header_layout.size, begin)
+    while offset + record_size <= end:
+        record = unpack(data, offset)
+        offset += record_size
+        incl_len = record.incl_len
+        if offset + incl_len > end:
+            return
+        if ethernet and incl_len > 14 and data[offset+12:offset+14] == '\x08\x00':
+            ip = offset + 14
+        else:
+            ip = link(data, offset, incl_len)
+        if filter and (ip is None or not filter(data, ip, offset + incl_len)):
+            offset += incl_len
+            continue
+        if nanoseconds:
+            record = microseconds(record)
+        p = Packet(buffer(data, offset, incl_len), None if ip is None else ip - offset, link_type)
+        p.pcap = record
+        offset += incl_len
+        yield p
+
+def stream_records(fd):
+    """Yields (pcap record, frame, link layer) for each frame in a capture, reading fd as it goes."""
     try:
+        magic_data = read(fd, magic_struct.size)
+    except EOD:
+        return
+    magic, = magic_struct.unpack(magic_data)
+    if magic == PCAPNG_MAGIC:
+        for record in PcapngReader().stream_records(fd, magic_data):
+            yield record
+        return
+    header_layout, layout, nanoseconds = pcap_format(magic)
+    try:
+        link = link_layer(header_layout.unpack(magic_data + read(fd, header_layout.size - magic_struct.size)).network)
         while True:
-            packet = readstruct(fd, pcap_packet_header)
-            p = Packet(read(fd, packet['incl_len']))
-            p.pcap = packet
-            yield p
+            record = layout.read(fd)
+            raw_data = read(fd, record.incl_len)
+            if nanoseconds:
+                record = microseconds(record)
+            yield record, raw_data, link
     except EOD:
         return
 
+class PcapngReader(object):
+    """
+    Walks the blocks of a pcapng file, keeping track of what the frames
+    depend on: the current section's byte order, and its interfaces' link
+    layers and timestamp units. block() turns one block into a frame.
+    """
+    def __init__(self):
+        self.order = '<'
+        self.interfaces = []
+        self.sections = []
+
+    def block_header(self, data, offset):
+        """(block type, block length); a section header also sets the byte order for what follows."""
+        if magic_struct.unpack_from(data, offset)[0] == PCAPNG_MAGIC:
+            byte_order_magic = data[offset+8:offset+12]
+            if byte_order_magic == '\x4d\x3c\x2b\x1a':
+                self.order = '<'
+            elif byte_order_magic == '\x1a\x2b\x3c\x4d':
+                self.order = '>'
+            else:
+                raise CaptureFormatError("Bad pcapng byte order magic %r" % byte_order_magic)
+            self.interfaces = []
+        return struct.unpack_from(self.order + 'II', data, offset)
+
+    def options(self, data, start, end):
+        while start + 4 <= end:
+            code, length = struct.unpack_from(self.order + 'HH', data, start)
+            if code == 0:
+                return
+            yield code, data[start+4:start+4+length]
+            start += 4 + ((length + 3) & ~3)
+
+    def block(self, data, offset, length):
+        """(pcap record, frame offset, frame length, link layer) for packet blocks, otherwise None."""
+        order = self.order
+        type, = struct.unpack_from(order + 'I', data, offset)
+        if type == 1:
+            # Interface description: link type, snaplen, options
+            link_type, snaplen = struct.unpack_from(order + 'HxxI', data, offset + 8)
+            resolution, seconds = 1000000, 0
+            for code, value in self.options(data, offset + 16, offset + length - 4):
+                if code == 9 and value:
+                    # if_tsresol: a negative power of 10, or of 2 with the top bit set
+                    exponent = ord(value[0])
+                    resolution = 2 ** (exponent & 0x7F) if exponent & 0x80 else 10 ** exponent
+                elif code == 14 and len(value) == 8:
+                    seconds, = struct.unpack(order + 'q', value)
+            self.interfaces.append((link_layer(link_type), resolution, seconds, snaplen))
+            return None
+        if type in (2, 6):
+            # Enhanced packet, or the obsolete packet block
+            if type == 6:
+                interface, high, low, caplen, origlen = struct.unpack_from(order + 'IIIII', data, offset + 8)
+            else:
+                interface, drops, high, low, caplen, origlen = struct.unpack_from(order + 'HHIIII', data, offset + 8)
+            if interface >= len(self.interfaces):
+                raise CaptureFormatError("Packet from undeclared interface %d" % interface)
+            link, resolution, seconds, snaplen = self.interfaces[interface]
+            if 28 + caplen > length - 4:
+                raise CaptureFormatError("Packet longer than its block")
+            timestamp, fraction = divmod((high << 32) | low, resolution)
+            record = pcap_packet_layout.record(timestamp + seconds, fraction * 1000000 // resolution, caplen, origlen)
+            return record, offset + 28, caplen, link
+        if type == 3:
+            # Simple packet: interface 0, no timestamp
+            if not self.interfaces:
+                raise CaptureFormatError("Packet from undeclared interface 0")
+            link, resolution, seconds, snaplen = self.interfaces[0]
+            origlen, = struct.unpack_from(order + 'I', data, offset + 8)
+            caplen = min(origlen, length - 16, snaplen or origlen)
+            return pcap_packet_layout.record(0, 0, caplen, origlen), offset + 12, caplen, link
+        return None
+
+    def map_records(self, data, begin = 0, stop = None, sections = None):
+        """
+        Yields (block offset, pcap record, frame offset, frame length, link
+        layer) for each frame in data, from the block at begin up to stop.
+        Blocks before begin only count for their section and interface
+        descriptions; sections, the offsets of those (see PcapIndex), saves
+        walking there. The ones walked over are added to self.sections.
+        """
+        end = len(data) if stop is None else min(stop, len(data))
+        offset = 0
+        if sections is not None:
+            for offset in sections:
+                if offset < begin:
+                    type, length = self.block_header(data, offset)
+                    self.block(data, offset, length)
+            offset = begin
+        while offset + 12 <= end:
+            type, length = self.block_header(data, offset)
+            if length < 12 or offset + length > end:
+                return
+            if type == 1 or type == PCAPNG_MAGIC:
+                self.sections.append(offset)
+            if offset >= begin or type == 1:
+                frame = self.block(data, offset, length)
+                if frame is not None:
+                    yield (offset,) + frame
+            offset += length
+
+    def stream_records(self, fd, prefix = ''):
+        """Like map_records, reading fd as it goes: yields (pcap record, frame, link layer)."""
+        try:
+            while True:
+                head = prefix + read(fd, 12 - len(prefix))
+                prefix = ''
+                type, length = self.block_header(head, 0)
+                if length < 12:
+                    return
+                block = head + read(fd, length - 12)
+                frame = self.block(block, 0, length)
+                if frame is not None:
+                    record, offset, caplen, link = frame
+                    yield record, block[offset:offset+caplen], link
+        except EOD:
+            return
+
+def read_packets(filename, my_mac = None, modulo=None, n=None, filter=None, start=None, end=None, span=None):
+    # Walks an mmap of the capture; packets are buffer() slices of the map, not copies.
+    # (Python 2's mmap only has the old buffer interface, so memoryview() won't take it.)
+    # '-' reads stdin, as it arrives. Frames that aren't IP only come through when
+    # there's no filter, with ip_offset None.
+    # start and end keep the frames with start <= timestamp < end. For a file that
+    # can be mapped, its index (see capture_index) skips to the parts holding them;
+    # span, a (begin, stop) pair from PcapIndex.ranges, only reads that part.
+    fd = None
+    if filename == '-':
+        packets = stream_packets(sys.stdin, filter, modulo)
+    else:
+        fd = file(filename, 'rb')
+        try:
+            data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        except (mmap.error, ValueError):
+            # Empty files and pipes (FIFOs) can't be mapped, or seeked
+            packets = stream_packets(fd, filter, modulo)
+        else:
+            fd.close()
+            begin, stop, sections = 0, None, None
+            if start is not None or end is not None or span is not None:
+                index = capture_index(filename)
+                begin, stop = index.span(start, end)
+                if span is not None:
+                    begin, stop = max(begin, span[0]), min(stop, span[1])
+                sections = index.sections
+            packets = map_packets(data, compile_filter(filter, modulo), begin, stop, sections)
+
+    try:
+        if start is None and end is None:
+            for p in packets:
+                yield p
+        else:
+            for p in packets:
+                timestamp = p.timestamp
+                if (start is None or timestamp >= start) and (end is None or timestamp < end):
+                    yield p
+    finally:
+        if fd is not None:
+            fd.close()
+
+def stream_packets(fd, filter=None, modulo=None):
+    filter = compile_filter(filter, modulo)
+    for record, raw_data, (link, link_type) in stream_records(fd):
+        ip = link(raw_data, 0, len(raw_data))
+        if filter and (ip is None or not filter(raw_data, ip, len(raw_data))):
+            continue
+        p = Packet(raw_data, ip, link_type)
+        p.pcap = record
+        yield p
+
+INDEX_MAGIC = 'MPKI'
+INDEX_VERSION = 1
+index_header_struct = struct.Struct('<4sHIQdII')
+index_entry_struct = struct.Struct('<Qdd')
+offset_struct = struct.Struct('<Q')
+
+class PcapIndex(object):
+    """
+    Where a capture's frames are by time, for capture_index to keep next to
+    it. entries has an (offset, earliest, latest) for every `every` frames:
+    the offset of the first one's record, and the range of their timestamps,
+    which needn't be in order. sections are the offsets of a pcapng file's
+    section and interface blocks, which any frame after them may depend on.
+    size and mtime tell whether the capture changed since.
+    """
+    def __init__(self, size, mtime, every, entries, sections = ()):
+        self.size = size
+        self.mtime = mtime
+        self.every = every
+        self.entries = entries
+        self.sections = list(sections)
+
+    def __repr__(self):
+        return '[PcapIndex %d entries, every %d frames]' % (len(self.entries), self.every)
+
+    def span(self, start = None, end = None):
+        """(begin, stop): the part of the capture that can hold frames with start <= timestamp < end."""
+        begin = stop = None
+        for n, (offset, earliest, latest) in enumerate(self.entries):
+            if begin is None and (start is None or latest >= start):
+                begin = offset
+            if begin is not None and (end is None or earliest < end):
+                stop = self.entries[n + 1][0] if n + 1 < len(self.entries) else self.size
+        if stop is None:
+            return self.size, self.size
+        return begin, stop
+
+    def ranges(self, parts, start = None, end = None):
+        """Cuts span(start, end) into at most parts (begin, stop) ranges of about the same size, on entry boundaries."""
+        begin, stop = self.span(start, end)
+        bounds = [offset for offset, earliest, latest in self.entries if begin < offset < stop] + [stop]
+        ranges = []
+        last = begin
+        for n in range(1, parts + 1):
+            cut = bounds[bisect_left(bounds, begin + (stop - begin) * n // parts)]
+            if cut > last:
+                ranges.append((last, cut))
+                last = cut
+        return ranges
+
+    def write(self, fd):
+        fd.write(index_header_struct.pack(INDEX_MAGIC, INDEX_VERSION, self.every, self.size, self.mtime,
+                                          len(self.entries), len(self.sections)))
+        for entry in self.entries:
+            fd.write(index_entry_struct.pack(*entry))
+        for offset in self.sections:
+            fd.write(offset_struct.pack(offset))
+
+    @classmethod
+    def read(cls, fd):
+        data = fd.read()
+        if len(data) < index_header_struct.size:
+            raise CaptureFormatError("Capture index is truncated")
+        magic, version, every, size, mtime, entries, sections = index_header_struct.unpack_from(data)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise CaptureFormatError("Not a capture index, or not one this version can read")
+        if len(data) != index_header_struct.size + entries * index_entry_struct.size + sections * offset_struct.size:
+            raise CaptureFormatError("Capture index is truncated")
+        offset = index_header_struct.size
+        index = cls(size, mtime, every, [])
+        for n in xrange(entries):
+            index.entries.append(index_entry_struct.unpack_from(data, offset))
+            offset += index_entry_struct.size
+        for n in xrange(sections):
+            index.sections.append(offset_struct.unpack_from(data, offset)[0])
+            offset += offset_struct.size
+        return index
+
+def frame_times(data, sections):
+    """
+    Yields (record offset, timestamp) for each frame in a mapped capture,
+    without building packets. A pcapng file's section and interface blocks
+    are added to sections.
+    """
+    if len(data) < magic_struct.size:
+        return
+    magic, = magic_struct.unpack_from(data)
+    if magic == PCAPNG_MAGIC:
+        reader = PcapngReader()
+        for position, record, offset, length, link in reader.map_records(data):
+            yield position, record.ts_sec + record.ts_usec / 1000000.0
+        sections.extend(reader.sections)
+        return
+    header_layout, layout, nanoseconds = pcap_format(magic)
+    unpack = layout.struct.unpack_from
+    record_size = layout.size
+    end = len(data)
+    offset = header_layout.size
+    while offset + record_size <= end:
+        ts_sec, fraction, incl_len, orig_len = unpack(data, offset)
+        if offset + record_size + incl_len > end:
+            return
+        if nanoseconds:
+            fraction //= 1000
+        # The same sum as Packet.timestamp, so they compare alike
+        yield offset, ts_sec + fraction / 1000000.0
+        offset += record_size + incl_len
+
+def build_index(filename, every = 1000):
+    """A PcapIndex of the capture in filename, from one pass over its record headers."""
+    fd = file(filename, 'rb')
+    try:
+        stat = os.fstat(fd.fileno())
+        try:
+            data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        except (mmap.error, ValueError):
+            data = ''
+    finally:
+        fd.close()
+    index = PcapIndex(stat.st_size, stat.st_mtime, every, [])
+    entry = None
+    for n, (offset, timestamp) in enumerate(frame_times(data, index.sections)):
+        if n % every == 0:
+            entry = [offset, timestamp, timestamp]
+            index.entries.append(entry)
+        elif timestamp < entry[1]:
+            entry[1] = timestamp
+        elif timestamp > entry[2]:
+            entry[2] = timestamp
+    index.entries = [tuple(entry) for entry in index.entries]
+    return index
+
+def capture_index(filename, every = None):
+    """
+    The PcapIndex for filename, from its sidecar (filename + '.idx') when
+    that's up to date, and every frames apart if every is given; otherwise
+    it's built (by default every 1000 frames) and saved there if we can.
+    """
+    sidecar = filename + '.idx'
+    stat = os.stat(filename)
+    try:
+        fd = file(sidecar, 'rb')
+        try:
+            index = PcapIndex.read(fd)
+        finally:
+            fd.close()
+        if (index.size, index.mtime) == (stat.st_size, stat.st_mtime) and every in (None, index.every):
+            return index
+    except (IOError, CaptureFormatError):
+        pass
+    index = build_index(filename, every or 1000)
+    try:
+        # Written to one side first, so a reader never sees half of it
+        temporary = '%s.%d' % (sidecar, os.getpid())
+        fd = file(temporary, 'wb')
+        try:
+            index.write(fd)
+        finally:
+            fd.close()
+        os.rename(temporary, sidecar)
+    except (IOError, OSError):
+        pass
+    return index
+
+class FilterError(ValueError): pass
+
+def tcp_offset(data, ip):
+    """Where the TCP header starts, for the IPv4 or IPv6 header at ip; None if it isn't TCP."""
+    if data[ip] >= '\x60':
+        return ip + 40 if data[ip+6] == '\x06' else None
+    return ip + (ord(data[ip]) & 0xF) * 4 if data[ip+9] == '\x06' else None
+
+class PacketFilter(object):
+    """
+    A tiny subset of tcpdump's filter language, checked against the raw frame
+    before a Packet is built:
+
+        tcp | [tcp] [src|dst] port N | [src|dst] host A.B.C.D (or IPv6)
+
+    combined with and, or, not and parentheses. Filters are called with the
+    offset of the IP header, which the link layer found, and of the frame's end;
+    mask() runs the same test over a whole PacketTable.
+
+    The expression is parsed into a tree of tuples: ('or', terms),
+    ('and', terms), ('not', term), ('tcp',), ('port', port, direction) and
+    ('host', host, direction), direction being 'src', 'dst' or None.
+    """
+    def __init__(self, expression):
+        self.expression = expression
+        self.tokens = expression.replace('(', ' ( ').replace(')', ' ) ').split()
+        self.tree = self.parse_or()
+        if self.tokens:
+            raise FilterError("Unexpected %r in filter %r" % (self.tokens[0], expression))
+        del self.tokens
+        self.match = self.build(self.tree)
+
+    def __call__(self, data, ip, end):
+        if end - ip < (60 if data[ip] >= '\x60' else 40):
+            return False
+        return self.match(data, ip)
+
+    def compile(self):
+        """The same test as a plain function, which is quicker to call than the instance."""
+        match = self.match
+        def check(data, ip, end):
+            if end - ip < 60 and (end - ip < 40 or data[ip] >= '\x60'):
+                return False
+            return match(data, ip)
+        return check
+
+    def __repr__(self):
+        return "PacketFilter(%r)" % self.expression
+
+    def pop(self):
+        if not self.tokens:
+            raise FilterError("Filter %r ended unexpectedly" % self.expression)
+        return self.tokens.pop(0)
+
+    def parse_or(self):
+        terms = [self.parse_and()]
+        while self.tokens and self.tokens[0] in ('or', '||'):
+            self.pop()
+            terms.append(self.parse_and())
+        return ('or', terms) if len(terms) > 1 else terms[0]
+
+    def parse_and(self):
+        terms = [self.parse_not()]
+        while self.tokens and self.tokens[0] in ('and', '&&'):
+            self.pop()
+            terms.append(self.parse_not())
+        return ('and', terms) if len(terms) > 1 else terms[0]
+
+    def parse_not(self):
+        if self.tokens and self.tokens[0] in ('not', '!'):
+            self.pop()
+            return ('not', self.parse_not())
+        if self.tokens and self.tokens[0] == '(':
+            self.pop()
+            term = self.parse_or()
+            if self.pop() != ')':
+                raise FilterError("Unbalanced parentheses in filter %r" % self.expression)
+            return term
+        return self.parse_primitive()
+
+    def parse_primitive(self):
+        direction = None
+        token = self.pop()
+        if token in ('src', 'dst'):
+            direction, token = token, self.pop()
+
+        if token == 'tcp' and not direction:
+            # "tcp port N": ports only ever match tcp anyway
+            if self.tokens[:1] == ['port'] or self.tokens[:2] in (['src', 'port'], ['dst', 'port']):
+                return self.parse_primitive()
+            return ('tcp',)
+        elif token == 'port':
+            try:
+                port = int(self.pop())
+            except ValueError:
+                raise FilterError("Bad port in filter %r" % self.expression)
+            return ('port', port, direction)
+        elif token == 'host':
+            try:
+                host = parse_ip_string(self.pop())
+            except (ValueError, socket.error):
+                raise FilterError("Bad host in filter %r" % self.expression)
+            return ('host', host, direction)
+        raise FilterError("Don't know how to filter on %r in %r" % (token, self.expression))
+
+    def build(self, node):
+        """The match(data, ip) function for a parsed tree."""
+        kind = node[0]
+        if kind == 'or':
+            return reduce(lambda a, b: lambda data, offset: a(data, offset) or b(data, offset), map(self.build, node[1]))
+        elif kind == 'and':
+            return reduce(lambda a, b: lambda data, offset: a(data, offset) and b(data, offset), map(self.build, node[1]))
+        elif kind == 'not':
+            term = self.build(node[1])
+            return lambda data, offset: not term(data, offset)
+        elif kind == 'tcp':
+            return lambda data, ip: tcp_offset(data, ip) is not None
+        elif kind == 'port':
+            return self.port_match(*node[1:])
+        return self.host_match(*node[1:])
+
+    def mask(self, rows, node = None):
+        """The filter over a PacketTable's rows, all at once: a boolean array."""
+        if node is None:
+            available = rows['length'].astype(numpy.int64) - rows['ip_offset']
+            long_enough = (((rows['version'] == 4) & (available >= 40)) | ((rows['version'] == 6) & (available >= 60)))
+            return long_enough & self.mask(rows, self.tree)
+        kind = node[0]
+        if kind == 'or':
+            return reduce(numpy.logical_or, [self.mask(rows, term) for term in node[1]])
+        elif kind == 'and':
+            return reduce(numpy.logical_and, [self.mask(rows, term) for term in node[1]])
+        elif kind == 'not':
+            return ~self.mask(rows, node[1])
+        tcp = rows['tcp_offset'] >= 0
+        if kind == 'tcp':
+            return tcp
+        if kind == 'port':
+            port, direction = node[1:]
+            columns = [rows[name] == port for name in ('source_port', 'destination_port')]
+            version = tcp
+        else:
+            host, direction = node[1:]
+            ipv6 = isinstance(host, str)
+            address = numpy.void(host if ipv6 else address_struct.pack(host, 0)[:4] + '\x00' * 12)
+            columns = [rows[name] == address for name in ('source_ip', 'destination_ip')]
+            version = rows['version'] == (6 if ipv6 else 4)
+        if direction == 'src':
+            return version & columns[0]
+        elif direction == 'dst':
+            return version & columns[1]
+        return version & (columns[0] | columns[1])
+
+    def port_match(self, port, direction):
+        unpack_from = ports_struct.unpack_from
+        def match(data, ip):
+            # tcp_offset(), inlined: this runs for every frame
+            if data[ip] < '\x60':
+                if data[ip+9] != '\x06':
+                    return False
+                tcp = ip + (ord(data[ip]) & 0xF) * 4
+            elif data[ip+6] == '\x06':
+                tcp = ip + 40
+            else:
+                return False
+            source, destination = unpack_from(data, tcp)
+            if direction == 'src':
+                return source == port
+            elif direction == 'dst':
+                return destination == port
+            return source == port or destination == port
+        return match
+
+    def host_match(self, host, direction):
+        unpack_from = address_struct.unpack_from
+        ipv6 = isinstance(host, str)
+        def match(data, ip):
+            if (data[ip] >= '\x60') != ipv6:
+                return False
+            if ipv6:
+                source, destination = data[ip+8:ip+24], data[ip+24:ip+40]
+            else:
+                source, destination = unpack_from(data, ip + 12)
+            if direction == 'src':
+                return source == host
+            elif direction == 'dst':
+                return destination == host
+            return source == host or destination == host
+        return match
+
+class ShardFilter(object):
+    """
+    Keeps the packets of every shards-th TCP connection. The key only depends
+    on the pair of endpoints, so both directions of a connection always land
+    in the same shard. Frames too short to have ports go to shard 0.
+    """
+    def __init__(self, shard, shards):
+        assert 0 <= shard < shards
+        self.shard = shard
+        self.shards = shards
+
+    def __call__(self, data, ip, end):
+        if end - ip < (60 if data[ip] >= '\x60' else 40):
+            return self.shard == 0
+        return self.key(data, ip) % self.shards == self.shard
+
+    @staticmethod
+    def key(data, ip):
+        if data[ip] >= '\x60':
+            source_ip, destination_ip = crc32(data[ip+8:ip+24]), crc32(data[ip+24:ip+40])
+            ports = ip + 40
+        else:
+            source_ip, destination_ip = address_struct.unpack_from(data, ip + 12)
+            ports = ip + (ord(data[ip]) & 0xF) * 4
+        source_port, destination_port = ports_struct.unpack_from(data, ports)
+        return (source_ip ^ destination_ip) + (source_port ^ destination_port)
+
+def compile_filter(filter, modulo = None):
+    """Turns read_packets' filter (expression or callable) and modulo ((shard, shards)) into one callable."""
+    if isinstance(filter, basestring):
+        filter = PacketFilter(filter).compile()
+    if modulo is None:
+        return filter
+    shard = ShardFilter(*modulo)
+    if filter is None:
+        return shard
+    return lambda data, ip, end: filter(data, ip, end) and shard(data, ip, end)
+
+# The bulk path, for first-pass triage over millions of frames (which hosts and
+# ports dominate, which MAC is ours): frames' headers are decoded a block at a
+# time into NumPy structured arrays, and Packets only get built for the rows
+# picked out of them. Needs NumPy.
+
+table_fields = [
+    ('offset', 'i8'), # of the frame in the file
+    ('length', 'u4'),
+    ('orig_length', 'u4'),
+    ('ts_sec', 'u4'),
+    ('ts_usec', 'u4'),
+    ('timestamp', 'f8'), # as Packet.timestamp
+    ('link_type', 'u2'),
+    ('destination_mac', 'V6'), # Ethernet only
+    ('source_mac', 'V6'),
+    ('ip_offset', 'i4'), # from the start of the frame, -1 if it isn't IP
+    ('version', 'u1'), # 4 or 6, 0 if it isn't IP
+    ('protocol', 'u1'),
+    ('source_ip', 'V16'), # IPv4 addresses are the first 4 bytes
+    ('destination_ip', 'V16'),
+    ('tcp_offset', 'i4'), # -1 if it isn't TCP, or the header's cut off
+    ('source_port', 'u2'),
+    ('destination_port', 'u2'),
+    ('flags', 'u1'), # as control_table has them
+    ('payload_offset', 'i4'),
+    ('payload_length', 'i4'),
+]
+
+def table_address(address, version):
+    """A source_ip or destination_ip value as Packet has addresses (see parse_ip_string)."""
+    address = str(address)
+    if version == 4:
+        return address_struct.unpack(address[:4] * 2)[0]
+    return address
+
+class PacketTable(object):
+    """
+    Decoded headers for a run of frames in a mapped capture: rows is a NumPy
+    structured array of table_fields, one row per frame. Picking rows (mask,
+    take) and grouping them (conversations, macs) works on whole columns;
+    packets() builds Packets for just the rows left.
+    """
+    def __init__(self, data, rows):
+        self.data = data
+        self.rows = rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __repr__(self):
+        return '[PacketTable %d rows]' % len(self.rows)
+
+    def mask(self, filter):
+        """Which rows pass filter, a PacketFilter or its expression, as a boolean array."""
+        if isinstance(filter, basestring):
+            filter = PacketFilter(filter)
+        return filter.mask(self.rows)
+
+    def take(self, selection):
+        """The table of just the rows selection (a mask, or row numbers) picks."""
+        return PacketTable(self.data, self.rows[selection])
+
+    def packets(self):
+        rows = self.rows
+        columns = [rows[name].tolist() for name in ('offset', 'length', 'ip_offset', 'link_type', 'ts_sec', 'ts_usec',
+                                                     'orig_length')]
+        data, record = self.data, pcap_packet_layout.record
+        for offset, length, ip_offset, link_type, ts_sec, ts_usec, orig_length in itertools.izip(*columns):
+            p = Packet(buffer(data, offset, length), ip_offset if ip_offset >= 0 else None, link_type)
+            p.pcap = record(ts_sec, ts_usec, length, orig_length)
+            yield p
+
+    def conversations(self):
+        """{socket: (packets, bytes)} for the TCP rows, bytes as on the wire; socket as in Packet.socket."""
+        rows = self.rows[self.rows['tcp_offset'] >= 0]
+        names = ('version', 'source_ip', 'source_port', 'destination_ip', 'destination_port')
+        flows = numpy.zeros(len(rows), [(name, dict(table_fields)[name]) for name in names])
+        for name in names:
+            flows[name] = rows[name]
+        # Unique is much quicker on one opaque column than on a record's fields
+        keys, inverse = numpy.unique(flows.view('V%d' % flows.dtype.itemsize), return_inverse = True)
+        keys = keys.view(flows.dtype)
+        packets = numpy.bincount(inverse, minlength = len(keys)).tolist()
+        sizes = numpy.bincount(inverse, rows['orig_length'], minlength = len(keys)).tolist()
+        # Few enough flows by now to pair up their directions one by one
+        conversations = {}
+        for (version, source_ip, source_port, destination_ip, destination_port), count, size in zip(keys.tolist(), packets, sizes):
+            socket = frozenset([(table_address(source_ip, version), source_port),
+                                (table_address(destination_ip, version), destination_port)])
+            before = conversations.get(socket, (0, 0))
+            conversations[socket] = (before[0] + count, before[1] + int(size))
+        return conversations
+
+    def macs(self):
+        """{MAC address: how many frames it's on, as source or destination}, for the Ethernet rows."""
+        rows = self.rows[self.rows['link_type'] == 1]
+        macs, counts = numpy.unique(numpy.concatenate([rows['destination_mac'], rows['source_mac']]), return_counts = True)
+        return dict((str(mac), count) for mac, count in zip(macs.tolist(), counts.tolist()))
+
+def table_records(data, block_rows):
+    """
+    Yields (frame offsets, lengths, original lengths, seconds, microseconds,
+    link types) as arrays, for each block_rows frames of a mapped capture.
+    Only the walk from one record to the next goes frame by frame.
+    """
+    if len(data) < magic_struct.size:
+        return
+    magic, = magic_struct.unpack_from(data)
+    if magic == PCAPNG_MAGIC:
+        columns = [[] for n in range(6)]
+        for position, record, offset, length, (link, link_type) in PcapngReader().map_records(data):
+            for column, value in zip(columns, (offset, length, record.orig_len, record.ts_sec, record.ts_usec, link_type)):
+                column.append(value)
+            if len(columns[0]) == block_rows:
+                yield [numpy.array(column, numpy.int64) for column in columns]
+                columns = [[] for n in range(6)]
+        if columns[0]:
+            yield [numpy.array(column, numpy.int64) for column in columns]
+        return
+
+    header_layout, layout, nanoseconds = pcap_format(magic)
+    if len(data) < header_layout.size:
+        return
+    link, link_type = link_layer(header_layout.unpack(data).network)
+    order = layout.struct.format[0]
+    unpack_length = struct.Struct(order + uint32).unpack_from
+    raw = numpy.frombuffer(data, numpy.uint8)
+    record_size = layout.size
+    end = len(data)
+    offset = header_layout.size
+    while True:
+        records = []
+        while offset + record_size <= end and len(records) < block_rows:
+            incl_len, = unpack_length(data, offset + 8)
+            if offset + record_size + incl_len > end:
+                break
+            records.append(offset)
+            offset += record_size + incl_len
+        if not records:
+            return
+        records = numpy.array(records, numpy.int64)
+        header = raw[records[:, None] + numpy.arange(record_size)].view(order + 'u4').astype(numpy.int64)
+        fraction = header[:, 1] // 1000 if nanoseconds else header[:, 1]
+        yield (records + record_size, header[:, 2], header[:, 3], header[:, 0], fraction,
+               numpy.repeat(numpy.int64(link_type), len(records)))
+
+def decode_table(raw, offsets, lengths, orig_lengths, seconds, microseconds, link_types):
+    """The table_fields rows for frames at offsets in raw (the capture as uint8), as read_packets would parse them."""
+    rows = numpy.zeros(len(offsets), table_fields)
+    rows['offset'], rows['length'], rows['orig_length'] = offsets, lengths, orig_lengths
+    rows['ts_sec'], rows['ts_usec'], rows['link_type'] = seconds, microseconds, link_types
+    rows['timestamp'] = seconds + microseconds / 1000000.0
+    ends = offsets + lengths
+
+    def byte(at):
+        return raw.take(at, mode = 'clip').astype(numpy.int64)
+    def short(at):
+        return (byte(at) << 8) | byte(at + 1)
+    def is_ip(ethertype):
+        return (ethertype == 0x0800) | (ethertype == 0x86dd)
+    def is_ip_version(at):
+        nibble = byte(at) >> 4
+        return (nibble == 4) | (nibble == 6)
+
+    # The link layers, as ethernet_ip and the rest find the IP header
+    ip = numpy.repeat(numpy.int64(-1), len(offsets))
+    ethernet = link_types == 1
+    if ethernet.any():
+        macs = raw.take(offsets[ethernet][:, None] + numpy.arange(12), mode = 'clip')
+        rows['destination_mac'][ethernet] = macs[:, :6].copy().view('V6').ravel()
+        rows['source_mac'][ethernet] = macs[:, 6:].copy().view('V6').ravel()
+        ethertype, start = short(offsets + 12), offsets + 14
+        vlan = ethernet & ((ethertype == 0x8100) | (ethertype == 0x88a8) | (ethertype == 0x9100)) & (start < ends)
+        while vlan.any():
+            ethertype[vlan], start[vlan] = short(start[vlan] + 2), start[vlan] + 4
+            vlan &= ((ethertype == 0x8100) | (ethertype == 0x88a8) | (ethertype == 0x9100)) & (start < ends)
+        found = ethernet & is_ip(ethertype) & (start < ends)
+        ip[found] = start[found]
+    for types, skip, test in (((113,), 16, lambda: (lengths > 16) & is_ip(short(offsets + 14))),
+                              ((276,), 20, lambda: (lengths > 20) & is_ip(short(offsets))),
+                              ((101, 228, 229), 0, lambda: (lengths > 0) & is_ip_version(offsets)),
+                              ((0, 108), 4, lambda: (lengths > 4) & is_ip_version(offsets + 4))):
+        found = reduce(numpy.logical_or, [link_types == link_type for link_type in types])
+        if found.any():
+            found &= test()
+            ip[found] = offsets[found] + skip
+
+    # IP, as Packet.parse: anything from 0x60 up is IPv6, and extension headers aren't followed
+    is_ip_row = ip >= 0
+    info = numpy.where(is_ip_row, byte(ip), 0)
+    ipv6 = is_ip_row & (info >= 0x60)
+    ipv4 = is_ip_row & ~ipv6
+    rows['ip_offset'] = numpy.where(is_ip_row, ip - offsets, -1)
+    rows['version'] = numpy.where(ipv6, 6, numpy.where(ipv4, 4, 0))
+    rows['protocol'] = numpy.where(ipv6, byte(ip + 6), numpy.where(ipv4, byte(ip + 9), 0))
+    for name, v4, v6 in (('source_ip', 12, 8), ('destination_ip', 16, 24)):
+        address = raw.take(numpy.where(ipv6, ip + v6, ip + v4)[:, None] + numpy.arange(16), mode = 'clip')
+        address[~ipv6, 4:] = 0
+        address[~is_ip_row] = 0
+        rows[name] = address.view('V16').ravel()
+
+    tcp = numpy.where(ipv6, ip + 40, ip + (info & 0xF) * 4)
+    tcp_rows = is_ip_row & (rows['protocol'] == 6) & (tcp + 20 <= ends)
+    rows['tcp_offset'] = numpy.where(tcp_rows, tcp - offsets, -1)
+    rows['source_port'] = numpy.where(tcp_rows, short(tcp), 0)
+    rows['destination_port'] = numpy.where(tcp_rows, short(tcp + 2), 0)
+    rows['flags'] = numpy.where(tcp_rows, byte(tcp + 13), 0)
+    payload = tcp + (byte(tcp + 12) >> 4) * 4
+    rows['payload_offset'] = numpy.where(tcp_rows, payload - offsets, -1)
+    rows['payload_length'] = numpy.where(tcp_rows, numpy.maximum(ends - payload, 0), 0)
+    return rows
+
+def read_tables(filename, block_rows = 1048576, filter = None):
+    """
+    Yields the capture in filename as PacketTables of block_rows frames at
+    a time (fewer, once filter, an expression or PacketFilter, has picked
+    its rows out). The bulk counterpart of read_packets, which it matches
+    row for row: PacketTable.packets() gives what read_packets would.
+    """
+    if numpy is None:
+        raise ImportError("read_tables needs NumPy")
+    if isinstance(filter, basestring):
+        filter = PacketFilter(filter)
+    fd = file(filename, 'rb')
+    try:
+        if os.fstat(fd.fileno()).st_size == 0:
+            return
+        try:
+            data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        except (mmap.error, ValueError):
+            raise CaptureFormatError("Can only read tables from a file that can be mapped, not %r" % filename)
+    finally:
+        fd.close()
+    raw = numpy.frombuffer(data, numpy.uint8)
+    for columns in table_records(data, block_rows):
+        table = PacketTable(data, decode_table(raw, *columns))
+        if filter is not None:
+            table = table.take(table.mask(filter))
+        yield table
+
+def conversations(tables, n = None):
+    """The n busiest (socket, packets, bytes) over tables, by bytes; all of them if n is None."""
+    totals = {}
+    for table in tables:
+        for socket, (packets, size) in table.conversations().iteritems():
+            before = totals.get(socket, (0, 0))
+            totals[socket] = (before[0] + packets, before[1] + size)
+    ranked = sorted(totals.iteritems(), key = lambda (socket, (packets, size)): (-size, -packets))
+    return [(socket, packets, size) for socket, (packets, size) in ranked[:n]]
+
+def write_pcap(fd, packets):
+    """Writes (timestamp, raw_data) pairs as a little-endian libpcap file."""
+    fd.write(pcap_header_layout.pack(0xa1b2c3d4, 2, 4, 0, 0, 65535, 1))
+    for timestamp, raw_data in packets:
+        ts_sec = int(timestamp)
+        ts_usec = int(round((timestamp - ts_sec) * 1000000))
+        fd.write(pcap_packet_layout.pack(ts_sec, ts_usec, len(raw_data), len(raw_data)))
+        fd.write(raw_data)
+
+def replay_pcap(filename, out, speed = 1.0, sleep = time.sleep):
+    """
+    Copies a capture to out, pacing the records by their timestamps (speed 2
+    plays twice as fast, 0 as fast as possible). For feeding a recording to
+    the live mode:
+
+        python tcpip.py replay capture.pcap 10 | python queries.py --live
+    """
+    first = started = None
+    link_type = None
+    for p in read_packets(filename):
+        if link_type is None:
+            # Whatever the capture was (pcapng, nanoseconds...), out is plain pcap
+            link_type = p.link_type
+            out.write(pcap_header_layout.pack(0xa1b2c3d4, 2, 4, 0, 0, 262144, link_type))
+        if speed:
+            if first is None:
+                first, started = p.timestamp, time.time()
+            delay = (p.timestamp - first) / speed - (time.time() - started)
+            if delay > 0:
+                sleep(delay)
+        out.write(pcap_packet_layout.pack(*p.pcap))
+        out.write(p.raw_data)
+        out.flush()
+    if link_type is None:
+        out.write(pcap_header_layout.pack(0xa1b2c3d4, 2, 4, 0, 0, 262144, 1))
+
+def parse_ip_string(ip):
+    """IPv4 addresses become ints, in the byte order Packet reads them; IPv6 ones 16 byte strings."""
+    if ':' in ip:
+        return socket.inet_pton(socket.AF_INET6, ip)
+    return sum([int(n) << (8*i) for (i, n) in enumerate(ip.split('.'))])
+
+ip6_struct = struct.Struct('!IHBB16s16s')
+udp_struct = struct.Struct('!HHHH')
+
+def make_packet(source, destination, data = '', control = ('ACK',), sequence_number = 0, ack_number = 0):
+    """Builds an ethernet/IP/TCP frame (IPv6 for string addresses), for tests and synthetic captures."""
+    (src_ip, src_port), (dst_ip, dst_port) = source, destination
+    control_bits = sum([2**control_names.index(name) for name in control])
+    tcp = tcp_layout.pack(src_port, dst_port, sequence_number, ack_number, (5 << 12) | control_bits, 65535, 0, 0)
+    mac = '\x00\x19\xb9\xb4s\xe4' + '\x00\x19\xb9\xf3\xb4\xb5'
+    if isinstance(src_ip, str):
+        return mac + '\x86\xdd' + ip6_struct.pack(6 << 28, len(tcp + data), 6, 64, src_ip, dst_ip) + tcp + data
+    ip = ip_layout.pack(0x45, 0, 0, 0, 0, 64, 6, 0, src_ip, dst_ip)
+    return mac + '\x08\x00' + ip + tcp + data
+
+def make_datagram(source, destination, data = ''):
+    """Like make_packet, but UDP."""
+    (src_ip, src_port), (dst_ip, dst_port) = source, destination
+    udp = udp_struct.pack(src_port, dst_port, 8 + len(data), 0)
+    mac = '\x00\x19\xb9\xb4s\xe4' + '\x00\x19\xb9\xf3\xb4\xb5'
+    if isinstance(src_ip, str):
+        return mac + '\x86\xdd' + ip6_struct.pack(6 << 28, len(udp + data), 17, 64, src_ip, dst_ip) + udp + data
+    ip = ip_layout.pack(0x45, 0, 0, 0, 0, 64, 17, 0, src_ip, dst_ip)
+    return mac + '\x08\x00' + ip + udp + data
+
 def good_hex(n):
     digits = '0123456789ABCDEF'
     return digits[n // 16] + digits[n % 16]
@@ -144,6 +1258,8 @@ def format_mac(mac):
     return ":".join([good_hex(ord(n)) for n in mac])
 
 def format_ip(ip):
+    if isinstance(ip, str):
+        return socket.inet_ntop(socket.AF_INET6, ip)
     return ".".join([str((ip>>(8*n)) % 0x100) for n in range(4)])
 
 ip_header = [
@@ -159,6 +1275,8 @@ ip_header = [
     ('destination', uint32),
 ]
 
+ip_layout = Layout('IpHeader', ip_header)
+
 tcp_header = [
     ('source_port', uint16),
     ('destination_port', uint16),
@@ -170,30 +1288,221 @@ tcp_header = [
     ('urgent', uint16),
 ]
 
+tcp_layout = Layout('TcpHeader', tcp_header, endian='!')
+
 control_names =('CWR', 'ECN', 'URG', 'ACK', 'PSH', 'RST', 'SYN', 'FIN')[::-1]
 parse_control = lambda control_bits:  frozenset([name for (n,name) in enumerate(control_names) if control_bits & (2**n)])
+control_table = [parse_control(n) for n in range(256)]
 
 bin = lambda i, m: 'b' + ''.join(str((i>>n) & 1) for n in range(m))
     
-def collapse_tcp_streams(packets, ConnFactory, progress = lambda: None):
-    sockets = {}
+class ConnectionTable(object):
+    """
+    The connections collapse_tcp_streams is following, as socket: [connection,
+    last seen]. Connections go away on FIN or RST, after idle_timeout seconds
+    (of capture time) without a packet, or, once there are max_connections,
+    the least recently active makes room for a new one. Either limit can be
+    None. A packet only updates its connection's last seen time; the table is
+    only scanned when a sweep for idle connections is due, or when it's full.
+    """
+    def __init__(self, idle_timeout = 600, max_connections = 65536):
+        self.idle_timeout = idle_timeout
+        self.max_connections = max_connections
+        self.connections = {}
+        self.expired_at = None
+        self.opened = 0
+        self.joined = 0
+        self.closed = 0
+        self.reset = 0
+        self.idle_evictions = 0
+        self.lru_evictions = 0
+        self.peak = 0
+
+    def __len__(self):
+        return len(self.connections)
+
+    def __contains__(self, socket):
+        return socket in self.connections
+
+    def open(self, socket, conn, now, joined = False):
+        connections = self.connections
+        connections[socket] = [conn, now]
+        if joined:
+            self.joined += 1
+        else:
+            self.opened += 1
+        if self.max_connections is not None and len(connections) > self.max_connections:
+            del connections[min((entry[1], key) for key, entry in connections.iteritems() if key != socket)[1]]
+            self.lru_evictions += 1
+        self.peak = max(self.peak, len(connections))
+
+    def close(self, socket, reset = False):
+        if self.connections.pop(socket, None) is not None:
+            if reset:
+                self.reset += 1
+            else:
+                self.closed += 1
+
+    def get(self, socket, now):
+        entry = self.connections.get(socket)
+        if entry is None:
+            return None
+        entry[1] = now
+        return entry[0]
+
+    def expire(self, now):
+        """
+        Drops connections idle for longer than idle_timeout. Only looks every
+        idle_timeout / 16 seconds of capture time (but at least a second
+        apart), so a connection can outstay the timeout by that much.
+        """
+        if self.idle_timeout is None or (self.expired_at is not None and
+                                         now - self.expired_at < max(1, self.idle_timeout / 16.0)):
+            return
+        self.expired_at = now
+        connections = self.connections
+        idle = [socket for socket, (conn, seen) in connections.iteritems() if now - seen > self.idle_timeout]
+        for socket in idle:
+            del connections[socket]
+        self.idle_evictions += len(idle)
+
+    def counters(self):
+        return {
+            'active_connections': len(self.connections),
+            'peak_connections': self.peak,
+            'connections_opened': self.opened,
+            'connections_joined': self.joined,
+            'connections_closed': self.closed,
+            'connections_reset': self.reset,
+            'idle_evictions': self.idle_evictions,
+            'lru_evictions': self.lru_evictions,
+        }
+
+closing = frozenset(['FIN', 'RST'])
+
+def collapse_tcp_streams(packets, ConnFactory, progress = lambda: None, connections = None, JoinFactory = None,
+                         parsed = False):
+    """
+    Hands each packet to the connection object for its socket. Connections are
+    made by ConnFactory() on SYN; JoinFactory(packet), if given, gets to pick
+    up sockets whose SYN we missed, by returning a connection (or None).
+    parsed says the packets come already parse()d.
+    """
+    if connections is None:
+        connections = ConnectionTable()
     for packet in packets:
-        packet.parse()
+        if not parsed:
+            packet.parse()
         progress()
+        if packet.socket is None:
+            continue
+        now = packet.timestamp
+        connections.expire(now)
         
-        if 'SYN' in packet.control:
-            sockets[packet.socket] = ConnFactory()
-        elif 'FIN' in packet.control:
-            try:
-                del sockets[packet.socket]
-            except KeyError:
-                pass
+        control = packet.control
+        if 'SYN' in control and 'ACK' not in control:
+            # The SYN-ACK belongs to the connection its SYN opened
+            connections.open(packet.socket, ConnFactory(), now)
+        elif 'FIN' in control or 'RST' in control:
+            connections.close(packet.socket, reset = 'RST' in control)
         
-        sock = sockets.get(packet.socket, None)
+        sock = connections.get(packet.socket, now)
+        if sock is None and JoinFactory is not None and not control & closing:
+            sock = JoinFactory(packet)
+            if sock is not None:
+                connections.open(packet.socket, sock, now, joined = True)
         if sock:
             sock.saw_packet(packet)
-        # Packets from connections we're just now seeing are ignored. Bad idea? Maybe, but interjecting into a steram is annoying
-                
+    return connections
+
+def seq_offset(seq, base):
+    """seq - base in 32-bit sequence space, as a signed distance."""
+    return ((seq - base + 0x80000000) & 0xFFFFFFFF) - 0x80000000
+
+class TcpReassembler(object):
+    """
+    One direction of a TCP stream, put back in sequence order. feed(packet)
+    returns the [(packet, data)] that are now in order: retransmitted bytes
+    are dropped, early segments wait in pending until the hole before them
+    fills. If more than max_pending bytes are waiting we give up on the hole
+    and skip to the earliest pending segment, returning (packet, None) to mark
+    the gap. Counts go into counters, which can be shared between streams.
+    """
+    def __init__(self, counters = None, max_pending = 262144):
+        self.next_seq = None
+        self.pending = {}
+        self.pending_bytes = 0
+        self.max_pending = max_pending
+        self.counters = {} if counters is None else counters
+
+    def count(self, name, n = 1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def feed(self, packet):
+        seq = packet.sequence_number
+        if 'SYN' in packet.control:
+            self.next_seq = (seq + 1) & 0xFFFFFFFF
+            return []
+        if self.next_seq is None:
+            self.next_seq = seq
+        data = packet.data
+        if not len(data):
+            return []
+        offset = seq_offset(seq, self.next_seq)
+        if offset > 0:
+            waiting = self.pending.get(seq)
+            if waiting is not None:
+                self.count('tcp_retransmits')
+                if len(waiting[1]) >= len(data):
+                    return []
+                self.pending_bytes -= len(waiting[1])
+            else:
+                self.count('tcp_out_of_order')
+            self.pending[seq] = (packet, data)
+            self.pending_bytes += len(data)
+            ready = []
+            while self.pending_bytes > self.max_pending:
+                ready.extend(self.skip())
+            return ready
+        if -offset >= len(data):
+            self.count('tcp_retransmits')
+            return []
+        if offset:
+            self.count('tcp_retransmits')
+            data = buffer(data, -offset)
+        self.next_seq = (self.next_seq + len(data)) & 0xFFFFFFFF
+        return [(packet, data)] + self.drain()
+
+    def earliest(self):
+        next_seq = self.next_seq
+        return min(self.pending, key = lambda seq: seq_offset(seq, next_seq))
+
+    def drain(self):
+        ready = []
+        while self.pending:
+            seq = self.earliest()
+            offset = seq_offset(seq, self.next_seq)
+            if offset > 0:
+                break
+            packet, data = self.pending.pop(seq)
+            self.pending_bytes -= len(data)
+            if -offset >= len(data):
+                self.count('tcp_retransmits')
+                continue
+            if offset:
+                data = buffer(data, -offset)
+            ready.append((packet, data))
+            self.next_seq = (self.next_seq + len(data)) & 0xFFFFFFFF
+        return ready
+
+    def skip(self):
+        """Gives up on the hole at next_seq: jumps to the earliest pending segment."""
+        seq = self.earliest()
+        self.count('tcp_gaps')
+        self.count('tcp_gap_bytes', seq_offset(seq, self.next_seq))
+        self.next_seq = seq
+        return [(self.pending[seq][0], None)] + self.drain()
+
 import unittest
 
 class TestTCPParser(unittest.TestCase):
@@ -205,12 +1514,614 @@ class TestTCPParser(unittest.TestCase):
         self.assertEqual(32, packet.tcp_header_length)
         self.assertEqual(frozenset(['ACK', 'PSH']), packet.control)
         
+    def test_header_fields(self):
+        packet = Packet(make_packet((parse_ip_string('10.5.6.56'), 35991), (parse_ip_string('10.7.5.15'), 3306), 'select 1',
+                                    sequence_number = 77))
+        packet.parse()
+        self.assertEqual(3306, packet.header.destination_port)
+        self.assertEqual('10.5.6.56', format_ip(packet.ip.source))
+        self.assertEqual(packet.header.sequence_number, packet.header[2])
+
+    def test_lazy_fields(self):
+        raw_packet = make_packet((1, 35991), (2, 3306), 'select 1', control=('ACK', 'PSH'), sequence_number=77)
+        packet = Packet(raw_packet)
+        packet.parse()
+        self.assertEqual(None, packet._header)
+        self.assertEqual(frozenset([(1, 35991), (2, 3306)]), packet.socket)
+        self.assertEqual('select 1', str(packet.data))
+        self.assertEqual(77, packet.sequence_number)
+        self.assertEqual(65535, packet.window)
+        self.assertEqual(5, packet.ihl)
+        self.assertFalse(hasattr(packet, '__dict__'))
+        
     def test_again(self):
         raw_packet = '\x00\x19\xb9\xb4s\xe4\x00\x19\xb9\xf3\xb4\xb5\x08\x00E\x08\x004\xcdt@\x00@\x06M\xf5\n\x05\x068\n\x07\x05\x0f\x8c\x97\x0c\xea\xc6\x90\xba\x9e\xcfY\x96v\x80\x10\x0373d\x00\x00\x01\x01\x08\n\xb1ia\xcdJ\xcdBJ'
         packet = Packet(raw_packet)
         packet.parse()
         self.assertEqual(32, packet.tcp_header_length)
         self.assertEqual(frozenset(['ACK']), packet.control)
-    
+
+class TestReadPackets(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.source = (parse_ip_string('10.5.6.56'), 35991)
+        self.destination = (parse_ip_string('10.7.5.15'), 3306)
+        self.packets = [
+            (1.5, make_packet(self.source, self.destination, control=('SYN',))),
+            (2.25, make_packet(self.source, self.destination, 'select 1')),
+            (3.0, make_packet(self.destination, self.source, 'x' * 300)),
+        ]
+        self.fd = tempfile.NamedTemporaryFile()
+        write_pcap(self.fd, self.packets)
+        self.fd.flush()
+
+    def tearDown(self):
+        self.fd.close()
+
+    def check(self, packets):
+        self.assertEqual(len(self.packets), len(packets))
+        for (ts, raw), packet in zip(self.packets, packets):
+            packet.parse()
+            self.assertEqual(ts, packet.timestamp)
+            self.assertEqual(raw, str(packet.raw_data))
+        self.assertEqual(frozenset(['SYN']), packets[0].control)
+        self.assertEqual('select 1', str(packets[1].data))
+        self.assertEqual(self.destination, packets[2].source)
+        self.assertEqual('10.7.5.15', format_ip(packets[2].source[0]))
+
+    def test_mmap(self):
+        self.check(list(read_packets(self.fd.name)))
+
+    def test_stream(self):
+        self.check(list(stream_packets(file(self.fd.name, 'rb'))))
+
+    def test_fifo(self):
+        import os, tempfile, threading
+        path = os.path.join(tempfile.mkdtemp(), 'fifo')
+        os.mkfifo(path)
+        def writer():
+            fd = file(path, 'wb')
+            replay_pcap(self.fd.name, fd, speed = 0)
+            fd.close()
+        thread = threading.Thread(target = writer)
+        thread.start()
+        try:
+            self.check(list(read_packets(path)))
+        finally:
+            thread.join()
+            os.unlink(path)
+            os.rmdir(os.path.dirname(path))
+
+    def test_replay_pacing(self):
+        from cStringIO import StringIO
+        out = StringIO()
+        delays = []
+        replay_pcap(self.fd.name, out, speed = 0.5, sleep = delays.append)
+        self.assertEqual(self.fd.tell(), len(out.getvalue()))
+        self.assertEqual([1.5, 3.0], [round(d, 1) for d in delays])
+
+    def test_truncated(self):
+        self.fd.truncate(self.fd.tell() - 10)
+        self.assertEqual(2, len(list(read_packets(self.fd.name))))
+
+def pcap_file(packets, order = '<', nanoseconds = False, link_type = 1):
+    header = Layout('PcapHeader', pcap_header, endian = order)
+    record = Layout('PcapPacketHeader', pcap_packet_header, endian = order)
+    chunks = [header.pack(0xa1b23c4d if nanoseconds else 0xa1b2c3d4, 2, 4, 0, 0, 65535, link_type)]
+    for timestamp, raw_data in packets:
+        fraction = int(round((timestamp % 1) * (1000000000 if nanoseconds else 1000000)))
+        chunks.append(record.pack(int(timestamp), fraction, len(raw_data), len(raw_data)) + raw_data)
+    return ''.join(chunks)
+
+def pcapng_block(order, type, body):
+    body += '\x00' * (-len(body) % 4)
+    return struct.pack(order + 'II', type, len(body) + 12) + body + struct.pack(order + 'I', len(body) + 12)
+
+def pcapng_file(packets, order = '<', resolution = None, link_type = 1, simple = False):
+    options = ''
+    if resolution is not None:
+        options = struct.pack(order + 'HH', 9, 1) + chr(resolution) + '\x00' * 3 + struct.pack(order + 'HH', 0, 0)
+    chunks = [pcapng_block(order, PCAPNG_MAGIC, struct.pack(order + 'IHHq', 0x1A2B3C4D, 1, 0, -1)),
+              pcapng_block(order, 1, struct.pack(order + 'HHI', link_type, 0, 0) + options),
+              pcapng_block(order, 5, struct.pack(order + 'III', 0, 0, 0))]
+    units = 10 ** (resolution or 6)
+    for timestamp, raw_data in packets:
+        if simple:
+            chunks.append(pcapng_block(order, 3, struct.pack(order + 'I', len(raw_data)) + raw_data))
+        else:
+            ticks = int(round(timestamp * units))
+            chunks.append(pcapng_block(order, 6, struct.pack(order + 'IIIII', 0, ticks >> 32, ticks & 0xFFFFFFFF,
+                                                             len(raw_data), len(raw_data)) + raw_data))
+    return ''.join(chunks)
+
+class TestCaptureFormats(unittest.TestCase):
+
+    def setUp(self):
+        self.client = (parse_ip_string('10.5.6.56'), 35991)
+        self.server = (parse_ip_string('10.7.5.15'), 3306)
+        self.packets = [
+            (1.5, make_packet(self.client, self.server, control=('SYN',))),
+            (2.25, make_packet(self.client, self.server, 'select 1')),
+            (3.0, make_packet(self.server, self.client, 'x' * 301)),
+            (3.5, '\xff' * 12 + '\x08\x06' + '\x00' * 46),
+        ]
+
+    def read(self, capture, **kw):
+        import tempfile
+        fd = tempfile.NamedTemporaryFile()
+        fd.write(capture)
+        fd.flush()
+        mapped = list(read_packets(fd.name, **kw))
+        fd.seek(0)
+        streamed = list(stream_packets(fd, **kw))
+        fd.close()
+        packets = []
+        for p, q in zip(mapped, streamed):
+            self.assertEqual((p.pcap, str(p.raw_data), p.ip_offset, p.link_type), (q.pcap, str(q.raw_data), q.ip_offset, q.link_type))
+        self.assertEqual(len(mapped), len(streamed))
+        return mapped
+
+    def check(self, packets, timestamps = True):
+        self.assertEqual([raw for ts, raw in self.packets], [str(p.raw_data) for p in packets])
+        if timestamps:
+            self.assertEqual([ts for ts, raw in self.packets], [p.timestamp for p in packets])
+        self.assertEqual([14, 14, 14, None], [p.ip_offset for p in packets])
+        packets[2].parse()
+        self.assertEqual((self.server, 'x' * 301), (packets[2].source, str(packets[2].data)))
+
+    def test_truncated_frame(self):
+        # Cut off right after the ethernet header: no IP header to point at
+        self.packets[1] = (2.25, self.packets[1][1][:14])
+        packets = self.read(pcap_file(self.packets, '<', False))
+        self.assertEqual([14, None, 14, None], [p.ip_offset for p in packets])
+
+    def test_pcap_variants(self):
+        for order in '<>':
+            for nanoseconds in (False, True):
+                self.check(self.read(pcap_file(self.packets, order, nanoseconds)))
+
+    def test_pcapng(self):
+        for order in '<>':
+            self.check(self.read(pcapng_file(self.packets, order)))
+            self.check(self.read(pcapng_file(self.packets, order, resolution = 9)))
+        # A second section can switch byte order
+        self.check(self.read(pcapng_file(self.packets[:2], '>') + pcapng_file(self.packets[2:], '<')))
+        self.check(self.read(pcapng_file(self.packets, simple = True)), timestamps = False)
+        self.assertEqual(3, len(self.read(pcapng_file(self.packets, '>', 9), filter = 'tcp port 3306 and host 10.7.5.15')))
+
+    def test_link_types(self):
+        frames = [make_packet(self.client, self.server, 'select 1'),
+                  make_packet((parse_ip_string('2001:db8::56'), 35991), (parse_ip_string('2001:db8::15'), 3306), 'select 1')]
+        vlan = lambda frame: frame[:12] + '\x81\x00\x00\x05' + frame[12:]
+        sll = lambda frame: '\x00\x00\x00\x01\x00\x06' + frame[6:12] + '\x00\x00' + frame[12:]
+        sll2 = lambda frame: frame[12:14] + '\x00' * 18 + frame[14:]
+        null = lambda frame: '\x02\x00\x00\x00' + frame[14:]
+        for link_type, wrap, ip_offset in ((1, lambda frame: frame, 14), (1, vlan, 18), (1, lambda frame: vlan(vlan(frame)), 22),
+                                           (113, sll, 16), (276, sll2, 20), (101, lambda frame: frame[14:], 0), (0, null, 4)):
+            packets = self.read(pcap_file([(n, wrap(frame)) for n, frame in enumerate(frames)], link_type = link_type),
+                                filter = 'tcp port 3306')
+            self.assertEqual([ip_offset] * 2, [p.ip_offset for p in packets])
+            for p in packets:
+                p.parse()
+                self.assertEqual((3306, 'select 1', link_type), (p.destination[1], str(p.data), p.link_type))
+            self.assertEqual(['10.5.6.56', '2001:db8::56'], [format_ip(p.source[0]) for p in packets])
+
+    def test_bad_files(self):
+        self.assertRaises(CaptureFormatError, self.read, 'hello, world' * 4)
+        self.assertRaises(CaptureFormatError, self.read, pcap_file(self.packets, link_type = 105))
+        self.assertRaises(CaptureFormatError, self.read, pcapng_file(self.packets, link_type = 105))
+        self.assertEqual([], self.read(''))
+        self.assertEqual(2, len(self.read(pcapng_file(self.packets)[:-100])))
+
+    def test_replay_converts(self):
+        from cStringIO import StringIO
+        import tempfile
+        fd = tempfile.NamedTemporaryFile()
+        fd.write(pcapng_file(self.packets, '>', 9, link_type = 113))
+        fd.flush()
+        out = StringIO()
+        replay_pcap(fd.name, out, speed = 0)
+        self.assertEqual(113, pcap_header_layout.unpack(out.getvalue()).network)
+        self.assertEqual([(ts, str(p.raw_data)) for ts, p in zip([1.5, 2.25, 3.0, 3.5], read_packets(fd.name))],
+                         [(p.timestamp, str(p.raw_data)) for p in stream_packets(StringIO(out.getvalue()))])
+
+class TestConnectionTable(unittest.TestCase):
+
+    class Conn(object):
+        def __init__(self):
+            self.packets = []
+        def saw_packet(self, packet):
+            self.packets.append(packet)
+
+    def stream(self, events):
+        # events: (timestamp, client port, control)
+        server = (parse_ip_string('10.7.5.15'), 3306)
+        for ts, port, control in events:
+            packet = Packet(make_packet((parse_ip_string('10.5.6.56'), port), server, control = control))
+            packet.pcap = pcap_packet_layout.record(int(ts), int(ts % 1 * 1000000), 0, 0)
+            yield packet
+
+    def test_fin_and_rst(self):
+        table = collapse_tcp_streams(self.stream([
+            (0, 1, ('SYN',)), (0, 2, ('SYN',)), (1, 1, ('ACK',)), (2, 1, ('FIN', 'ACK')),
+            (3, 2, ('RST',)), (4, 2, ('ACK',)),
+        ]), self.Conn)
+        self.assertEqual(0, len(table))
+        self.assertEqual((2, 1, 1, 2), (table.opened, table.closed, table.reset, table.peak))
+
+    def test_non_ip(self):
+        arp = Packet('\xff' * 12 + '\x08\x06' + '\x00' * 46, None)
+        arp.parse()
+        self.assertEqual((None, None), (arp.socket, arp.control))
+        conns = []
+        def ConnFactory():
+            conns.append(self.Conn())
+            return conns[-1]
+        packets = list(self.stream([(0, 1, ('SYN',)), (1, 1, ('ACK',))]))
+        collapse_tcp_streams([packets[0], arp, packets[1]], ConnFactory)
+        self.assertEqual([2], [len(conn.packets) for conn in conns])
+
+    def test_not_tcp(self):
+        client, server = (parse_ip_string('10.5.6.56'), 35991), (parse_ip_string('10.7.5.15'), 53)
+        frames = [make_datagram(client, server), make_datagram(client, server, '\x00' * 13 + '\x02' + '\x00' * 30),
+                  make_datagram((parse_ip_string('2001:db8::56'), 35991), (parse_ip_string('2001:db8::15'), 53), 'x' * 30),
+                  make_packet(client, server, control = ('SYN',))[:40]]
+        for frame in frames:
+            packet = Packet(frame)
+            packet.parse()
+            self.assertEqual((None, None), (packet.socket, packet.control))
+        conns = []
+        def ConnFactory():
+            conns.append(self.Conn())
+            return conns[-1]
+        packets = list(self.stream([(0, 1, ('SYN',)), (1, 1, ('ACK',))]))
+        collapse_tcp_streams([packets[0]] + [Packet(frame) for frame in frames] + [packets[1]], ConnFactory)
+        self.assertEqual([2], [len(conn.packets) for conn in conns])
+
+    def test_syn_ack(self):
+        conns = []
+        def ConnFactory():
+            conns.append(self.Conn())
+            return conns[-1]
+        table = collapse_tcp_streams(self.stream([(0, 1, ('SYN',)), (0, 1, ('SYN', 'ACK')), (1, 1, ('ACK',))]), ConnFactory)
+        self.assertEqual(1, table.opened)
+        self.assertEqual([3], [len(conn.packets) for conn in conns])
+
+    def test_idle_timeout(self):
+        conns = []
+        def ConnFactory():
+            conns.append(self.Conn())
+            return conns[-1]
+        table = collapse_tcp_streams(self.stream([
+            (0, 1, ('SYN',)), (0, 2, ('SYN',)), (5, 2, ('ACK',)), (11, 3, ('SYN',)), (12, 1, ('ACK',)), (14, 2, ('ACK',)),
+        ]), ConnFactory, connections = ConnectionTable(idle_timeout = 10))
+        self.assertEqual(1, table.idle_evictions)
+        self.assertEqual(2, len(table))
+        self.assertEqual([1, 3, 1], [len(conn.packets) for conn in conns])
+
+    def test_lru(self):
+        table = collapse_tcp_streams(self.stream([
+            (0, 1, ('SYN',)), (0, 2, ('SYN',)), (1, 1, ('ACK',)), (2, 3, ('SYN',)),
+        ]), self.Conn, connections = ConnectionTable(max_connections = 2))
+        self.assertEqual(1, table.lru_evictions)
+        self.assertEqual(2, table.counters()['active_connections'])
+        self.assertEqual(2, table.counters()['peak_connections'])
+        self.assertFalse(frozenset([(parse_ip_string('10.5.6.56'), 2), (parse_ip_string('10.7.5.15'), 3306)]) in table)
+
+class TestTcpReassembler(unittest.TestCase):
+
+    def segments(self, *pieces):
+        # pieces: (sequence number, data)
+        return [Packet(make_packet((1, 35991), (2, 3306), data, ('ACK', 'PSH'), seq)) for seq, data in pieces]
+
+    def reassemble(self, packets, **kw):
+        stream = TcpReassembler(**kw)
+        out = []
+        for packet in packets:
+            packet.parse()
+            out.extend(stream.feed(packet))
+        return stream, ''.join(str(data) if data is not None else '|' for packet, data in out)
+
+    def test_in_order(self):
+        syn = Packet(make_packet((1, 35991), (2, 3306), '', ('SYN',), 99))
+        stream, data = self.reassemble([syn] + self.segments((100, 'abc'), (103, 'def')))
+        self.assertEqual('abcdef', data)
+        self.assertEqual({}, stream.counters)
+
+    def test_reordered(self):
+        stream, data = self.reassemble(self.segments((100, 'abc'), (106, 'ghi'), (109, 'j'), (103, 'def')))
+        self.assertEqual('abcdefghij', data)
+        self.assertEqual({'tcp_out_of_order': 2}, stream.counters)
+        self.assertEqual(0, stream.pending_bytes)
+
+    def test_retransmits(self):
+        stream, data = self.reassemble(self.segments(
+            (100, 'abc'), (100, 'abc'), (101, 'bcdef'), (109, 'j'), (109, 'j'), (106, 'ghi'), (103, 'd')))
+        self.assertEqual('abcdefghij', data)
+        self.assertEqual({'tcp_retransmits': 4, 'tcp_out_of_order': 1}, stream.counters)
+
+    def test_gap(self):
+        stream, data = self.reassemble(self.segments((100, 'abc'), (110, 'klm'), (113, 'nop'), (116, 'q')), max_pending = 6)
+        self.assertEqual('abc|klmnopq', data)
+        self.assertEqual(1, stream.counters['tcp_gaps'])
+        self.assertEqual(7, stream.counters['tcp_gap_bytes'])
+
+    def test_wraparound(self):
+        stream, data = self.reassemble(self.segments((0xFFFFFFFE, 'ab'), (2, 'ef'), (0, 'cd')))
+        self.assertEqual('abcdef', data)
+        self.assertEqual(4, stream.next_seq)
+
+class TestPacketFilter(unittest.TestCase):
+
+    def setUp(self):
+        self.mysql = (parse_ip_string('10.7.5.15'), 3306)
+        self.client = (parse_ip_string('10.5.6.56'), 35991)
+        self.web = (parse_ip_string('10.7.5.80'), 80)
+
+    def matches(self, expression, source, destination):
+        raw_packet = make_packet(source, destination, 'data')
+        return PacketFilter(expression)(raw_packet, 14, len(raw_packet))
+
+    def test_port(self):
+        self.assertTrue(self.matches('tcp port 3306', self.client, self.mysql))
+        self.assertTrue(self.matches('tcp port 3306', self.mysql, self.client))
+        self.assertFalse(self.matches('tcp port 3306', self.client, self.web))
+        self.assertTrue(self.matches('dst port 3306', self.client, self.mysql))
+        self.assertFalse(self.matches('src port 3306', self.client, self.mysql))
+
+    def test_host(self):
+        self.assertTrue(self.matches('tcp port 3306 and host 10.7.5.15', self.mysql, self.client))
+        self.assertFalse(self.matches('port 3306 and host 10.7.5.16', self.mysql, self.client))
+        self.assertTrue(self.matches('src host 10.5.6.56', self.client, self.web))
+        self.assertFalse(self.matches('dst host 10.5.6.56', self.client, self.web))
+
+    def test_boolean(self):
+        self.assertTrue(self.matches('port 80 or port 3306', self.client, self.web))
+        self.assertFalse(self.matches('not (port 80 or port 3306)', self.client, self.web))
+        self.assertTrue(self.matches('tcp and not port 3306', self.client, self.web))
+        self.assertTrue(self.matches('tcp and port 80', self.client, self.web))
+        self.assertTrue(self.matches('tcp dst port 80', self.client, self.web))
+
+    def test_non_ip(self):
+        arp = '\xff' * 12 + '\x08\x06' + '\x00' * 46
+        self.assertEqual(None, ethernet_ip(arp, 0, len(arp)))
+
+    def test_ipv6(self):
+        mysql = (parse_ip_string('2001:db8::15'), 3306)
+        client = (parse_ip_string('2001:db8::56'), 35991)
+        self.assertTrue(self.matches('tcp port 3306', client, mysql))
+        self.assertTrue(self.matches('tcp and dst host 2001:db8::15', client, mysql))
+        self.assertFalse(self.matches('host 2001:db8::16', client, mysql))
+        self.assertFalse(self.matches('host 10.7.5.15', client, mysql))
+        self.assertFalse(self.matches('host 2001:db8::15', self.client, self.mysql))
+        self.assertRaises(FilterError, PacketFilter, 'host 2001:db8:::1')
+
+    def test_bad_expressions(self):
+        for expression in ('port', 'port http', 'udp', 'host 10.7.5.15 and', '(tcp', 'tcp tcp'):
+            self.assertRaises(FilterError, PacketFilter, expression)
+
+    def test_read_packets(self):
+        import tempfile
+        fd = tempfile.NamedTemporaryFile()
+        write_pcap(fd, [
+            (1, make_packet(self.client, self.web)),
+            (2, make_packet(self.client, self.mysql)),
+            (3, make_packet(self.mysql, self.client)),
+        ])
+        fd.flush()
+        self.assertEqual([2, 3], [p.timestamp for p in read_packets(fd.name, filter='tcp port 3306')])
+        fd.seek(0)
+        self.assertEqual([2, 3], [p.timestamp for p in stream_packets(fd, filter='tcp port 3306')])
+
+class TestShardFilter(unittest.TestCase):
+
+    def test_connections_stay_together(self):
+        import tempfile
+        server = (parse_ip_string('10.7.5.15'), 3306)
+        packets = []
+        for n in range(40):
+            client = (parse_ip_string('10.5.6.%d' % (n % 7 + 1)), 30000 + n)
+            packets.append((n, make_packet(client, server)))
+            packets.append((n + 0.5, make_packet(server, client)))
+        fd = tempfile.NamedTemporaryFile()
+        write_pcap(fd, packets)
+        fd.flush()
+
+        seen = []
+        for shard in range(3):
+            sockets = {}
+            for p in read_packets(fd.name, modulo=(shard, 3)):
+                p.parse()
+                sockets[p.socket] = sockets.get(p.socket, 0) + 1
+            self.assertTrue(sockets)
+            self.assertEqual([2], list(set(sockets.values())))
+            seen.extend(sockets.keys())
+        self.assertEqual(40, len(set(seen)))
+        self.assertEqual(40, len(seen))
+
+class TestCaptureIndex(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        client = (parse_ip_string('10.5.6.56'), 35991)
+        server = (parse_ip_string('10.7.5.15'), 3306)
+        # Mostly in order, with a few frames out of place
+        times = [100 + n * 0.5 for n in range(40)]
+        times[10], times[25] = times[25], times[10]
+        self.packets = [(ts, make_packet(client, server, 'frame %d' % n)) for n, ts in enumerate(times)]
+        self.fd = tempfile.NamedTemporaryFile()
+
+    def tearDown(self):
+        if os.path.exists(self.fd.name + '.idx'):
+            os.remove(self.fd.name + '.idx')
+
+    def write(self, capture):
+        self.fd.seek(0)
+        self.fd.truncate()
+        self.fd.write(capture)
+        self.fd.flush()
+
+    def timestamps(self, **kw):
+        return [p.timestamp for p in read_packets(self.fd.name, **kw)]
+
+    def test_time_range(self):
+        for capture in (pcap_file(self.packets), pcap_file(self.packets, '>', True), pcapng_file(self.packets, resolution = 9)):
+            self.write(capture)
+            index = capture_index(self.fd.name, every = 4)
+            self.assertEqual(10, len(index.entries))
+            everything = self.timestamps()
+            for start, end in ((None, None), (104, 109), (None, 101.5), (112.25, None), (101, 101), (200, 300)):
+                expected = [ts for ts in everything if (start is None or ts >= start) and (end is None or ts < end)]
+                self.assertEqual(expected, self.timestamps(start = start, end = end))
+            # The frame from 112.5 is at 105, so the part read starts before it
+            begin, stop = index.span(104, 106)
+            self.assertTrue(begin < index.entries[3][0] and stop > index.entries[6][0])
+
+    def test_ranges(self):
+        for capture in (pcap_file(self.packets), pcapng_file(self.packets)):
+            self.write(capture)
+            index = capture_index(self.fd.name, every = 3)
+            ranges = index.ranges(4)
+            self.assertEqual(4, len(ranges))
+            self.assertEqual([index.entries[0][0], len(capture)], [ranges[0][0], ranges[-1][1]])
+            timestamps = []
+            for span in ranges:
+                timestamps.extend(self.timestamps(span = span))
+            self.assertEqual(self.timestamps(), timestamps)
+            self.assertEqual(14, len(index.ranges(20)))
+            halves = [self.timestamps(start = 110, end = 111, span = span) for span in index.ranges(2)]
+            self.assertEqual([[110.0], [110.5]], halves)
+
+    def test_sidecar(self):
+        self.write(pcap_file(self.packets))
+        index = capture_index(self.fd.name, every = 5)
+        self.assertTrue(os.path.exists(self.fd.name + '.idx'))
+        self.assertEqual(index.entries, capture_index(self.fd.name).entries)
+        self.assertEqual(4, len(capture_index(self.fd.name, every = 10).entries))
+        self.assertEqual(10, capture_index(self.fd.name).every)
+        # A capture that changed gets a new index
+        self.write(pcap_file(self.packets[:20]))
+        self.assertEqual(2, len(capture_index(self.fd.name, every = 10).entries))
+        self.assertEqual(20, len(self.timestamps(start = 0)))
+        file(self.fd.name + '.idx', 'wb').write('MPKI')
+        self.assertEqual(20, len(self.timestamps(end = 1000)))
+        self.write('')
+        self.assertEqual([], self.timestamps(start = 0))
+        self.assertEqual([], capture_index(self.fd.name).entries)
+
+@unittest.skipIf(numpy is None, "needs NumPy")
+class TestPacketTable(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.fd = tempfile.NamedTemporaryFile()
+        mysql = (parse_ip_string('10.7.5.15'), 3306)
+        mysql6 = (parse_ip_string('2001:db8::15'), 3306)
+        web = (parse_ip_string('10.7.5.80'), 80)
+        self.packets = []
+        for n in range(30):
+            client = (parse_ip_string('10.5.6.%d' % (n % 4 + 1)), 40000 + n % 4)
+            client6 = (parse_ip_string('2001:db8::%x' % (n % 3 + 0x56)), 50000 + n % 3)
+            self.packets.extend([
+                (n, make_packet(client, mysql, 'q' * n, ('ACK', 'PSH'), n)),
+                (n + 0.25, make_packet(mysql, client, 'r' * (n * 40), ('ACK',), n)),
+                (n + 0.5, make_packet(client6, mysql6, 's' * n, ('SYN',) if n < 3 else ('ACK',))),
+                (n + 0.75, make_packet(web, client, 'w' * 9)),
+            ])
+        self.packets.append((31, '\xff' * 12 + '\x08\x06' + '\x00' * 46))
+        self.packets.append((32, make_datagram(client, (web[0], 53), '\x00' * 13 + '\x02')))
+
+    def write(self, capture):
+        self.fd.seek(0)
+        self.fd.truncate()
+        self.fd.write(capture)
+        self.fd.flush()
+
+    def check(self, tables, filter = None):
+        expected = list(read_packets(self.fd.name, filter = filter))
+        rows = numpy.concatenate([table.rows for table in tables])
+        packets = [p for table in tables for p in table.packets()]
+        self.assertEqual(len(expected), len(packets))
+        for row, p, q in zip(rows.tolist(), packets, expected):
+            self.assertEqual((p.pcap, str(p.raw_data), p.ip_offset, p.link_type), (q.pcap, str(q.raw_data), q.ip_offset, q.link_type))
+            row = dict(zip(rows.dtype.names, row))
+            self.assertEqual(q.timestamp, row['timestamp'])
+            if q.ip_offset is None:
+                self.assertEqual((0, -1), (row['version'], row['tcp_offset']))
+                continue
+            q.parse()
+            if q.socket is None:
+                self.assertEqual(-1, row['tcp_offset'])
+                continue
+            version = row['version']
+            self.assertEqual((q.source, q.destination, q.control, str(q.data)),
+                             ((table_address(row['source_ip'], version), row['source_port']),
+                              (table_address(row['destination_ip'], version), row['destination_port']),
+                              control_table[row['flags']], str(q.raw_data)[row['payload_offset']:]))
+            self.assertEqual(len(q.data), row['payload_length'])
+
+    def test_matches_read_packets(self):
+        for capture in (pcap_file(self.packets), pcap_file(self.packets, '>', True), pcapng_file(self.packets, '>', 9),
+                        pcapng_file(self.packets[:50]) + pcapng_file(self.packets[50:], '>')):
+            self.write(capture)
+            for block_rows in (7, 1000):
+                tables = list(read_tables(self.fd.name, block_rows))
+                self.assertEqual(-(-len(self.packets) // block_rows), len(tables))
+                self.check(tables)
+
+    def test_link_types(self):
+        vlan = lambda frame: frame[:12] + '\x81\x00\x00\x05' + frame[12:]
+        sll = lambda frame: '\x00\x00\x00\x01\x00\x06' + frame[6:12] + '\x00\x00' + frame[12:]
+        null = lambda frame: '\x02\x00\x00\x00' + frame[14:]
+        for link_type, wrap in ((1, vlan), (1, lambda frame: vlan(vlan(frame))), (113, sll), (101, lambda frame: frame[14:]),
+                                (0, null)):
+            self.write(pcap_file([(ts, wrap(frame)) for ts, frame in self.packets], link_type = link_type))
+            self.check(list(read_tables(self.fd.name)))
+
+    def test_filters(self):
+        self.write(pcapng_file(self.packets))
+        table, = read_tables(self.fd.name)
+        for expression in ('tcp port 3306', 'tcp dst port 3306', 'src host 10.5.6.2 or host 2001:db8::57',
+                           'not port 80 and not host 10.5.6.1', 'tcp and (port 80 or src port 40003)', 'host 10.7.5.15'):
+            self.assertEqual([p.pcap for p in read_packets(self.fd.name, filter = expression)],
+                             [p.pcap for p in table.take(table.mask(expression)).packets()])
+            self.check(list(read_tables(self.fd.name, 11, filter = expression)), expression)
+
+    def test_conversations(self):
+        self.write(pcap_file(self.packets))
+        expected = {}
+        for p in read_packets(self.fd.name, filter = 'tcp'):
+            p.parse()
+            packets, size = expected.get(p.socket, (0, 0))
+            expected[p.socket] = (packets + 1, size + p.pcap.orig_len)
+        busiest = conversations(read_tables(self.fd.name, 13))
+        self.assertEqual(expected, dict((socket, (packets, size)) for socket, packets, size in busiest))
+        self.assertEqual(11, len(busiest))
+        self.assertEqual([size for socket, packets, size in busiest], sorted([size for socket, packets, size in busiest], reverse = True))
+        self.assertEqual(3, len(conversations(read_tables(self.fd.name), 3)))
+
+    def test_macs(self):
+        self.write(pcap_file(self.packets))
+        macs = read_tables(self.fd.name).next().macs()
+        self.assertEqual({'\x00\x19\xb9\xb4s\xe4': 121, '\x00\x19\xb9\xf3\xb4\xb5': 121, '\xff' * 6: 2}, macs)
+
+    def test_empty(self):
+        self.write('')
+        self.assertEqual([], list(read_tables(self.fd.name)))
+        self.write(pcap_file([]))
+        self.assertEqual([], list(read_tables(self.fd.name)))
+
 if __name__ == "__main__":
-    unittest.main()
\ No newline at end of file
+    if sys.argv[1:2] == ['replay']:
+        replay_pcap(sys.argv[2], sys.stdout, float(sys.argv[3]) if len(sys.argv) > 3 else 1.0)
+    elif sys.argv[1:2] == ['top']:
+        # The busiest TCP conversations: python tcpip.py top capture.pcap [n [filter]]
+        for endpoints, packets, size in conversations(read_tables(sys.argv[2], filter = ' '.join(sys.argv[4:]) or None),
+                                                      int(sys.argv[3]) if len(sys.argv) > 3 else 20):
+            print '%12d bytes %9d packets  %s' % (size, packets, ' <-> '.join(sorted(map(format_endpoint, endpoints))))
+    elif sys.argv[1:2] == ['index']:
+        # Build the index ahead of time: python tcpip.py index capture.pcap [every]
+        print capture_index(sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else None)
+    else:
+        unittest.main()
\ No newline at end of file